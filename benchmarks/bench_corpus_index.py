@@ -0,0 +1,83 @@
+""" 语料倒排索引 (TraceCorpus) 与全量扫描的查询耗时对比
+
+    在临时目录里面生成若干个 .jsonl 文件，分别测量:
+        - 首次全量建索引、无变化时增量更新、新增一个文件之后增量更新的耗时
+        - "哪些 trace 里面有出错的 llm span" 这个查询: 全量扫描 (逐个打开文件、建 SpanTree、检查) 与索引查询 (search / search + load)
+
+    用法: python benchmarks/bench_corpus_index.py [--files 8] [--traces-per-file 250] [--spans 100] [--workers 4]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.collections import SpanTree
+from tracespantree.collections.corpus import TraceCorpus
+from tracespantree.utils.io import iter_traces
+from tracespantree.utils.synthetic import generate_traces, write_jsonl
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, round(time.perf_counter() - start, 4)
+
+
+def full_scan(root: str) -> int:
+    matched = 0
+    for trace in iter_traces(root):
+        tree = SpanTree(trace=trace)
+        if any(span.get("type") == "llm" and span.get("status_code") == 1 for span in tree.span_map.values()):
+            matched += 1
+    return matched
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--traces-per-file", type=int, default=250)
+    parser.add_argument("--spans", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="corpus-bench-")
+    try:
+        root = os.path.join(workdir, "traces")
+        os.makedirs(root)
+        for k in range(args.files):
+            write_jsonl(os.path.join(root, f"part-{k:04d}.jsonl"),
+                        generate_traces(args.traces_per_file, seed=k * args.traces_per_file, spans=args.spans,
+                                        payload_size=128, error_rate=0.002))
+
+        corpus = TraceCorpus(os.path.join(workdir, "corpus.idx"), root, fields=["status_code"], workers=args.workers)
+        build, build_s = timed(corpus.update)
+        _, noop_s = timed(corpus.update)
+        write_jsonl(os.path.join(root, "part-new.jsonl"), generate_traces(args.traces_per_file, seed=10 ** 6, spans=args.spans))
+        incremental, incremental_s = timed(corpus.update)
+
+        scan_matched, scan_s = timed(lambda: full_scan(root))
+        hits, search_s = timed(lambda: corpus.search(span_type="llm", where={"status_code": 1}))
+        loaded, load_s = timed(lambda: sum(1 for _ in corpus.query(span_type="llm", where={"status_code": 1})))
+        assert scan_matched == len(hits) == loaded, (scan_matched, len(hits), loaded)
+
+        result = {
+            "traces": build["traces"] + incremental["traces"],
+            "index": {**corpus.stats(), "bytes": os.path.getsize(os.path.join(workdir, "corpus.idx"))},
+            "build_s": build_s,
+            "noop_update_s": noop_s,
+            "incremental_update_s": incremental_s,
+            "matched_traces": len(hits),
+            "full_scan_s": scan_s,
+            "search_s": search_s,
+            "search_and_load_s": load_s,
+            "speedup_search_and_load": round(scan_s / max(load_s, 1e-9), 1),
+        }
+        corpus.close()
+        print(json.dumps(result, indent=2))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,94 @@
+""" 跨 trace 抽取结果缓存 (batch_retrieve(configs, memo=ExtractionMemo())) 的基准测试
+
+    用少数几个模板 trace (拓扑结构相同) 生成大量 trace: 每个 trace 的 span_id 都不同，但是大部分下游 span 的负载与模板相同，
+    只有一部分 span 的负载随 trace 变化。抓取配置里面的回调有一定的计算量 (规范化 JSON + 摘要)，
+    对比不使用缓存与使用缓存时 batch_retrieve 的总耗时，并确认两者结果相同。
+
+    用法: python benchmarks/bench_extraction_memo.py [--traces 500] [--spans 200] [--templates 5] [--unique 0.1] [--callback-rounds 50]
+"""
+import os
+import sys
+import json
+import copy
+import time
+import random
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.collections import SpanTree, ExtractionMemo
+from tracespantree.utils.synthetic import generate_trace
+
+
+CALLBACK_ROUNDS = 50
+
+
+def fingerprint(value) -> str:
+    # 模拟有一定计算量的回调 (e.g. 解析、规范化模型输出)，计算量由 --callback-rounds 控制
+    digest = json.dumps(value, sort_keys=True).encode()
+    for _ in range(CALLBACK_ROUNDS):
+        digest = hashlib.sha256(digest).digest()
+    return digest.hex()[:16]
+
+
+def make_traces(n: int, spans: int, templates: int, unique: float, seed: int = 0) -> list:
+    # 模板之间拓扑结构与 span name 相同，只有一部分负载不同
+    rng = random.Random(seed)
+    base = generate_trace(spans=spans, seed=seed, stringified_ratio=0.0)
+    bases = [base]
+    for k in range(1, templates):
+        template = copy.deepcopy(base)
+        for span in template["spans"]:
+            if rng.random() < 0.5:
+                span["input"] = {"template": k, "value": rng.random()}
+        bases.append(template)
+    traces = []
+    for i in range(n):
+        trace = copy.deepcopy(bases[i % templates])
+        for span in trace["spans"]:
+            span["span_id"] = f"{i}:{span['span_id']}"
+            if span["parent_id"] != "0":
+                span["parent_id"] = f"{i}:{span['parent_id']}"
+            if rng.random() < unique:
+                span["output"] = {"request": i, "value": rng.random()}
+        traces.append(trace)
+    return traces
+
+
+def make_configs(trace: dict, entries: int) -> dict:
+    configs = {}
+    for span in trace["spans"][::max(1, len(trace["spans"]) // entries)][:entries]:
+        configs[span["name"]] = {"target_fields": [("input", None, fingerprint), ("output", None, fingerprint),
+                                                   ("duration", None, None)]}
+    return configs
+
+
+def run(trees: list, configs: dict, memo) -> tuple:
+    start = time.perf_counter()
+    rows = [tree.batch_retrieve(configs, memo=memo) for tree in trees]
+    return rows, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--traces", type=int, default=500)
+    parser.add_argument("--spans", type=int, default=200)
+    parser.add_argument("--templates", type=int, default=5)
+    parser.add_argument("--unique", type=float, default=0.1, help="负载随 trace 变化的 span 比例")
+    parser.add_argument("--entries", type=int, default=10, help="抓取配置的配置项个数")
+    parser.add_argument("--callback-rounds", type=int, default=50, help="回调的计算量，0 表示几乎没有计算量")
+    args = parser.parse_args()
+    CALLBACK_ROUNDS = args.callback_rounds
+
+    traces = make_traces(args.traces, args.spans, args.templates, args.unique)
+    configs = make_configs(traces[0], args.entries)
+
+    baseline_rows, baseline = run([SpanTree(trace=copy.deepcopy(trace)) for trace in traces], configs, None)
+    memo = ExtractionMemo()
+    memo_rows, memoized = run([SpanTree(trace=copy.deepcopy(trace)) for trace in traces], configs, memo)
+    assert baseline_rows == memo_rows, "memoized results differ from the baseline"
+
+    print(json.dumps({"memo": False, "traces": len(traces), "batch_retrieve_seconds": round(baseline, 4)}))
+    print(json.dumps({"memo": True, "traces": len(traces), "batch_retrieve_seconds": round(memoized, 4), **memo.counters()}))
+    print(f"speedup: {baseline / memoized:.2f}x")
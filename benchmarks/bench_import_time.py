@@ -0,0 +1,81 @@
+""" import 耗时基准测试 (python -X importtime)，同时检查导入是否有副作用
+
+    - import tracespantree 的累计耗时 (多次运行取中位数) 不能超过预算
+    - 导入 tracespantree 以及 utils 下面的 logx/ploter/decorator 之后，不能加载 matplotlib、networkx、colorlog、
+      pandas、urllib3、asyncio 等重量级依赖，也不能在当前目录创建 logs/ 或者给 root logger 挂 handler
+
+    用法: python benchmarks/bench_import_time.py [--budget-ms 40] [--repeat 7]
+    超出预算或者检测到副作用时以非零状态码退出
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["matplotlib", "networkx", "colorlog", "pandas", "openpyxl", "urllib3", "asyncio", "concurrent.futures", "sqlite3"]
+
+SIDE_EFFECT_PROBE = f"""
+import os, sys, json, logging
+import tracespantree
+import tracespantree.utils.logx, tracespantree.utils.ploter, tracespantree.utils.decorator, tracespantree.utils.io
+print(json.dumps({{
+    "heavy_modules": [m for m in {HEAVY_MODULES!r} if m in sys.modules],
+    "logs_dir_created": os.path.exists("logs"),
+    "root_handlers": len(logging.getLogger().handlers),
+}}))
+"""
+
+
+def _run(args, cwd):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    return subprocess.run([sys.executable, *args], cwd=cwd, env=env, capture_output=True, text=True, check=True)
+
+
+def import_time_us(cwd: str, module: str = "tracespantree") -> int:
+    stderr = _run(["-X", "importtime", "-c", f"import {module}"], cwd).stderr
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        # 格式: "import time: self [us] | cumulative | imported package"
+        _, cumulative_us, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative_us)
+    raise RuntimeError(f"module {module} not found in -X importtime output")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=40.0)
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cwd:
+        import_time_us(cwd)  # 预热，生成 .pyc
+        samples = [import_time_us(cwd) / 1000 for _ in range(args.repeat)]
+        side_effects = json.loads(_run(["-c", SIDE_EFFECT_PROBE], cwd).stdout)
+
+    result = {
+        "module": "tracespantree",
+        "median_ms": round(statistics.median(samples), 2),
+        "max_ms": round(max(samples), 2),
+        "budget_ms": args.budget_ms,
+        **side_effects,
+    }
+    print(json.dumps(result))
+
+    failures = []
+    if result["median_ms"] > args.budget_ms:
+        failures.append(f"import time {result['median_ms']}ms exceeds budget {args.budget_ms}ms")
+    if side_effects["heavy_modules"]:
+        failures.append(f"heavy modules imported eagerly: {side_effects['heavy_modules']}")
+    if side_effects["logs_dir_created"] or side_effects["root_handlers"]:
+        failures.append("importing the package configured logging or created a logs/ directory")
+    if failures:
+        print("\n".join(failures), file=sys.stderr)
+        sys.exit(1)
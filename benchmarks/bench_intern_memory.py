@@ -0,0 +1,78 @@
+""" 负载驻留 (SpanTree(intern=True)) 的内存基准测试
+
+    构造一个扇出严重的合成 trace: 根节点下面挂 fanout 个相同结构的调用，每个调用再挂 depth 层子调用，
+    每个 span 都带有相同的请求模板 (字符串化 JSON) 与配置字典，对比驻留前后 SpanTree 占用的内存。
+
+    用法: python benchmarks/bench_intern_memory.py [--fanout 2000] [--depth 3]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.collections import SpanTree
+
+
+REQUEST_TEMPLATE = json.dumps({
+    "method": "POST",
+    "headers": {"content-type": "application/json", "x-client": "bench", "x-region": "cn-north-1"},
+    "body": {"model": "demo", "params": {"temperature": 0.7, "top_p": 0.9, "max_tokens": 512},
+             "messages": [{"role": "system", "content": "You are a helpful assistant. " * 8}]},
+})
+
+CONFIG = {"retry": {"max": 3, "backoff_ms": [100, 200, 400]}, "timeout_ms": 3000, "feature_flags": ["a", "b", "c"]}
+
+
+def fanout_spans(fanout: int, depth: int) -> list:
+    spans = [{"span_id": "0", "parent_id": None, "name": "root", "request": REQUEST_TEMPLATE}]
+    for i in range(fanout):
+        parent_id = "0"
+        for level in range(depth):
+            span_id = f"{i}-{level}"
+            spans.append({
+                "span_id": span_id,
+                "parent_id": parent_id,
+                "name": f"call_level_{level}",
+                "request": REQUEST_TEMPLATE,
+                "config": json.loads(json.dumps(CONFIG)),
+                "status_code": 0,
+            })
+            parent_id = span_id
+    return spans
+
+
+def measure(fanout: int, depth: int, intern: bool) -> dict:
+    spans = fanout_spans(fanout, depth)
+    tracemalloc.start()
+    start = time.perf_counter()
+    tree = SpanTree(spans=spans, intern=intern)
+    elapsed = time.perf_counter() - start
+    del spans
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    groups = tree.group_identical_subtrees()
+    return {
+        "intern": intern,
+        "spans": len(tree.span_map),
+        "build_seconds": round(elapsed, 4),
+        "retained_mb": round(current / 2 ** 20, 2),
+        "peak_mb": round(peak / 2 ** 20, 2),
+        "largest_identical_group": len(groups[0]) if groups else 0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fanout", type=int, default=2000)
+    parser.add_argument("--depth", type=int, default=3)
+    args = parser.parse_args()
+
+    baseline = measure(args.fanout, args.depth, intern=False)
+    interned = measure(args.fanout, args.depth, intern=True)
+    for row in (baseline, interned):
+        print(json.dumps(row))
+    print(f"retained memory ratio: {interned['retained_mb'] / baseline['retained_mb']:.2%}")
@@ -0,0 +1,50 @@
+""" KVView 与 KVTree 的构造/单次查询开销对比
+
+    KVTree 构造时会调用 expand 展开并改写整份数据，KVView 只引用原始数据，查询时按需解析经过的字符串化 JSON。
+    每个 span 的负载都是字符串化 JSON，分别测量 "只构造" 与 "构造 + 查询一个字段" 两种场景下每个 span 的平均耗时。
+
+    用法: python benchmarks/bench_kvview.py [--spans 2000] [--payload-size 4096]
+"""
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.collections import KVTree, KVView
+from tracespantree.utils.synthetic import generate_trace
+
+
+def measure(spans: list, factory, key: str = None) -> float:
+    # KVTree 会原地改写输入，每种场景都使用一份独立的深拷贝，拷贝本身不计时
+    spans = copy.deepcopy(spans)
+    start = time.perf_counter()
+    for span in spans:
+        tree = factory(span)
+        if key is not None:
+            tree.get(key)
+    return (time.perf_counter() - start) / len(spans)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spans", type=int, default=2000)
+    parser.add_argument("--payload-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    spans = generate_trace(spans=args.spans, payload_size=args.payload_size, stringified_ratio=1.0, seed=7)["spans"]
+    key = "output.field_3.value"
+
+    rows = []
+    for label, factory in (("KVTree", KVTree), ("KVView", KVView)):
+        rows.append({
+            "impl": label,
+            "construct_us": round(measure(spans, factory) * 1e6, 2),
+            "construct_and_get_us": round(measure(spans, factory, key) * 1e6, 2),
+        })
+    for row in rows:
+        print(json.dumps(row))
+    print(f"construct + single lookup speedup: {rows[0]['construct_and_get_us'] / rows[1]['construct_and_get_us']:.1f}x")
@@ -0,0 +1,73 @@
+""" logx 同步模式与队列模式的日志吞吐对比 (多线程竞争)
+
+    每种模式下 N 个线程同时各写 M 条日志到文件 (不输出到控制台)，测量:
+        - calls_per_s:   调用方视角的吞吐，即所有线程的 log 调用全部返回所花的时间
+        - drained_per_s: 包含队列模式把剩余日志写完 (shutdown_logger) 的时间
+    另外测一种 "重复失败信息" 的场景: 同一处代码对不同字段打印失败信息，开启按模板限流之后绝大部分日志在入队之前就被丢弃
+
+    用法: python benchmarks/bench_logging.py [--threads 8] [--messages 5000]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.utils import logx
+
+
+def run(threads: int, messages: int, log_dir: str, name: str, repeated: bool = False, **kwargs) -> dict:
+    logger = logx.logger_initiate(is_console=False, log_dir=log_dir, name=name, max_bytes=64 * 1024 * 1024, **kwargs)
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(k):
+        barrier.wait()
+        for i in range(messages):
+            if repeated:
+                logger.warning("Failed to retrieve '%s' from span '%s': %s", f"field_{i % 50}", f"span_{k}", "KeyError")
+            else:
+                logger.info("worker %d extracted field %d from span %s", k, i, "llm_call")
+
+    pool = [threading.Thread(target=worker, args=(k,)) for k in range(threads)]
+    for thread in pool:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    returned = time.perf_counter() - start
+    logx.shutdown_logger(name)
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+    drained = time.perf_counter() - start
+
+    total = threads * messages
+    return {"calls_per_s": round(total / returned), "drained_per_s": round(total / drained)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+
+    log_dir = tempfile.mkdtemp(prefix="logx-bench-")
+    try:
+        scenarios = {
+            "sync":                     dict(),
+            "queue":                    dict(use_queue=True),
+            "sync/repeated":            dict(repeated=True),
+            "queue/repeated":           dict(use_queue=True, repeated=True),
+            "queue/repeated+ratelimit": dict(use_queue=True, repeated=True, rate_limit=logx.RateLimitFilter(1.0, burst=10, by="template")),
+        }
+        for label, kwargs in scenarios.items():
+            result = run(args.threads, args.messages, log_dir, label.replace("/", "_").replace("+", "_"), **kwargs)
+            print(json.dumps({"mode": label, "threads": args.threads, **result}))
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
@@ -0,0 +1,106 @@
+""" 大型 OTLP/JSON 导出文件的建树基准测试
+
+    把合成 trace 转换成 OTLP/JSON (resourceSpans[].scopeSpans[].spans[]，属性为 key/value 列表)，对比两种建树方式:
+        - schema:   SpanTree(trace=document, schema="otlp")，span 按引用挂到树上，通过访问函数读取 id/name/时间戳
+        - remap:    先把每个 span 复制、重映射成默认格式 (name/span_id/parent_id + tags)，再按默认格式建树
+    分别记录建树耗时、建树之后保留的内存 (tracemalloc) 以及一次 analyze() 的耗时。
+
+    用法: python benchmarks/bench_otlp_ingest.py [--spans 50000] [--services 8]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.collections import SpanTree
+from tracespantree.utils.synthetic import generate_trace
+
+
+def to_otlp(trace: dict, services: int) -> dict:
+    ''' 合成 trace -> OTLP/JSON，span 按照名字的哈希分配到 services 个 resource 里面
+    '''
+    trace_id = trace["trace_id"].encode().hex()[:32].ljust(32, "0")
+    resources = [[] for _ in range(services)]
+    for span in trace["spans"]:
+        payload = span["input"] if isinstance(span["input"], dict) else json.loads(span["input"])
+        attributes = [{"key": "span.type", "value": {"stringValue": span["type"]}},
+                      {"key": "duration.ms", "value": {"intValue": str(span["duration"])}}]
+        for group in payload.values():
+            for field, value in group.items():
+                attributes.append({"key": f"app.{field}", "value": {"stringValue": value["value"]}})
+        resources[hash(span["name"]) % services].append({
+            "traceId": trace_id,
+            "spanId": span["span_id"],
+            "parentSpanId": "" if span["parent_id"] == "0" else span["parent_id"],
+            "name": span["name"],
+            "kind": 2,
+            "startTimeUnixNano": str(span["start_time"] * 1_000_000),
+            "endTimeUnixNano": str(span["end_time"] * 1_000_000),
+            "attributes": attributes,
+            "status": {"code": 2 if span["status_code"] else 0},
+        })
+    return {"resourceSpans": [
+        {"resource": {"attributes": [{"key": "service.name", "value": {"stringValue": f"service-{i}"}}]},
+         "scopeSpans": [{"scope": {"name": "bench"}, "spans": spans}]}
+        for i, spans in enumerate(resources)
+    ]}
+
+
+def remap(document: dict) -> list:
+    spans = []
+    for resource_spans in document["resourceSpans"]:
+        for scope_spans in resource_spans["scopeSpans"]:
+            for span in scope_spans["spans"]:
+                spans.append({
+                    "name": span["name"],
+                    "span_id": span["spanId"],
+                    "parent_id": span["parentSpanId"] or None,
+                    "duration": (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])),
+                    "status_code": 1 if span["status"]["code"] == 2 else 0,
+                    "tags": [{"key": item["key"], "value": dict(item["value"])} for item in span["attributes"]],
+                })
+    return spans
+
+
+def measure(raw: str, mode: str) -> dict:
+    document = json.loads(raw)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    if mode == "schema":
+        tree = SpanTree(trace=document, schema="otlp")
+    else:
+        tree = SpanTree(spans=remap(document))
+    build = time.perf_counter() - start
+    if mode == "remap":
+        del document
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    analytics = tree.analyze()
+    analyze = time.perf_counter() - start
+    return {
+        "mode": mode,
+        "spans": len(tree.span_map),
+        "build_seconds": round(build, 4),
+        "retained_extra_mb": round((current - before) / 2 ** 20, 2),
+        "analyze_seconds": round(analyze, 4),
+        "critical_path_len": len(analytics.critical_path),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spans", type=int, default=50000)
+    parser.add_argument("--services", type=int, default=8)
+    args = parser.parse_args()
+
+    raw = json.dumps(to_otlp(generate_trace(spans=args.spans, payload_size=256, seed=11), args.services))
+    print(f"OTLP export: {len(raw) / 2 ** 20:.1f} MB")
+    for mode in ("schema", "remap"):
+        print(json.dumps(measure(raw, mode)))
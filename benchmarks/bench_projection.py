@@ -0,0 +1,114 @@
+""" 投影下推 (SpanTree(projection=configs)) 的建树耗时与内存基准测试
+
+    合成一个负载较重的 trace (一部分负载是字符串化 JSON)，抓取配置只关心少数几个 span 的几个字段，
+    对比完整展开与投影之后的建树耗时、SpanTree 占用的内存，并确认两者 batch_retrieve 的结果相同；
+    另外在一批随机嵌套的负载 (含字符串化 JSON、None、list 与同名字段) 上确认投影不改变抓取结果 (--fuzz 控制个数)。
+
+    用法: python benchmarks/bench_projection.py [--spans 2000] [--payload-size 4096] [--repeat 3] [--fuzz 500]
+"""
+import os
+import sys
+import json
+import copy
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.collections import SpanTree, SpanProjection
+from tracespantree.utils.synthetic import generate_trace
+
+
+def make_configs(trace: dict) -> dict:
+    spans = trace["spans"]
+    return {
+        spans[0]["name"]: {"target_fields": [("duration", None, None), ("output_group_0.field_0.value", None, None)]},
+        spans[len(spans) // 2]["name"]: {"target_fields": {"score": ("input.score", None, None)}},
+        "db": {"is_type": True, "target_fields": [("status_code", None, None)]},
+    }
+
+
+def random_payload(rng: random.Random, depth: int):
+    roll = rng.random()
+    if depth <= 0 or roll < 0.25:
+        return rng.choice([None, 0, 5, "", "s", False, "{bad"])
+    if roll < 0.55:
+        return {key: random_payload(rng, depth - 1) for key in rng.sample("abcd", rng.randint(1, 3))}
+    if roll < 0.75:
+        return [random_payload(rng, depth - 1) for _ in range(rng.randint(0, 3))]
+    inner = random_payload(rng, depth - 1)
+    return json.dumps(inner) if isinstance(inner, (dict, list)) else inner
+
+
+def check_equivalence(n: int, seed: int = 0) -> int:
+    ''' 投影只保留搜索经过的命中路径: 第一个命中的字段即使走不到完整路径也要保留 (搜索不回溯)，
+        这里在随机负载上对比完整 span 与投影之后的 span 的 batch_retrieve 结果
+    '''
+    cases = [
+        ({"x": {"a": {"c": 1}}, "y": {"a": {"b": 2}}}, "a.b", None),
+        ({"x": {"a": 5}, "y": {"a": {"b": 3}}}, "a.b", None),
+    ]
+    rng = random.Random(seed)
+    for _ in range(n):
+        payload = {key: random_payload(rng, 4) for key in rng.sample("abcd", 3)}
+        field = ".".join(rng.choice("abcd") for _ in range(rng.randint(1, 3)))
+        cases.append((payload, field, rng.choice([None, 0, -1])))
+
+    for payload, field, idx in cases:
+        trace = {"spans": [dict(payload, name="target", span_id="1", parent_id="0")]}
+        configs = {"target": {"idx": idx, "target_fields": {"value": (field, "default", None)}}}
+        for source in ("trace", "spans"):
+            kwargs = {"trace": trace} if source == "trace" else {"spans": trace["spans"]}
+            full = SpanTree(**copy.deepcopy(kwargs), super_id="0").batch_retrieve(configs)
+            projected = SpanTree(**copy.deepcopy(kwargs), super_id="0", projection=configs).batch_retrieve(configs)
+            assert full == projected, f"projection changed the result of {field!r} on {payload!r}: {full} != {projected}"
+    return len(cases)
+
+
+def measure(trace: dict, configs: dict, projection, repeat: int) -> dict:
+    best = None
+    for _ in range(repeat):
+        data = copy.deepcopy(trace)
+        start = time.perf_counter()
+        tree = SpanTree(trace=data, projection=projection)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    data = copy.deepcopy(trace)
+    tracemalloc.start()
+    tree = SpanTree(trace=data, projection=projection)
+    del data
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "projection": projection is not None,
+        "spans": len(tree.span_map),
+        "build_seconds": round(best, 4),
+        "retained_mb": round(current / 2 ** 20, 2),
+        "peak_mb": round(peak / 2 ** 20, 2),
+        "results": tree.batch_retrieve(configs),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spans", type=int, default=2000)
+    parser.add_argument("--payload-size", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--fuzz", type=int, default=500, help="随机负载上的等价性检查个数")
+    args = parser.parse_args()
+
+    print(json.dumps({"equivalence_cases": check_equivalence(args.fuzz)}))
+
+    trace = generate_trace(spans=args.spans, payload_size=args.payload_size, stringified_ratio=0.5, seed=7)
+    configs = make_configs(trace)
+
+    full = measure(trace, configs, None, args.repeat)
+    projected = measure(trace, configs, SpanProjection(configs), args.repeat)
+    assert full.pop("results") == projected.pop("results"), "projection changed batch_retrieve results"
+    for row in (full, projected):
+        print(json.dumps(row))
+    print(f"retained memory ratio: {projected['retained_mb'] / full['retained_mb']:.2%}, "
+          f"build speedup: {full['build_seconds'] / projected['build_seconds']:.1f}x")
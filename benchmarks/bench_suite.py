@@ -0,0 +1,356 @@
+""" SpanTree / KVTree / Tracer 的基准测试套件 (asv 风格的最小实现，不依赖第三方库)
+
+    每个用例由 setup (不计时) 与 run (计时) 两部分组成，run 在一轮里面执行 number 次，一共测 repeat 轮，
+    记录每次调用的耗时 (秒) 的 min/median/mean/stdev。结果写成 JSON，带有 Python 版本、平台与 git 提交等信息，
+    可以用 --compare 与之前保存的结果对比，耗时比值超过 --threshold 的用例视为性能回退，进程以非零状态退出。
+
+    数据全部来自 tracespantree.utils.synthetic 的确定性合成 trace，相同的参数每次生成的数据完全一样。
+
+    用法:
+        python benchmarks/bench_suite.py --output bench_results.json
+        python benchmarks/bench_suite.py --filter retrieve --compare bench_results.json
+        python benchmarks/bench_suite.py --list
+"""
+import os
+import re
+import sys
+import copy
+import random
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.collections import SpanTree, KVTree, TraceAssembler
+from tracespantree.utils.synthetic import generate_trace
+from tracespantree.TraceGen import Tracer
+
+
+CASES = {}
+
+
+def case(name: str, number: int = 10, repeat: int = 5):
+    ''' 注册一个用例: 被装饰的函数只负责准备数据 (不计时)，返回一个无参的可调用对象，计时的就是这个可调用对象
+    '''
+    def decorator(setup):
+        CASES[name] = (setup, number, repeat)
+        return setup
+    return decorator
+
+
+# ---------------------------------------------------------------- 数据准备
+
+def _trace(spans: int, **kwargs) -> dict:
+    return generate_trace(spans=spans, seed=2024, **kwargs)
+
+
+def _leaf_paths(tree: SpanTree, count: int) -> list:
+    ''' 取 count 个叶子 span，返回 "父亲名称.叶子名称" 形式的约束搜索路径，用来驱动 retrieve。
+        约束搜索是贪心的 (先命中的同名父节点下面找不到叶子就返回 None)，这里只保留能够命中该叶子的路径
+    '''
+    paths = []
+    for span_id, span in tree.span_map.items():
+        if tree.sons.get(span_id):
+            continue
+        parent = tree.span_map.get(tree.parent_map.get(span_id))
+        if parent is None:
+            continue
+        path = f"{parent['name']}{tree.sep}{span['name']}"
+        if tree._recursive_inter_search(path) is span:
+            paths.append(path)
+        if len(paths) >= count:
+            break
+    return paths
+
+
+# ---------------------------------------------------------------- 用例
+
+@case("build/1k", number=5)
+def build_small():
+    trace = _trace(1000)
+    return lambda: SpanTree(trace=copy.deepcopy(trace))
+
+
+@case("build/10k", number=1, repeat=3)
+def build_large():
+    trace = _trace(10000)
+    return lambda: SpanTree(trace=copy.deepcopy(trace))
+
+
+@case("build/10k-broken-links", number=1, repeat=3)
+def build_broken():
+    trace = _trace(10000, broken_links=50)
+    return lambda: SpanTree(trace=copy.deepcopy(trace))
+
+
+@case("retrieve/cold-100", number=3)
+def retrieve_cold():
+    # 关闭缓存，测的是 inter + inner 搜索本身
+    tree = SpanTree(trace=_trace(5000, name_collisions=0.3), cache_size=0)
+    paths = _leaf_paths(tree, 100)
+
+    def run():
+        for path in paths:
+            tree.retrieve(path, "input_group_0.value")
+    return run
+
+
+@case("retrieve/warm-100", number=20)
+def retrieve_warm():
+    tree = SpanTree(trace=_trace(5000, name_collisions=0.3), cache_size=128)
+    paths = _leaf_paths(tree, 100)
+    for path in paths:
+        tree.retrieve(path, "input_group_0.value")
+
+    def run():
+        for path in paths:
+            tree.retrieve(path, "output_group_0.score")
+    return run
+
+
+@case("batch_retrieve/50x4", number=10)
+def batch_retrieve():
+    tree = SpanTree(trace=_trace(5000, name_collisions=0.3))
+    configs = {
+        path: {"target_fields": [("input_group_0.value", None, None), ("input_group_0.score", 0, float),
+                                 ("output_group_0.value", "", str.upper), ("duration", 0, None)]}
+        for path in _leaf_paths(tree, 50)
+    }
+    return lambda: tree.batch_retrieve(configs)
+
+
+@case("temporal/active_at-1000", number=5)
+def temporal_active_at():
+    # 区间树在 setup 里面构建，测的是 1000 次时间点查询
+    tree = SpanTree(trace=_trace(10000))
+    tree.interval_index
+    horizon = max(tree.end_times)
+    points = [horizon * i / 1000 for i in range(1000)]
+    return lambda: [tree.active_at(t) for t in points]
+
+
+@case("temporal/concurrent_with-100", number=5)
+def temporal_concurrent_with():
+    tree = SpanTree(trace=_trace(10000))
+    tree.interval_index
+    span_ids = list(tree.span_map)[::100]
+    return lambda: [tree.concurrent_with(span_id) for span_id in span_ids]
+
+
+@case("ancestry/lca-10k", number=3)
+def ancestry_lca():
+    # 稀疏表在 setup 里面构建，测的是一万次随机 span 对的 LCA 查询
+    tree = SpanTree(trace=_trace(10000))
+    span_ids = list(tree.span_map)
+    rng = random.Random(0)
+    pairs = [(rng.choice(span_ids), rng.choice(span_ids)) for _ in range(10000)]
+    tree.lca(*pairs[0])
+    return lambda: [tree.lca(a, b) for a, b in pairs]
+
+
+@case("ancestry/is_ancestor-10k", number=3)
+def ancestry_is_ancestor():
+    tree = SpanTree(trace=_trace(10000))
+    span_ids = list(tree.span_map)
+    rng = random.Random(0)
+    pairs = [(rng.choice(span_ids), rng.choice(span_ids)) for _ in range(10000)]
+    return lambda: [tree.is_ancestor(a, b) for a, b in pairs]
+
+
+@case("traverse/dfs-10k", number=5)
+def traverse_dfs():
+    # 在建树时算好的先序序列上迭代，剪掉一半子树
+    tree = SpanTree(trace=_trace(10000))
+    prune = lambda span, depth: span["status_code"] != 0 or depth >= 6
+    return lambda: [sum(1 for _ in tree.iter_dfs()), sum(1 for _ in tree.iter_dfs(prune=prune))]
+
+
+@case("traverse/levels-10k", number=5)
+def traverse_levels():
+    tree = SpanTree(trace=_trace(10000))
+    return lambda: [len(spans) for _, spans in tree.iter_levels(order="insertion")]
+
+
+@case("analytics/analyze-10k", number=3)
+def analytics_analyze():
+    tree = SpanTree(trace=_trace(10000))
+    return lambda: tree.analyze()
+
+
+@case("assembler/200x50-interleaved", number=3)
+def assembler_interleaved():
+    # 200 个 trace 的 span 随机交错成一条流，测的是按 trace id 拆分并产出 SpanTree 的吞吐
+    rng = random.Random(0)
+    queues = []
+    for k in range(200):
+        trace = generate_trace(spans=50, seed=k)
+        for span in trace["spans"]:
+            span["trace_id"] = trace["trace_id"]
+        queues.append(trace["spans"])
+    stream, cursors = [], [0] * len(queues)
+    active = list(range(len(queues)))
+    while active:
+        i = rng.choice(active)
+        stream.append(queues[i][cursors[i]])
+        cursors[i] += 1
+        if cursors[i] == len(queues[i]):
+            active.remove(i)
+
+    def run():
+        assembler = TraceAssembler(idle_timeout=60, max_open_traces=1000)
+        trees = list(assembler.process(copy.deepcopy(stream)))
+        assert len(trees) == 200
+    return run
+
+
+@case("kvtree/find_key", number=200)
+def kvtree_find_key():
+    data = KVTree.expand(copy.deepcopy(_trace(1, payload_size=4096, stringified_ratio=0)["spans"][0]))
+    keys = ["output_group_0.field_12.value", "output.score", "input_group_0.field_3", "missing.key"]
+    return lambda: [KVTree.find_key(data, key) for key in keys]
+
+
+@case("kvtree/update_key", number=200)
+def kvtree_update_key():
+    data = KVTree.expand(copy.deepcopy(_trace(1, payload_size=4096, stringified_ratio=0)["spans"][0]))
+    return lambda: [KVTree.update_key(data, key, 1) for key in ("field_15", "score", "missing")]
+
+
+@case("kvtree/update_many_keys", number=200)
+def kvtree_update_many_keys():
+    data = KVTree.expand(copy.deepcopy(_trace(1, payload_size=4096, stringified_ratio=0)["spans"][0]))
+    updates = {f"output_group_{i // 4}.field_{i}.value": i for i in range(0, 32, 3)}
+    updates.update({"duration": 1, "input_group_1.score": 0.5})
+    return lambda: KVTree.update_many_keys(data, updates, copy_on_write=True)
+
+
+@case("kvtree/expand-stringified", number=20)
+def kvtree_expand():
+    spans = _trace(200, payload_size=1024, stringified_ratio=1.0)["spans"]
+    return lambda: [KVTree.expand(dict(span)) for span in spans]
+
+
+@case("tracer/trace_gen-overhead", number=5)
+def tracer_overhead():
+    tracer = Tracer()
+
+    @tracer.trace_gen
+    def leaf(x):
+        return x + 1
+
+    @tracer.trace_gen
+    def parent(n):
+        return sum(leaf(i) for i in range(n))
+
+    def run():
+        tracer.spans.clear()
+        for _ in range(100):
+            parent(10)
+    return run
+
+
+@case("tracer/plain-baseline", number=5)
+def tracer_baseline():
+    def leaf(x):
+        return x + 1
+
+    def parent(n):
+        return sum(leaf(i) for i in range(n))
+
+    def run():
+        for _ in range(100):
+            parent(10)
+    return run
+
+
+# ---------------------------------------------------------------- 执行与结果
+
+def measure(setup, number: int, repeat: int) -> dict:
+    run = setup()
+    run()                                       # 预热
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        samples.append((time.perf_counter() - start) / number)
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_suite(pattern: str = None, scale: float = 1.0) -> dict:
+    results = {}
+    for name, (setup, number, repeat) in CASES.items():
+        if pattern and not re.search(pattern, name):
+            continue
+        results[name] = measure(setup, max(1, round(number * scale)), repeat)
+        print(f"{name:<32} median {results[name]['median'] * 1e3:10.3f} ms  (min {results[name]['min'] * 1e3:.3f} ms)")
+    return {
+        "machine": {"python": platform.python_version(), "implementation": platform.python_implementation(),
+                    "platform": platform.platform(), "processor": platform.processor() or platform.machine()},
+        "commit": _git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    ''' 按 median 对比两次结果，返回耗时比值超过 threshold 的用例 [(name, ratio), ...]
+    '''
+    regressions = []
+    print(f"\ncompare with {baseline.get('commit')} ({baseline.get('timestamp')})")
+    for name, result in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            print(f"{name:<32} (new)")
+            continue
+        ratio = result["median"] / old["median"] if old["median"] else float("inf")
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"{name:<32} {ratio:6.2f}x{flag}")
+        if ratio > threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter", help="只运行名称匹配该正则的用例")
+    parser.add_argument("--scale", type=float, default=1.0, help="按比例调整每轮执行次数")
+    parser.add_argument("--output", help="把结果写入 JSON 文件")
+    parser.add_argument("--compare", help="与之前保存的 JSON 结果对比")
+    parser.add_argument("--threshold", type=float, default=1.2, help="median 耗时比值超过该值视为回退")
+    parser.add_argument("--list", action="store_true", help="列出所有用例")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(CASES))
+        sys.exit(0)
+
+    current = run_suite(args.filter, args.scale)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(current, baseline, args.threshold):
+            sys.exit(1)
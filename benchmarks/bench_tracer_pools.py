@@ -0,0 +1,63 @@
+""" Tracer 跨线程池/进程池传播的开销
+
+    - thread: ThreadPoolExecutor 与 TracedThreadPoolExecutor (每次 submit 复制一次上下文) 执行同样的带追踪任务
+    - process: ProcessPoolExecutor (子进程的 span 全部丢失) 与 TracedProcessPoolExecutor (span 随任务结果发回并合并)
+
+    每个任务产生 1 + fanout 个 span，输出每个任务的平均耗时 (微秒) 以及父进程最终收到的 span 个数。
+
+    用法: python benchmarks/bench_tracer_pools.py [--tasks 2000] [--fanout 4] [--workers 4]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.TraceGen import Tracer, TracedThreadPoolExecutor, TracedProcessPoolExecutor
+
+
+tracer = Tracer()
+
+
+@tracer.trace_gen
+def leaf(x):
+    return x + 1
+
+
+@tracer.trace_gen
+def task(x, fanout):
+    # fanout 作为参数传给子进程: spawn/forkserver 启动的子进程会重新导入本模块，看不到父进程里面修改过的全局变量
+    return sum(leaf(x + i) for i in range(fanout))
+
+
+def measure(executor_factory, tasks: int, fanout: int) -> dict:
+    tracer.spans.clear()
+    with executor_factory() as pool:
+        # 先让进程池把子进程拉起来，启动开销不计入
+        list(pool.map(abs, range(pool._max_workers)))
+        start = time.perf_counter()
+        for future in [pool.submit(task, i, fanout) for i in range(tasks)]:
+            future.result()
+        elapsed = time.perf_counter() - start
+    return {"per_task_us": round(elapsed / tasks * 1e6, 1), "spans_collected": len(tracer.spans)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    scenarios = {
+        "thread/plain":   lambda: ThreadPoolExecutor(args.workers),
+        "thread/traced":  lambda: TracedThreadPoolExecutor(args.workers),
+        "process/plain":  lambda: ProcessPoolExecutor(args.workers),
+        "process/traced": lambda: TracedProcessPoolExecutor(tracer, max_workers=args.workers),
+    }
+    for label, factory in scenarios.items():
+        print(json.dumps({"mode": label, "tasks": args.tasks, "expected_spans": args.tasks * (1 + args.fanout), **measure(factory, args.tasks, args.fanout)}))
@@ -0,0 +1,110 @@
+""" 流式 Excel 报表 (XlsxRowWriter，openpyxl write-only 模式) 的耗时与内存基准测试
+
+    用合成 trace 的 batch_retrieve 结果作为行模板，生成不同行数的结果流，分别用 XlsxRowWriter 逐行写出，
+    记录耗时与 tracemalloc 的内存峰值 (峰值应当与行数无关)；安装了 pandas 时对照先建 DataFrame 再 to_excel 的做法。
+    测量之前先检查以 '=' 开头的取值写成了文本单元格而不是公式 (trace 负载是不可信的输入)。
+
+    用法: python benchmarks/bench_xlsx_report.py [--rows 20000 100000] [--sheet-rows 1048576] [--pandas]
+"""
+import os
+import sys
+import json
+import copy
+import time
+import argparse
+import zipfile
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracespantree.collections import SpanTree, result_columns
+from tracespantree.utils.export import XlsxRowWriter
+from tracespantree.utils.synthetic import generate_trace
+
+
+def make_template(spans: int = 200) -> tuple:
+    trace = generate_trace(spans=spans, seed=11, stringified_ratio=0.0)
+    names = [span["name"] for span in trace["spans"][1:6]]
+    configs = {name: {"target_fields": [("duration", None, None), ("status_code", None, None), ("input", None, None)]}
+               for name in names}
+    row = SpanTree(trace=copy.deepcopy(trace)).batch_retrieve(configs)
+    return configs, row
+
+
+def iter_rows(template: dict, n: int):
+    for i in range(n):
+        row = dict(template)
+        row["trace_id"] = f"trace-{i:08d}"
+        yield row
+
+
+def write_report(n: int, columns: list, template: dict, sheet_rows: int, path: str) -> XlsxRowWriter:
+    with XlsxRowWriter(path, columns=columns, sheet_rows=sheet_rows) as writer:
+        writer.write_rows(iter_rows(template, n))
+    return writer
+
+
+FORMULA_PAYLOADS = ['=HYPERLINK("http://e.com","c")', "=1+1", "=SUM(A1:A2", "+1", "-1", "@SUM(A1)"]
+
+
+def check_text_cells(path: str) -> dict:
+    ''' 公式样式的取值 (包括不合法的公式) 必须原样写成文本单元格，工作表里面不能出现 <f> 元素 '''
+    from openpyxl import load_workbook
+
+    with XlsxRowWriter(path, columns=["=header", "value"]) as writer:
+        writer.write_rows({"=header": value, "value": value} for value in FORMULA_PAYLOADS)
+    with zipfile.ZipFile(path) as archive:
+        sheet = archive.read("xl/worksheets/sheet1.xml").decode("utf-8")
+    assert "<f>" not in sheet, "formula-like values were written as formulas"
+    rows = list(load_workbook(path, read_only=True).active.values)
+    assert rows[0] == ("=header", "value") and [row[0] for row in rows[1:]] == FORMULA_PAYLOADS, rows
+    return {"check": "text_cells", "values": len(FORMULA_PAYLOADS), "ok": True}
+
+
+def measure(n: int, columns: list, template: dict, sheet_rows: int, path: str) -> dict:
+    # tracemalloc 会明显拖慢 openpyxl，耗时与内存峰值分两次测量
+    start = time.perf_counter()
+    writer = write_report(n, columns, template, sheet_rows, path)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    write_report(n, columns, template, sheet_rows, path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"writer": "XlsxRowWriter", "rows": n, "sheets": writer.sheets, "seconds": round(elapsed, 2),
+            "rows_per_second": round(n / elapsed), "peak_mb": round(peak / 2 ** 20, 2),
+            "file_mb": round(os.path.getsize(path) / 2 ** 20, 2)}
+
+
+def measure_pandas(n: int, columns: list, template: dict, path: str) -> dict:
+    import pandas as pd
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    frame = pd.DataFrame([{key: json.dumps(value) if isinstance(value, (dict, list)) else value for key, value in row.items()}
+                          for row in iter_rows(template, n)], columns=columns)
+    frame.to_excel(path, index=False)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"writer": "pandas.to_excel", "rows": n, "seconds": round(elapsed, 2), "peak_mb": round(peak / 2 ** 20, 2)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[20000, 100000])
+    parser.add_argument("--sheet-rows", type=int, default=XlsxRowWriter.MAX_ROWS)
+    parser.add_argument("--pandas", action="store_true", help="对照 DataFrame + to_excel (需要 pandas)")
+    args = parser.parse_args()
+
+    configs, template = make_template()
+    columns = ["trace_id", *result_columns(configs)]
+    with tempfile.TemporaryDirectory() as tmp:
+        # 预热: 先导入 openpyxl，避免把模块导入计入第一次测量的内存峰值
+        write_report(10, columns, template, args.sheet_rows, os.path.join(tmp, "warmup.xlsx"))
+        print(json.dumps(check_text_cells(os.path.join(tmp, "formulas.xlsx"))))
+        for n in args.rows:
+            print(json.dumps(measure(n, columns, template, args.sheet_rows, os.path.join(tmp, f"report-{n}.xlsx"))))
+            if args.pandas:
+                print(json.dumps(measure_pandas(n, columns, template, os.path.join(tmp, f"pandas-{n}.xlsx"))))
@@ -15,6 +15,9 @@ setup(
     author="volmodaoist",
     url="https://github.com/volmodaoist/SpanTree",
     packages=find_packages(include=["tracespantree", "tracespantree.*"]),
+    entry_points={
+        "console_scripts": ["tracespantree=tracespantree.cli:main"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -2,7 +2,14 @@ import uuid
 import pprint
 import functools
 
-from contextvars import ContextVar
+from contextvars import ContextVar, copy_context
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+
+# 跨进程传播: 子进程里面执行任务时，_remote_parent 记录父进程提交任务时的 span_id，
+# _span_sink 收集这个任务产生的所有 span，随任务结果一起发回父进程 (子进程里面任何 Tracer 实例产生的 span 都会被收集)
+_remote_parent = ContextVar("remote_parent_span_id", default=None)
+_span_sink     = ContextVar("span_sink", default=None)
 
 
 class Tracer:
@@ -19,8 +26,8 @@ class Tracer:
         """
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            # 读取当前上下文中的 parent_span_id
-            parent_span_id = self._current_span_id_var.get()
+            # 读取当前上下文中的 parent_span_id，子进程里面的第一层调用使用父进程提交任务时的 span_id
+            parent_span_id = self._current_span_id_var.get() or _remote_parent.get()
 
             # 生成新的 span_id
             span_id = str(uuid.uuid4())
@@ -40,8 +47,9 @@ class Tracer:
             except Exception as e:
                 output_data = f"Exception: {e}"
             finally:
-                # 记录本次函数调用信息
-                self.spans.append({
+                # 记录本次函数调用信息，子进程里面写入随任务结果发回的 sink
+                sink = _span_sink.get()
+                (self.spans if sink is None else sink).append({
                     "parent_id": parent_span_id,
                     "span_id": span_id,
                     "name": func.__name__,
@@ -55,6 +63,91 @@ class Tracer:
 
         return wrapper
 
+    def current_span_id(self):
+        """ 当前上下文中正在执行的 span_id，没有的时候返回 None
+        """
+        return self._current_span_id_var.get() or _remote_parent.get()
+
+    def wrap(self, func):
+        """ 捕获当前上下文 (包括当前 span)，返回的函数无论在哪个线程里面执行，产生的 span 都挂在当前 span 下面，
+            适合手动创建线程、或者把回调交给其它框架执行的场景，每次调用都在上下文的副本里面运行，可以并发调用
+        """
+        context = copy_context()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return context.copy().run(func, *args, **kwargs)
+        return wrapper
+
+    def merge(self, spans: list):
+        """ 合并其它进程发回来的 span
+        """
+        self.spans.extend(spans)
+
+
+class TracedThreadPoolExecutor(ThreadPoolExecutor):
+    """ 提交任务时复制调用方的上下文 (contextvars.copy_context)，任务在这个副本里面执行，
+        因此线程池里面产生的 span 与调用方的 span 保持父子关系，submit 与 map 都适用
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(copy_context().run, fn, *args, **kwargs)
+
+
+def _run_traced(parent_span_id, fn, args, kwargs):
+    """ 在子进程里面执行任务: 恢复父 span，收集任务产生的 span，返回 (是否成功, 结果或异常, spans)
+    """
+    sink = []
+    parent_token, sink_token = _remote_parent.set(parent_span_id), _span_sink.set(sink)
+    try:
+        return True, fn(*args, **kwargs), sink
+    except Exception as e:
+        return False, e, sink
+    finally:
+        _span_sink.reset(sink_token)
+        _remote_parent.reset(parent_token)
+
+
+class TracedProcessPoolExecutor(ProcessPoolExecutor):
+    """ 子进程里面产生的 span 随任务结果一起通过进程池自带的结果管道发回父进程，不需要额外的队列或者临时文件，
+        并且在调用方拿到 future 的结果之前就已经合并进 tracer.spans；子进程里面第一层 span 的父节点是提交任务时的当前 span
+
+    :param tracer: 接收子进程 span 的 Tracer，其余参数与 ProcessPoolExecutor 相同 (任务函数、参数与 span 内容需要可以 pickle)
+    """
+
+    def __init__(self, tracer: Tracer, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tracer = tracer
+
+    def submit(self, fn, /, *args, **kwargs):
+        inner = super().submit(_run_traced, self.tracer.current_span_id(), fn, args, kwargs)
+        outer = Future()
+
+        def relay(done: Future):
+            if outer.done():
+                return
+            if done.cancelled():
+                outer.cancel()
+                return
+            error = done.exception()
+            if error is not None:
+                outer.set_exception(error)
+                return
+            ok, value, spans = done.result()
+            self.tracer.merge(spans)
+            if ok:
+                outer.set_result(value)
+            else:
+                outer.set_exception(value)
+
+        def cancel_inner(done: Future):
+            if done.cancelled():
+                inner.cancel()
+
+        outer.add_done_callback(cancel_inner)
+        inner.add_done_callback(relay)
+        return outer
+
 
 
 
@@ -0,0 +1,7 @@
+import sys
+
+from tracespantree.cli import main
+
+
+# python -m tracespantree 等价于 tracespantree 命令
+sys.exit(main())
@@ -0,0 +1,424 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+from collections import deque, namedtuple
+
+from tracespantree.utils.io import iter_trace_files, iter_trace_records
+from tracespantree.utils.export import WRITERS, infer_format, open_writer
+from tracespantree.utils.instrument import PhaseStats, perf_counter_ns
+from tracespantree.collections.adapters import SCHEMAS, get_schema
+from tracespantree.collections.spanquery import compile_query
+from tracespantree.collections.projection import SpanProjection
+from tracespantree.collections.spantree import SpanTree, result_columns
+
+
+""" 命令行入口 (安装之后为 tracespantree 命令，或者 python -m tracespantree):
+
+        tracespantree configs.json traces/ -o rows.csv --workers 8 --profile
+        tracespantree configs.py spans.jsonl -o rows.jsonl --follow --state rows.offsets
+
+    - 抓取配置与 SpanTree.batch_retrieve 的格式相同，可以是 JSON 文件或者定义了 CONFIGS 的 Python 文件 (回调可以是任意函数)
+    - 每个 trace 输出一行: file、offset、trace_id 三列定位 trace，其余各列为 batch_retrieve 的结果 (列由抓取配置决定，见 result_columns)
+    - 输出格式为 CSV、JSONL、Parquet 或者 Excel (.xlsx，写满一个工作表之后自动换到下一个工作表)
+    - .jsonl 文件按行对齐切成若干字节区间，.json 文件整个作为一个任务，交给进程池并行解析、建树与抓取，输出保持输入顺序
+    - --follow 持续跟踪增长中的 .jsonl 文件，只处理完整的行，每写出一批结果就把各个文件处理到的字节偏移写入状态文件，
+      重启之后从状态文件记录的位置继续 (至少一次: 写出结果之后、保存状态之前中断，重启后这一批会重复输出)
+"""
+
+
+_STATE_VERSION = 1
+
+# 每一行最前面定位 trace 的三列，与 _extract_trace 里面的 row 保持一致
+LOCATION_COLUMNS = ["file", "offset", "trace_id"]
+
+# 传给子进程的参数，子进程按这个 key 缓存加载好的抓取配置
+ExtractOptions = namedtuple("ExtractOptions", ["config", "schema", "sep", "projection", "profile"])
+
+
+# ------------------------------------------------------------ 抓取配置
+
+def _resolve_callback(callback):
+    ''' JSON 配置里面的回调写成 "模块:属性" (e.g. "json:dumps"、"mypkg.parsers:parse_score")，或者内置函数的名称 (e.g. "len")
+    '''
+    if callback is None or callable(callback):
+        return callback
+    if not isinstance(callback, str):
+        raise TypeError(f"Expected callback to be a 'module:attribute' string, but got {type(callback).__name__}.")
+
+    import importlib
+    module_name, _, attr_path = callback.rpartition(":")
+    target = importlib.import_module(module_name or "builtins")
+    for attr in attr_path.split("."):
+        try:
+            target = getattr(target, attr)
+        except AttributeError:
+            raise ValueError(f"Cannot resolve callback '{callback}'.") from None
+    if not callable(target):
+        raise ValueError(f"Callback '{callback}' is not callable.")
+    return target
+
+
+def _field_entry(entry) -> tuple:
+    ''' 字段写成字符串，或者 [字段, 默认值, 回调] (后两项可以省略) '''
+    if isinstance(entry, str):
+        return entry, None, None
+    if isinstance(entry, (list, tuple)) and 1 <= len(entry) <= 3:
+        field, default, callback = (*entry, None, None)[:3]
+        return field, default, _resolve_callback(callback)
+    raise ValueError(f"Expected a target field to be a string or [field, default, callback], but got {entry!r}.")
+
+
+def parse_config(raw: dict) -> dict:
+    ''' 把 JSON 格式的抓取配置转换成 batch_retrieve 的配置: "query:" 开头的 key 编译成 SpanQuery，字段补全为三元组并解析回调
+    '''
+    if not isinstance(raw, dict):
+        raise ValueError(f"Expected the config to be a JSON object, but got {type(raw).__name__}.")
+    configs = {}
+    for target_span_name, cfg in raw.items():
+        if not isinstance(cfg, dict):
+            raise ValueError(f"Configuration for '{target_span_name}' must be an object.")
+        if target_span_name.startswith("query:"):
+            target_span_name = compile_query(target_span_name[len("query:"):])
+        cfg = dict(cfg)
+        target_fields = cfg.get("target_fields")
+        if isinstance(target_fields, dict):
+            cfg["target_fields"] = {key: _field_entry(entry) for key, entry in target_fields.items()}
+        elif isinstance(target_fields, list):
+            cfg["target_fields"] = [_field_entry(entry) for entry in target_fields]
+        configs[target_span_name] = cfg
+    return configs
+
+
+def load_config(path: str) -> dict:
+    ''' 读取抓取配置: .py 文件执行之后取其中的 CONFIGS 变量，其余按 JSON 解析 (见 parse_config)
+    '''
+    if path.endswith(".py"):
+        import runpy
+        configs = runpy.run_path(path).get("CONFIGS")
+        if not isinstance(configs, dict):
+            raise ValueError(f"Config module '{path}' must define a dict named CONFIGS.")
+        return configs
+    with open(path, "r", encoding="utf-8") as f:
+        return parse_config(json.load(f))
+
+
+# ------------------------------------------------------------ 子进程里面的抓取
+
+_CONTEXTS = {}      # ExtractOptions -> (抓取配置, SpanProjection)
+
+
+def _context(options: ExtractOptions) -> tuple:
+    context = _CONTEXTS.get(options)
+    if context is None:
+        configs = load_config(options.config)
+        projection = SpanProjection(configs, sep=options.sep) if options.projection else None
+        context = _CONTEXTS[options] = (configs, projection)
+    return context
+
+
+def _trace_id(trace, tree: SpanTree):
+    if isinstance(trace, dict):
+        for key in ("trace_id", "traceId", "traceID"):
+            if trace.get(key) is not None:
+                return trace[key]
+    for span in tree.span_map.values():
+        return tree.schema.trace_id(span)
+    return None
+
+
+def _extract_trace(trace, path: str, offset: int, options: ExtractOptions, stats: PhaseStats):
+    configs, projection = _context(options)
+    try:
+        start = perf_counter_ns()
+        tree = SpanTree(trace=trace, schema=options.schema, sep=options.sep, projection=projection,
+                        instrument=True if options.profile else None)
+        built = perf_counter_ns()
+        row = {"file": path, "offset": offset, "trace_id": _trace_id(trace, tree)}
+        row.update(tree.batch_retrieve(configs))
+        stats.observe("build", built - start)
+        stats.observe("extract", perf_counter_ns() - built)
+    except Exception as e:
+        stats.incr("failed_traces")
+        print(f"tracespantree: failed to process trace at {path}:{offset}: {e}", file=sys.stderr)
+        return None
+    if tree._stats is not None:
+        stats.merge(tree._stats)
+    stats.incr("traces")
+    return row
+
+
+def _extract_range(path: str, start: int, end: int, options: ExtractOptions) -> tuple:
+    ''' 处理一个任务: .jsonl 文件的字节区间 [start, end)，或者整个 .json 文件 (end 为 -1)，返回 (path, end, rows, stats)
+    '''
+    stats, rows = PhaseStats(), []
+    if end < 0:
+        began = perf_counter_ns()
+        try:
+            records = list(iter_trace_records(path, get_schema(options.schema).split_document))
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            # 与 .jsonl 里面无法解析的行一样跳过，不中断整个任务
+            stats.incr("bad_files")
+            print(f"tracespantree: skipped malformed file {path}: {e}", file=sys.stderr)
+            return path, end, rows, stats
+        stats.observe("read", perf_counter_ns() - began)
+        for offset, _, trace in records:
+            row = _extract_trace(trace, path, offset, options, stats)
+            if row is not None:
+                rows.append(row)
+        return path, end, rows, stats
+
+    began = perf_counter_ns()
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    stats.observe("read", perf_counter_ns() - began)
+    stats.incr("bytes", len(data))
+
+    offset = start
+    for line in data.split(b"\n"):
+        line_offset, offset = offset, offset + len(line) + 1
+        if not line.strip():
+            continue
+        began = perf_counter_ns()
+        try:
+            trace = json.loads(line)
+        except ValueError:
+            stats.incr("bad_lines")
+            continue
+        stats.observe("parse", perf_counter_ns() - began)
+        row = _extract_trace(trace, path, line_offset, options, stats)
+        if row is not None:
+            rows.append(row)
+    return path, end, rows, stats
+
+
+# ------------------------------------------------------------ 任务切分与调度
+
+def _complete_end(path: str, start: int, end: int, block: int = 1 << 16) -> int:
+    ''' [start, end) 里面最后一个完整行的结束位置，没有完整的行时返回 start (正在写入的半行留到下一轮)
+    '''
+    with open(path, "rb") as f:
+        pos = end
+        while pos > start:
+            begin = max(start, pos - block)
+            f.seek(begin)
+            i = f.read(pos - begin).rfind(b"\n")
+            if i >= 0:
+                return begin + i + 1
+            pos = begin
+    return start
+
+
+def _split_range(path: str, start: int, end: int, chunk_size: int) -> list:
+    ''' 把 [start, end) 按行对齐切成大约 chunk_size 字节的区间 '''
+    ranges = []
+    with open(path, "rb") as f:
+        while start < end:
+            stop = start + chunk_size
+            if stop < end:
+                f.seek(stop - 1)
+                f.readline()
+                stop = f.tell()
+            stop = min(stop, end)
+            ranges.append((path, start, stop))
+            start = stop
+    return ranges
+
+
+def _iter_tasks(paths: list, chunk_size: int):
+    for root in paths:
+        for path in iter_trace_files(root):
+            if path.endswith(".jsonl"):
+                yield from _split_range(path, 0, os.path.getsize(path), chunk_size)
+            else:
+                yield path, 0, -1
+
+
+def _run_tasks(tasks, options: ExtractOptions, pool, window: int):
+    ''' 按任务顺序产出结果，进程池里面同时最多有 window 个任务 (不会一次性把所有任务读进内存)
+    '''
+    if pool is None:
+        for path, start, end in tasks:
+            yield _extract_range(path, start, end, options)
+        return
+    pending = deque()
+    for path, start, end in tasks:
+        pending.append(pool.submit(_extract_range, path, start, end, options))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# ------------------------------------------------------------ --follow
+
+def _load_state(path: str) -> dict:
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("version") != _STATE_VERSION:
+        raise ValueError(f"Unsupported state file version in '{path}'.")
+    return state["files"]
+
+
+def _save_state(path: str, files: dict) -> None:
+    # 先写临时文件再替换，保存过程中断不会损坏原有的状态
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": _STATE_VERSION, "files": files}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _pending_tasks(paths: list, files: dict, chunk_size: int, stats: PhaseStats) -> list:
+    ''' 扫描一轮被跟踪的文件 (目录每轮重新列出，新出现的文件从头开始)，返回新增的完整行对应的任务
+        文件被截断或者被替换 (inode 变化，e.g. 日志轮转) 时从头开始
+    '''
+    tasks = []
+    for root in paths:
+        for path in iter_trace_files(root, (".jsonl",)):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            key = os.path.abspath(path)
+            entry = files.get(key)
+            offset = 0
+            if entry is not None:
+                offset = entry["offset"]
+                if entry["inode"] != st.st_ino or st.st_size < offset:
+                    offset = 0
+                    stats.incr("rotated_files")
+            files[key] = {"offset": offset, "inode": st.st_ino}
+            if st.st_size > offset:
+                end = _complete_end(path, offset, st.st_size)
+                if end > offset:
+                    tasks.extend(_split_range(path, offset, end, chunk_size))
+    return tasks
+
+
+def _write(writer, rows: list, stats: PhaseStats) -> None:
+    began = perf_counter_ns()
+    writer.write_rows(rows)
+    if writer.supports_append:
+        # 文本格式每个任务之后落盘 (--follow 模式依赖这一点)；Parquet 攒满 batch_size 行再写 row group，
+        # 不让第一个任务的几行数据决定整个文件的列类型
+        writer.flush()
+    stats.observe("write", perf_counter_ns() - began)
+    stats.incr("rows", len(rows))
+
+
+def _follow(args, options: ExtractOptions, pool, window: int, writer, stats: PhaseStats, files: dict) -> None:
+    idle = 0.0
+    while True:
+        tasks = _pending_tasks(args.paths, files, args.chunk_size, stats)
+        for path, end, rows, task_stats in _run_tasks(tasks, options, pool, window):
+            stats.merge(task_stats)
+            _write(writer, rows, stats)
+            files[os.path.abspath(path)]["offset"] = end
+            _save_state(args.state, files)
+        if tasks:
+            idle = 0.0
+            continue
+        _save_state(args.state, files)
+        if args.idle_exit is not None and idle >= args.idle_exit:
+            return
+        time.sleep(args.interval)
+        idle += args.interval
+
+
+# ------------------------------------------------------------ 入口
+
+def _print_profile(stats: PhaseStats, elapsed: float, stream=None) -> None:
+    ''' 每个阶段的调用次数与耗时 (按总耗时排序)，以及计数器与吞吐，默认输出到标准错误 '''
+    stream = stream or sys.stderr
+    phases = sorted(stats.to_dict()["phases"].items(), key=lambda item: -item[1]["total_ns"])
+    print(f"{'phase':<24}{'count':>10}{'total ms':>12}{'mean us':>12}{'max ms':>10}", file=stream)
+    for phase, timing in phases:
+        print(f"{phase:<24}{timing['count']:>10}{timing['total_ns'] / 1e6:>12.1f}"
+              f"{timing['mean_ns'] / 1e3:>12.1f}{timing['max_ns'] / 1e6:>10.1f}", file=stream)
+    for event, n in sorted(stats.counters.items()):
+        print(f"{event:<24}{n:>10}", file=stream)
+    traces = stats.counters["traces"]
+    print(f"{'wall seconds':<24}{elapsed:>10.2f}  ({traces / elapsed if elapsed else 0.0:.0f} traces/s)", file=stream)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="tracespantree",
+        description="Extract fields from trace files with a batch_retrieve config and write one row per trace.")
+    parser.add_argument("config", help="batch_retrieve config: a JSON file, or a Python file defining CONFIGS")
+    parser.add_argument("paths", nargs="+", help="trace files (.json/.jsonl) or directories")
+    parser.add_argument("-o", "--output", default="-", help="output file, '-' for stdout (default)")
+    parser.add_argument("-f", "--format", choices=sorted(WRITERS), help="output format, inferred from the output suffix by default")
+    parser.add_argument("--schema", choices=sorted(SCHEMAS), default=None, help="span layout of the traces")
+    parser.add_argument("--sep", default=".", help="separator of span paths and field paths")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: cpu count, 1 runs inline)")
+    parser.add_argument("--chunk-size", type=int, default=4 << 20, help="bytes of .jsonl input per task")
+    parser.add_argument("--no-projection", dest="projection", action="store_false",
+                        help="expand every span instead of only the fields used by the config")
+    parser.add_argument("--follow", action="store_true", help="keep tailing .jsonl files and emit rows as lines are appended")
+    parser.add_argument("--state", default=None, help="offsets file used by --follow to resume (default: OUTPUT.offsets)")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between polls in --follow mode")
+    parser.add_argument("--idle-exit", type=float, default=None, help="stop --follow after this many idle seconds")
+    parser.add_argument("--profile", action="store_true", help="print per-phase timings to stderr")
+    return parser
+
+
+def main(argv: list = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    fmt = args.format or infer_format(args.output)
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be positive")
+    if args.follow:
+        if not WRITERS[fmt].supports_append:
+            parser.error(f"--follow appends to the output, use csv or jsonl instead of {fmt}")
+        if args.state is None:
+            if args.output == "-":
+                parser.error("--follow with stdout output requires --state")
+            args.state = f"{args.output}.offsets"
+
+    try:
+        configs = load_config(args.config)
+    except (OSError, ValueError, TypeError, ImportError) as e:
+        parser.error(f"cannot load config '{args.config}': {e}")
+    columns = LOCATION_COLUMNS + result_columns(configs, args.sep)
+
+    options = ExtractOptions(os.path.abspath(args.config), args.schema, args.sep, args.projection, args.profile)
+    workers = args.workers if args.workers is not None else (os.cpu_count() or 1)
+    stats, started = PhaseStats(), time.perf_counter()
+
+    pool = None
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        if args.follow:
+            files = _load_state(args.state)
+            # 有状态文件说明是在继续之前的输出，追加写入；否则重新开始
+            with open_writer(args.output, fmt, append=bool(files), columns=columns) as writer:
+                try:
+                    _follow(args, options, pool, 2 * workers, writer, stats, files)
+                except KeyboardInterrupt:
+                    pass
+        else:
+            with open_writer(args.output, fmt, columns=columns) as writer:
+                for _, _, rows, task_stats in _run_tasks(_iter_tasks(args.paths, args.chunk_size), options, pool, 2 * workers):
+                    stats.merge(task_stats)
+                    _write(writer, rows, stats)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if args.profile:
+        _print_profile(stats, time.perf_counter() - started)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,2 +1,12 @@
 from tracespantree.collections.kvtree import MultiNestDict, KVTree
-from tracespantree.collections.spantree import SpanTree
\ No newline at end of file
+from tracespantree.collections.kvview import KVView
+from tracespantree.collections.adapters import SpanSchema, get_schema
+from tracespantree.collections.spanquery import SpanQuery, SpanQuerySyntaxError, compile_query
+from tracespantree.collections.projection import SpanProjection
+from tracespantree.collections.memo import ExtractionMemo
+from tracespantree.collections.analytics import TraceAnalytics, LatencySketch, LatencyAggregator
+from tracespantree.collections.spandiff import SpanTreeDiff
+from tracespantree.collections.spantree import SpanTree, result_columns
+from tracespantree.collections.assembler import TraceAssembler
+
+# corpus (TraceCorpus) 依赖 sqlite3，不在这里导入: from tracespantree.collections.corpus import TraceCorpus
@@ -0,0 +1,367 @@
+from operator import methodcaller
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
+
+
+""" span 字段布局 (schema) 与多种 trace 格式的适配器:
+    - SpanTree 通过 SpanSchema 上的访问函数读取 span_id / parent_id / name / 时间戳 / 状态码，
+      不需要像 setup_keys 那样为每个 span 重建一个新的字典，原始 span 对象直接挂到树上
+    - iter_spans 负责从整份导出文件里面按引用取出所有 span (e.g. OTLP 的 resourceSpans[].scopeSpans[].spans[])
+    - split_document 负责把一份 .json 文档拆成若干个 trace (e.g. Zipkin 的 span 列表本身就是一个 trace)
+    - attributes/tags 这类 key-value 列表沿用 tags 的懒展开策略: 只有搜索到某个 span 的时候才转换成字典
+
+    内置的格式: default (本项目的 name/span_id/parent_id/tags)、otlp (OpenTelemetry OTLP/JSON)、
+    jaeger (Jaeger 查询接口/界面导出的 JSON)、zipkin (Zipkin v2 JSON)。
+    时间戳保持各个格式原本的单位: otlp 为纳秒，jaeger 与 zipkin 为微秒。
+"""
+
+
+def _none(span) -> None:
+    return None
+
+
+def _getter(field: Union[str, Callable, None]) -> Callable:
+    if field is None:
+        return _none
+    if callable(field):
+        return field
+    return methodcaller("get", field)
+
+
+def _split_list(document: Any) -> list:
+    return document if isinstance(document, list) else [document]
+
+
+def _first(document: dict, *keys) -> Any:
+    for key in keys:
+        value = document.get(key)
+        if value is not None:
+            return value
+    return None
+
+
+def _to_int(value) -> Optional[int]:
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _attribute(span: dict, attributes_key: str, key: str, item_key: str = "key", item_value: str = "value") -> Any:
+    ''' 读取单个属性，不展开整个属性列表 (属性可能已经被懒展开成字典)
+    '''
+    attributes = span.get(attributes_key)
+    if isinstance(attributes, dict):
+        return attributes.get(key)
+    if isinstance(attributes, list):
+        for item in attributes:
+            if isinstance(item, dict) and item.get(item_key) == key:
+                return item.get(item_value)
+    return None
+
+
+class SpanSchema:
+    ''' 描述一种 span 格式: 每个字段可以是 span 里面的 key (直接读取)，也可以是 span -> value 的访问函数
+
+    :param format:             格式名称
+    :param span_id:            span id
+    :param parent_id:          父节点 id，树根返回 None 或者不存在的 id
+    :param name:               span name
+    :param span_type:          span type (按类型搜索时使用)
+    :param trace_id:           span 所属的 trace id，从混合了多个 trace 的 span 流里面按 trace 分组时使用
+    :param start/end/duration: 开始时间、结束时间与时长，没有 duration 的时候由 end - start 计算
+    :param status:             状态码，约定 0 (或 None) 表示正常，其它值表示出错
+    :param attributes_key:     key-value 列表形式的属性字段，搜索到 span 时懒展开成字典
+    :param attributes_to_dict: 属性列表 -> 字典的转换函数，None 表示属性本来就是字典
+    :param iter_spans:         从整份导出数据里面按引用取出所有 span 的函数，None 表示使用 trace["spans"] (原有行为)
+    :param split_document:     把一份 .json 文档拆成 trace 列表的函数，None 表示顶层是列表时每个元素是一个 trace
+    :param topology_keys:      span 里面描述拓扑结构的顶层字段 (id 与名称)，输出负载时跳过
+    :param id_fields:          每个 trace 都不相同的 id 字段，计算子树哈希、比较两棵树时默认忽略
+    :param skeleton_fields:    投影 (SpanProjection) 时每个 span 都要保留的骨架字段，字符串表示顶层字段，元组表示嵌套路径 (e.g. 属性里面的 span type)，
+                               上面以字符串形式给出的字段 (span_id、name、start 等) 会自动加入
+    '''
+
+    def __init__(self, format: str, span_id = "span_id", parent_id = "parent_id", name = "name", span_type = None,
+                 trace_id = None, start = None, end = None, duration = None, status = None, attributes_key: str = None,
+                 attributes_to_dict: Callable = None, iter_spans: Callable = None, split_document: Callable = None,
+                 topology_keys: Iterable[str] = (), id_fields: Iterable[str] = (), skeleton_fields: Iterable = ()):
+        self.format             = format
+        self.span_id            = _getter(span_id)
+        self.parent_id          = _getter(parent_id)
+        self.name               = _getter(name)
+        self.span_type          = _getter(span_type)
+        self.trace_id           = _getter(trace_id)
+        self.start              = _getter(start)
+        self.end                = _getter(end)
+        self.status             = _getter(status)
+        self.attributes_key     = attributes_key
+        self.attributes_to_dict = attributes_to_dict
+        self.iter_spans         = iter_spans
+        self.split_document     = split_document or _split_list
+        self.topology_keys      = tuple(topology_keys)
+        self.id_fields          = tuple(id_fields)
+        self.skeleton_fields    = self._skeleton((*topology_keys, span_id, parent_id, name, span_type, trace_id,
+                                                  start, end, duration, status, *skeleton_fields))
+
+        if duration is not None:
+            self.duration = _getter(duration)
+        elif start is not None and end is not None:
+            self.duration = self._duration_from_interval
+        else:
+            self.duration = _none
+
+    @staticmethod
+    def _skeleton(fields: Iterable) -> tuple:
+        # 访问函数读取的字段无法自动推断，需要通过 skeleton_fields 显式给出
+        skeleton = []
+        for field in fields:
+            if isinstance(field, str):
+                field = (field,)
+            if isinstance(field, tuple) and field not in skeleton:
+                skeleton.append(field)
+        return tuple(skeleton)
+
+    def _duration_from_interval(self, span) -> Optional[float]:
+        start, end = self.start(span), self.end(span)
+        if start is None or end is None:
+            return None
+        return end - start
+
+    def flatten_attributes(self, span: dict) -> dict:
+        ''' 把 span 的属性列表原地转换成字典 (只转换一次)，返回 span 本身
+        '''
+        key = self.attributes_key
+        if key is not None and self.attributes_to_dict is not None:
+            # 没有属性字段的 span 会得到一个空字典，之后不再重复检查
+            attributes = span.get(key, [])
+            if isinstance(attributes, list):
+                span[key] = self.attributes_to_dict(attributes)
+        return span
+
+    def __repr__(self):
+        return f"SpanSchema({self.format!r})"
+
+
+# ---------------------------------------------------------------- default
+
+def _tags_to_dict(tags: list) -> dict:
+    # 每个 tag 的 value 字段是一个只含一个元素的字典，使用迭代器获取包裹在内部的关键值
+    return {tag.get("key"): next(iter(tag.get("value").values())) for tag in tags}
+
+
+def _default_span_type(span: dict) -> Any:
+    ''' 优先读取 span 的 type 字段，没有的话再看 tags 里面的 span_type (不展开 tags)
+    '''
+    span_type = span.get("type")
+    if span_type is not None:
+        return span_type
+
+    tags = span.get("tags")
+    if isinstance(tags, dict):
+        return tags.get("span_type")
+    if isinstance(tags, list):
+        for tag in tags:
+            if isinstance(tag, dict) and tag.get("key") == "span_type" and isinstance(tag.get("value"), dict):
+                return next(iter(tag["value"].values()), None)
+    return None
+
+
+DEFAULT_SCHEMA = SpanSchema(
+    "default",
+    span_type          = _default_span_type,
+    trace_id           = "trace_id",
+    start              = "start_time",
+    end                = "end_time",
+    duration           = "duration",
+    status             = "status_code",
+    attributes_key     = "tags",
+    attributes_to_dict = _tags_to_dict,
+    topology_keys      = ("name", "span_id", "parent_id"),
+    id_fields          = ("span_id", "parent_id"),
+    skeleton_fields    = ("type", ("tags", "span_type")),
+)
+
+
+# ---------------------------------------------------------------- OpenTelemetry (OTLP/JSON)
+
+def _otlp_value(value: Any) -> Any:
+    ''' OTLP 的 AnyValue: {"stringValue": "..."} / {"intValue": "1"} / {"arrayValue": {"values": [...]}} / ...
+    '''
+    if not isinstance(value, dict):
+        return value
+    for key, inner in value.items():
+        if key in ("intValue", "int_value"):
+            return _to_int(inner)
+        if key in ("arrayValue", "array_value"):
+            return [_otlp_value(item) for item in (inner or {}).get("values", [])]
+        if key in ("kvlistValue", "kvlist_value"):
+            return _otlp_attributes((inner or {}).get("values", []))
+        return inner
+    return None
+
+
+def _otlp_attributes(attributes: list) -> dict:
+    return {item.get("key"): _otlp_value(item.get("value")) for item in attributes if isinstance(item, dict)}
+
+
+def _otlp_iter_spans(document: Any) -> Iterator[dict]:
+    ''' 支持 {"resourceSpans": [...]}、多份导出组成的列表，以及 snake_case 字段名与旧版的 instrumentationLibrarySpans
+    '''
+    documents = document if isinstance(document, list) else [document]
+    for doc in documents:
+        for resource_spans in _first(doc, "resourceSpans", "resource_spans") or ():
+            for scope_spans in _first(resource_spans, "scopeSpans", "scope_spans", "instrumentationLibrarySpans") or ():
+                yield from scope_spans.get("spans") or ()
+
+
+def _otlp_parent_id(span: dict) -> Any:
+    return _first(span, "parentSpanId", "parent_span_id") or None
+
+
+def _otlp_status(span: dict) -> int:
+    code = (span.get("status") or {}).get("code")
+    return 1 if code in (2, "STATUS_CODE_ERROR") else 0
+
+
+OTLP_SCHEMA = SpanSchema(
+    "otlp",
+    span_id            = lambda span: _first(span, "spanId", "span_id"),
+    parent_id          = _otlp_parent_id,
+    name               = "name",
+    span_type          = "kind",
+    trace_id           = lambda span: _first(span, "traceId", "trace_id"),
+    start              = lambda span: _to_int(_first(span, "startTimeUnixNano", "start_time_unix_nano")),
+    end                = lambda span: _to_int(_first(span, "endTimeUnixNano", "end_time_unix_nano")),
+    status             = _otlp_status,
+    attributes_key     = "attributes",
+    attributes_to_dict = _otlp_attributes,
+    iter_spans         = _otlp_iter_spans,
+    topology_keys      = ("name", "spanId", "parentSpanId", "traceId", "span_id", "parent_span_id", "trace_id"),
+    id_fields          = ("spanId", "parentSpanId", "traceId", "span_id", "parent_span_id", "trace_id"),
+    skeleton_fields    = ("startTimeUnixNano", "endTimeUnixNano", "start_time_unix_nano", "end_time_unix_nano", "status"),
+)
+
+
+# ---------------------------------------------------------------- Jaeger
+
+def _jaeger_iter_spans(document: Any) -> Iterator[dict]:
+    ''' 支持 {"data": [trace, ...]}、单个 trace {"spans": [...]} 以及 trace 列表
+    '''
+    if isinstance(document, dict) and "data" in document:
+        traces = document["data"] or ()
+    elif isinstance(document, list):
+        traces = document
+    else:
+        traces = [document]
+    for trace in traces:
+        yield from trace.get("spans") or ()
+
+
+def _jaeger_split_document(document: Any) -> list:
+    ''' {"data": [trace, ...]} 按 data 里面的 trace 拆分 '''
+    if isinstance(document, dict) and isinstance(document.get("data"), list):
+        return document["data"]
+    return _split_list(document)
+
+
+def _jaeger_parent_id(span: dict) -> Any:
+    references = span.get("references") or ()
+    for reference in references:
+        if reference.get("refType") == "CHILD_OF":
+            return reference.get("spanID")
+    if references:
+        return references[0].get("spanID")
+    return span.get("parentSpanID")
+
+
+def _jaeger_end(span: dict) -> Optional[int]:
+    start, duration = _to_int(span.get("startTime")), _to_int(span.get("duration"))
+    return start + duration if start is not None and duration is not None else None
+
+
+def _jaeger_status(span: dict) -> int:
+    error = _attribute(span, "tags", "error")
+    if error in (True, "true"):
+        return 1
+    return 1 if _attribute(span, "tags", "otel.status_code") == "ERROR" else 0
+
+
+JAEGER_SCHEMA = SpanSchema(
+    "jaeger",
+    span_id            = "spanID",
+    parent_id          = _jaeger_parent_id,
+    name               = "operationName",
+    span_type          = lambda span: _attribute(span, "tags", "span.kind"),
+    trace_id           = "traceID",
+    start              = "startTime",
+    end                = _jaeger_end,
+    duration           = "duration",
+    status             = _jaeger_status,
+    attributes_key     = "tags",
+    attributes_to_dict = lambda tags: {tag.get("key"): tag.get("value") for tag in tags if isinstance(tag, dict)},
+    iter_spans         = _jaeger_iter_spans,
+    split_document     = _jaeger_split_document,
+    topology_keys      = ("operationName", "spanID", "traceID", "references"),
+    id_fields          = ("spanID", "traceID", "references"),
+    skeleton_fields    = ("parentSpanID", ("tags", "span.kind"), ("tags", "error"), ("tags", "otel.status_code")),
+)
+
+
+# ---------------------------------------------------------------- Zipkin v2
+
+def _zipkin_iter_spans(document: Any) -> Iterator[dict]:
+    ''' 支持 span 列表，以及多个 trace (span 列表) 组成的列表
+    '''
+    for item in document if isinstance(document, list) else [document]:
+        if isinstance(item, list):
+            yield from item
+        else:
+            yield item
+
+
+def _zipkin_split_document(document: Any) -> list:
+    ''' Zipkin v2 的一个 trace 就是一个 span 列表: 元素都是列表时按元素拆分，否则整份文档是一个 trace '''
+    if isinstance(document, list) and document and all(isinstance(item, list) for item in document):
+        return document
+    return [document]
+
+
+def _zipkin_end(span: dict) -> Optional[int]:
+    start, duration = _to_int(span.get("timestamp")), _to_int(span.get("duration"))
+    return start + duration if start is not None and duration is not None else None
+
+
+ZIPKIN_SCHEMA = SpanSchema(
+    "zipkin",
+    span_id            = "id",
+    parent_id          = "parentId",
+    name               = "name",
+    span_type          = "kind",
+    trace_id           = "traceId",
+    start              = "timestamp",
+    end                = _zipkin_end,
+    duration           = "duration",
+    status             = lambda span: 1 if "error" in (span.get("tags") or {}) else 0,
+    attributes_key     = "tags",
+    iter_spans         = _zipkin_iter_spans,
+    split_document     = _zipkin_split_document,
+    topology_keys      = ("name", "id", "parentId", "traceId"),
+    id_fields          = ("id", "parentId", "traceId"),
+    skeleton_fields    = (("tags", "error"),),
+)
+
+
+SCHEMAS = {schema.format: schema for schema in (DEFAULT_SCHEMA, OTLP_SCHEMA, JAEGER_SCHEMA, ZIPKIN_SCHEMA)}
+
+
+def get_schema(schema: Union[str, SpanSchema, None]) -> SpanSchema:
+    ''' 按名称获取内置的 SpanSchema，None 表示默认格式
+    '''
+    if schema is None:
+        return DEFAULT_SCHEMA
+    if isinstance(schema, SpanSchema):
+        return schema
+    if schema not in SCHEMAS:
+        raise ValueError(f"Unknown span schema '{schema}', expected one of {sorted(SCHEMAS)} or a SpanSchema instance.")
+    return SCHEMAS[schema]
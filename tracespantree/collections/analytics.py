@@ -0,0 +1,295 @@
+import math
+
+from typing import Any, Callable, Iterable, Optional, Union
+from collections import Counter
+
+
+def as_number(value: Any) -> Optional[float]:
+    ''' 把 span 里面的时长、时间戳之类的字段转换为数值，无法转换时返回 None
+    '''
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+class TraceAnalytics:
+    ''' SpanTree 一次后序遍历得到的统计结果，所有按 span 统计的字段都是 span_id -> value 的字典
+
+        - duration:         span 自身记录的时长，没有记录时为 None
+        - subtree_duration: span 的包含时长 (inclusive)，span 本身没有时长时使用孩子节点包含时长之和
+        - self_time:        span 自身耗时，即包含时长减去孩子节点包含时长之和 (不小于 0)
+        - error_count:      span 子树 (含自身) 里面出错的 span 个数
+        - error_roots:      自身出错、但是子树里面没有其它出错 span 的节点，通常就是错误的源头
+        - critical_path:    从树根到叶子节点的关键路径 (span_id 列表)，每一步选择关键路径权重最大的孩子，
+                            权重 = 自身耗时 + 孩子节点关键路径权重的最大值
+        - fanout_hist:      孩子个数 -> span 个数
+        - depth_hist:       深度 -> span 个数，树根深度为 0
+        - by_name:          span name -> {count, errors, total, self_total, max}
+    '''
+
+    def __init__(self):
+        self.duration         = {}
+        self.subtree_duration = {}
+        self.self_time        = {}
+        self.error_count      = {}
+        self.error_roots      = []
+        self.critical_path    = []
+        self.fanout_hist      = Counter()
+        self.depth_hist       = Counter()
+        self.by_name          = {}
+
+    @property
+    def critical_path_duration(self) -> float:
+        return sum(self.self_time.get(span_id, 0) for span_id in self.critical_path)
+
+    def to_dict(self) -> dict:
+        return {
+            "duration":         dict(self.duration),
+            "subtree_duration": dict(self.subtree_duration),
+            "self_time":        dict(self.self_time),
+            "error_count":      dict(self.error_count),
+            "error_roots":      list(self.error_roots),
+            "critical_path":    list(self.critical_path),
+            "critical_path_duration": self.critical_path_duration,
+            "fanout_hist":      dict(self.fanout_hist),
+            "depth_hist":       dict(self.depth_hist),
+            "by_name":          {name: dict(stat) for name, stat in self.by_name.items()},
+        }
+
+
+def _accessor(key: Union[str, Callable, None]) -> Optional[Callable]:
+    if key is None or callable(key):
+        return key
+    return lambda span: span.get(key)
+
+
+def analyze_tree(tree, duration_key: Union[str, Callable] = "duration", start_key: Union[str, Callable] = None,
+                 end_key: Union[str, Callable] = None, status_key: Union[str, Callable] = "status_code") -> TraceAnalytics:
+    ''' 在 SpanTree 的拓扑结构上做一次自底向上的遍历 (SpanTree.iter_dfs(reverse=True))，同时计算时长、自身耗时、关键路径、扇出/深度直方图与错误传播，
+        参数可以是字段名或者 span -> value 的访问函数，含义详见 SpanTree.analyze
+    '''
+    result = TraceAnalytics()
+    sons, get_name = tree.sons, tree.schema.name
+    get_duration, get_start, get_end, get_status = map(_accessor, (duration_key, start_key, end_key, status_key))
+
+    def own_duration(span):
+        duration = as_number(get_duration(span)) if get_duration else None
+        if duration is None and get_start and get_end:
+            start, end = as_number(get_start(span)), as_number(get_end(span))
+            if start is not None and end is not None:
+                duration = end - start
+        return duration
+
+    def is_error(span):
+        status = get_status(span) if get_status else None
+        return status is not None and status != 0
+
+    cp_weight, cp_next = {}, {}
+    best_root, best_weight = None, None
+
+    get_span_id = tree.schema.span_id
+    for root_id in tree.get_components():
+        # 逆先序遍历 (与后序遍历的汇总顺序相同): 每个 span 出现的时候，它的所有后代都已经汇总完毕
+        for span, depth in tree.iter_dfs(root_id, reverse=True):
+            span_id = get_span_id(span)
+            children = sons.get(span_id, ())
+            result.depth_hist[depth] += 1
+            result.fanout_hist[len(children)] += 1
+
+            children_total = sum(result.subtree_duration[child_id] for child_id in children)
+            duration = own_duration(span)
+            inclusive = duration if duration is not None else children_total
+            self_time = max(0, inclusive - children_total)
+
+            errors = sum(result.error_count[child_id] for child_id in children)
+            if is_error(span):
+                if errors == 0:
+                    result.error_roots.append(span_id)
+                errors += 1
+
+            heaviest = max(children, key=cp_weight.__getitem__, default=None)
+            cp_weight[span_id] = self_time + (cp_weight[heaviest] if heaviest is not None else 0)
+            cp_next[span_id] = heaviest
+
+            result.duration[span_id] = duration
+            result.subtree_duration[span_id] = inclusive
+            result.self_time[span_id] = self_time
+            result.error_count[span_id] = errors
+
+            stat = result.by_name.setdefault(get_name(span), {"count": 0, "errors": 0, "total": 0, "self_total": 0, "max": 0})
+            stat["count"] += 1
+            stat["errors"] += int(is_error(span))
+            stat["total"] += inclusive
+            stat["self_total"] += self_time
+            stat["max"] = max(stat["max"], inclusive)
+
+        if best_weight is None or cp_weight[root_id] > best_weight:
+            best_root, best_weight = root_id, cp_weight[root_id]
+
+    span_id = best_root
+    while span_id is not None:
+        result.critical_path.append(span_id)
+        span_id = cp_next[span_id]
+
+    return result
+
+
+class LatencySketch:
+    ''' 可合并的分位数草图 (DDSketch 的简化实现)，相对误差不超过 relative_accuracy，
+        桶的个数不超过 max_bins，超出的时候合并最小的桶，因此内存有上界，且两个草图可以直接按桶相加合并
+    '''
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be in (0, 1).")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._gamma   = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._bins    = {}
+        self._zeros   = 0
+        self.count    = 0
+        self.total    = 0.0
+        self.min      = None
+        self.max      = None
+
+    def add(self, value: float, weight: int = 1) -> "LatencySketch":
+        # NaN 与任何数比较都不成立，not 0 <= value 同时拒绝负数与 NaN
+        if not 0 <= value < math.inf:
+            raise ValueError(f"LatencySketch only accepts finite non-negative values, but got {value}.")
+        if value == 0:
+            self._zeros += weight
+        else:
+            key = math.ceil(math.log(value) / self._log_gamma)
+            self._bins[key] = self._bins.get(key, 0) + weight
+            if len(self._bins) > self.max_bins:
+                self._collapse()
+
+        self.count += weight
+        self.total += value * weight
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        return self
+
+    def _collapse(self):
+        keys = sorted(self._bins)
+        overflow = len(keys) - self.max_bins
+        merged = sum(self._bins.pop(key) for key in keys[:overflow + 1])
+        self._bins[keys[overflow]] = merged
+
+    def merge(self, other: "LatencySketch") -> "LatencySketch":
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge LatencySketch objects with different relative_accuracy.")
+        for key, weight in other._bins.items():
+            self._bins[key] = self._bins.get(key, 0) + weight
+        while len(self._bins) > self.max_bins:
+            self._collapse()
+
+        self._zeros += other._zeros
+        self.count  += other.count
+        self.total  += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not 0 <= q <= 1:
+            raise ValueError("q must be in [0, 1].")
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self._zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self._bins):
+            seen += self._bins[key]
+            if rank < seen:
+                value = 2 * self._gamma ** key / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+
+class LatencyAggregator:
+    ''' 跨多个 SpanTree 流式聚合每个 span name 的耗时分位数，每个 name 只保留一个 LatencySketch，
+        不需要保存原始耗时数据，多个聚合器 (例如多进程各自聚合) 可以通过 merge 合并
+        负数、NaN、无穷大的耗时 (时钟漂移、数据损坏) 不参与聚合，按 name 计入 rejected
+    '''
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.sketches = {}
+        self.errors   = Counter()
+        self.rejected = Counter()
+        self.traces   = 0
+
+    def _sketch(self, name) -> LatencySketch:
+        sketch = self.sketches.get(name)
+        if sketch is None:
+            sketch = self.sketches[name] = LatencySketch(self.relative_accuracy, self.max_bins)
+        return sketch
+
+    def add_value(self, name, value: float, is_error: bool = False) -> "LatencyAggregator":
+        if not 0 <= value < math.inf:
+            self.rejected[name] += 1
+            return self
+        self._sketch(name).add(value)
+        if is_error:
+            self.errors[name] += 1
+        return self
+
+    def add_tree(self, tree, **kwargs) -> "LatencyAggregator":
+        ''' 聚合一棵 SpanTree，kwargs 与 SpanTree.analyze 的参数相同，没有记录时长的 span 不参与聚合，
+            时长为负数或者不是有限值的 span 计入 rejected，不影响同一棵树上的其它 span
+        '''
+        analytics = tree.analyze(**kwargs)
+        get_status = _accessor(kwargs.get("status_key") or tree.schema.status)
+        for span_id, duration in analytics.duration.items():
+            if duration is None:
+                continue
+            span = tree.span_map[span_id]
+            status = get_status(span)
+            self.add_value(tree.schema.name(span), duration, is_error=status is not None and status != 0)
+        self.traces += 1
+        return self
+
+    def add_trees(self, trees: Iterable, **kwargs) -> "LatencyAggregator":
+        for tree in trees:
+            self.add_tree(tree, **kwargs)
+        return self
+
+    def merge(self, other: "LatencyAggregator") -> "LatencyAggregator":
+        for name, sketch in other.sketches.items():
+            self._sketch(name).merge(sketch)
+        self.errors.update(other.errors)
+        self.rejected.update(other.rejected)
+        self.traces += other.traces
+        return self
+
+    def percentiles(self, qs: Iterable[float] = (0.5, 0.9, 0.99)) -> dict:
+        qs = tuple(qs)
+        report = {}
+        empty = LatencySketch(self.relative_accuracy, self.max_bins)
+        # 只有被拒绝的耗时的 name 也列出来 (count 为 0，分位数为 None)
+        names = [*self.sketches, *(name for name in self.rejected if name not in self.sketches)]
+        for name in names:
+            sketch = self.sketches.get(name, empty)
+            row = {"count": sketch.count, "errors": self.errors.get(name, 0), "rejected": self.rejected.get(name, 0),
+                   "mean": sketch.mean, "min": sketch.min, "max": sketch.max}
+            for q in qs:
+                row[f"p{q * 100:g}"] = sketch.quantile(q)
+            report[name] = row
+        return report
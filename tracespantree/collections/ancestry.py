@@ -0,0 +1,86 @@
+from array import array
+from typing import Optional
+
+
+""" 树上祖先关系的静态索引，所有 span 用下标 (SpanTree.position) 表示:
+    - 一次先序遍历 (显式栈) 得到每个节点的深度、所属连通分量、先序编号 tin 与子树最后一个节点的先序编号 tout，
+      is_ancestor(a, b) 即 tin[a] <= tin[b] <= tout[a]，O(1)
+    - LCA 使用先序序列上的稀疏表 (RMQ): 对 tin[u] < tin[v]，先序区间 (tin[u], tin[v]] 里面深度最小的节点的父节点就是 LCA，
+      稀疏表占用 O(n log n) 内存，首次调用 lca 的时候才构建，查询 O(1)
+    - 从任何树根都走不到的节点 (parent_map 里面成环) 深度为 -1，不参与祖先关系
+"""
+
+
+class AncestryIndex:
+    ''' 在 (下标化的) 森林上构建的祖先关系索引
+
+    :param size:     节点个数
+    :param roots:    每个连通分量的树根下标 (按输出顺序)
+    :param children: 下标 -> 孩子下标列表 (按遍历顺序)
+    '''
+
+    def __init__(self, size: int, roots: list, children: list):
+        self.depth     = array('l', [-1]) * size
+        self.tin       = array('l', [-1]) * size
+        self.tout      = array('l', [-1]) * size
+        self.parent    = array('l', [-1]) * size
+        self.component = array('l', [-1]) * size
+        self.order     = array('l')            # 先序序列: 先序编号 -> 节点下标
+        self._sparse   = None
+
+        depth, parent, component, order = self.depth, self.parent, self.component, self.order
+        for root_index, root in enumerate(roots):
+            depth[root] = 0
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                self.tin[node] = len(order)
+                component[node] = root_index
+                order.append(node)
+                kids = children[node]
+                for child in reversed(kids):
+                    # 防御重复的 span_id / 成环的 parent_map: 已经访问过的节点不再入栈
+                    if depth[child] < 0:
+                        depth[child], parent[child] = depth[node] + 1, node
+                        stack.append(child)
+
+        # 逆先序累加子树大小，tout = tin + 子树大小 - 1
+        subtree = array('l', [1]) * size
+        for node in reversed(order):
+            if parent[node] >= 0:
+                subtree[parent[node]] += subtree[node]
+        for node in order:
+            self.tout[node] = self.tin[node] + subtree[node] - 1
+
+    def is_ancestor(self, ancestor: int, node: int, proper: bool = True) -> bool:
+        ''' ancestor 是否是 node 的祖先，proper 为 False 时节点也视为自身的祖先 '''
+        if self.depth[ancestor] < 0 or self.depth[node] < 0 or (proper and ancestor == node):
+            return False
+        return self.tin[ancestor] <= self.tin[node] <= self.tout[ancestor]
+
+    def _build_sparse(self) -> list:
+        # 每一项编码为 depth << 32 | 先序编号，直接对整数取 min 就能得到深度最小的节点
+        depth = self.depth
+        level = [(depth[node] << 32) | k for k, node in enumerate(self.order)]
+        sparse, width = [level], 1
+        while 2 * width <= len(level):
+            prev = sparse[-1]
+            sparse.append(list(map(min, prev[:len(prev) - width], prev[width:])))
+            width *= 2
+        return sparse
+
+    def lca(self, u: int, v: int) -> Optional[int]:
+        ''' u 与 v 的最近公共祖先 (下标)，两者不在同一棵树上时返回 None '''
+        if self.depth[u] < 0 or self.depth[v] < 0 or self.component[u] != self.component[v]:
+            return None
+        if u == v:
+            return u
+
+        if self._sparse is None:
+            self._sparse = self._build_sparse()
+        lo, hi = sorted((self.tin[u], self.tin[v]))
+        lo += 1
+        k = (hi - lo + 1).bit_length() - 1
+        row = self._sparse[k]
+        best = min(row[lo], row[hi - (1 << k) + 1])
+        return self.parent[self.order[best & 0xFFFFFFFF]]
@@ -0,0 +1,206 @@
+import time
+
+from typing import Any, Callable, Iterable, Iterator, Union
+from collections import OrderedDict
+
+from tracespantree.utils.instrument import PhaseStats
+from tracespantree.collections.adapters import SpanSchema, get_schema
+from tracespantree.collections.spantree import SpanTree
+
+
+""" TraceAssembler: 把多个 trace 交错在一起的 span 流按 trace id 拆分，在线地产出完整的 SpanTree
+    - 每个打开的 trace 只缓存它的 span 列表，完成的时候一次性建树 (建树本身是 O(n)，没有必要每来一个 span 就更新一次树结构)
+    - 完成条件: 树根已经到达，并且超过 idle_timeout 秒没有收到新的 span；一直没有树根的 trace 在 rootless_timeout 之后丢弃 (或者照常产出)
+    - 内存有上限: 打开的 trace 超过 max_open_traces 时淘汰最久没有活动的 trace
+    - 计数器 (PhaseStats，可以导出为 Prometheus 格式): 迟到的 span、孤儿 span、被淘汰/丢弃的 trace 等
+"""
+
+
+def _default_is_root(parent_id: Any) -> bool:
+    return parent_id in (None, "", "0", 0)
+
+
+class _OpenTrace:
+    __slots__ = ("spans", "has_root", "first_seen", "last_seen")
+
+    def __init__(self, now: float):
+        self.spans      = []
+        self.has_root   = False
+        self.first_seen = now
+        self.last_seen  = now
+
+
+class TraceAssembler:
+    ''' 按 trace id 拆分交错的 span 流:
+
+        assembler = TraceAssembler(idle_timeout=10)
+        for tree in assembler.process(iter_jsonl_spans(stream)):
+            tree.batch_retrieve(configs)
+
+    :param schema:           span 的字段布局，trace id 通过 schema.trace_id 读取
+    :param idle_timeout:     树根到达之后，超过这么多秒没有新的 span 就认为 trace 已经完整
+    :param rootless_timeout: 一直没有树根的 trace 在最后一个 span 之后等待多久，默认是 idle_timeout 的两倍
+    :param max_open_traces:  同时打开的 trace 个数上限，超出时淘汰最久没有活动的 trace (有树根则提前产出，否则丢弃)
+    :param emit_rootless:    没有树根的 trace 超时或者被淘汰时是否照常产出 SpanTree (断链的树)，默认丢弃并计入孤儿 span
+    :param is_root:          parent_id -> 是否为树根，默认 None/''/'0'/0 视为没有父节点
+    :param closed_memory:    记住多少个已经产出的 trace id，用来识别迟到的 span
+    :param clock:            时钟函数，默认 time.monotonic
+    :param tree_kwargs:      透传给 SpanTree 的参数 (e.g. sep、cache_size、intern)
+    '''
+
+    def __init__(self, schema: Union[str, SpanSchema] = None, idle_timeout: float = 30.0, rootless_timeout: float = None,
+                 max_open_traces: int = 10000, emit_rootless: bool = False, is_root: Callable[[Any], bool] = None,
+                 closed_memory: int = 100000, clock: Callable[[], float] = time.monotonic, **tree_kwargs):
+        self.schema           = get_schema(schema)
+        self.idle_timeout     = idle_timeout
+        self.rootless_timeout = rootless_timeout if rootless_timeout is not None else 2 * idle_timeout
+        self.max_open_traces  = max_open_traces
+        self.emit_rootless    = emit_rootless
+        self.is_root          = is_root or _default_is_root
+        self.closed_memory    = closed_memory
+        self.clock            = clock
+        self.tree_kwargs      = dict(tree_kwargs, schema=self.schema)
+        self.stats            = PhaseStats()
+
+        self._open   = OrderedDict()    # trace id -> _OpenTrace，按最近一次活动的时间排序 (最久没有活动的在最前面)
+        self._closed = OrderedDict()    # 最近产出或者丢弃的 trace id，识别迟到的 span
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    # ------------------------------------------------------------ 输入
+
+    def add(self, span: dict) -> list[SpanTree]:
+        ''' 接收一个 span，返回因为淘汰而提前产出的 SpanTree (通常为空列表)
+        '''
+        stats = self.stats
+        stats.incr("spans")
+        trace_id = self.schema.trace_id(span) if isinstance(span, dict) else None
+        if trace_id is None:
+            stats.incr("spans_without_trace_id")
+            return []
+        if trace_id in self._closed:
+            stats.incr("late_spans")
+            return []
+
+        now = self.clock()
+        trace = self._open.get(trace_id)
+        if trace is None:
+            trace = self._open[trace_id] = _OpenTrace(now)
+            stats.incr("traces_opened")
+        else:
+            trace.last_seen = now
+            self._open.move_to_end(trace_id)
+
+        trace.spans.append(span)
+        if not trace.has_root and self.is_root(self.schema.parent_id(span)):
+            trace.has_root = True
+
+        emitted = []
+        while len(self._open) > self.max_open_traces:
+            evicted_id, evicted = self._open.popitem(last=False)
+            stats.incr("traces_evicted")
+            tree = self._close(evicted_id, evicted)
+            if tree is not None:
+                emitted.append(tree)
+        return emitted
+
+    def add_document(self, document: Any) -> list[SpanTree]:
+        ''' 接收一份包含多个 span 的数据 (e.g. OTLP 的一次导出，或者 {"spans": [...]})，按 schema 取出其中的 span 逐个接收
+        '''
+        if self.schema.iter_spans is not None:
+            spans = self.schema.iter_spans(document)
+        elif isinstance(document, dict) and isinstance(document.get("spans"), list):
+            spans = document["spans"]
+        else:
+            spans = [document]
+
+        emitted = []
+        for span in spans:
+            emitted.extend(self.add(span))
+        return emitted
+
+    # ------------------------------------------------------------ 输出
+
+    def _close(self, trace_id, trace: _OpenTrace):
+        ''' 关闭一个 trace: 有树根 (或者 emit_rootless) 时建树返回，否则丢弃并计入孤儿 span
+        '''
+        self._closed[trace_id] = None
+        if len(self._closed) > self.closed_memory:
+            self._closed.popitem(last=False)
+
+        stats = self.stats
+        if not trace.has_root and not self.emit_rootless:
+            stats.incr("traces_dropped")
+            stats.incr("orphan_spans", len(trace.spans))
+            return None
+
+        tree = SpanTree(spans=trace.spans, **self.tree_kwargs)
+        # 父节点一直没有到达的 span (不含真正的树根) 计入孤儿 span
+        orphans = sum(1 for span_id in tree.get_components() if not self.is_root(tree.parent_map.get(span_id)))
+        if orphans:
+            stats.incr("orphan_spans", orphans)
+        stats.incr("traces_emitted")
+        return tree
+
+    def poll(self, now: float = None) -> list[SpanTree]:
+        ''' 产出所有已经完成的 trace: 有树根且空闲超过 idle_timeout，或者没有树根且空闲超过 rootless_timeout
+        '''
+        now = self.clock() if now is None else now
+        emitted, waiting = [], []
+        while self._open:
+            trace_id, trace = next(iter(self._open.items()))
+            idle = now - trace.last_seen
+            if idle < self.idle_timeout:
+                break
+            del self._open[trace_id]
+            if not trace.has_root and idle < self.rootless_timeout:
+                # 还在等待树根，放回去 (保持原来的先后顺序)
+                waiting.append((trace_id, trace))
+                continue
+            tree = self._close(trace_id, trace)
+            if tree is not None:
+                emitted.append(tree)
+
+        for trace_id, trace in reversed(waiting):
+            self._open[trace_id] = trace
+            self._open.move_to_end(trace_id, last=False)
+        return emitted
+
+    def flush(self) -> list[SpanTree]:
+        ''' 输入结束: 关闭所有打开的 trace
+        '''
+        emitted = []
+        while self._open:
+            tree = self._close(*self._open.popitem(last=False))
+            if tree is not None:
+                emitted.append(tree)
+        return emitted
+
+    def process(self, spans: Iterable[dict], poll_every: int = 1000, flush: bool = True,
+                poll_interval: float = 1.0) -> Iterator[SpanTree]:
+        ''' 消费一个 span 迭代器，在线地产出完成的 SpanTree，迭代器结束时 (flush=True) 产出剩余的所有 trace
+
+        :param poll_every:    每接收这么多个 span 检查一次超时
+        :param poll_interval: 距离上一次检查超过这么多秒 (按 clock 计时) 时，收到下一个 span 就检查一次超时，
+                              流量稀疏的时候已经完成的 trace 不必等到攒够 poll_every 个 span，None 表示只按 span 个数检查；
+                              迭代器本身阻塞的时候无法检查，需要由调用方定时调用 poll()
+        '''
+        clock, last_poll = self.clock, self.clock()
+        for i, span in enumerate(spans, 1):
+            yield from self.add(span)
+            if poll_interval is None and i % poll_every:
+                continue
+            now = clock()
+            if i % poll_every == 0 or now - last_poll >= poll_interval:
+                last_poll = now
+                yield from self.poll(now)
+        yield from self.poll()
+        if flush:
+            yield from self.flush()
+
+    def counters(self) -> dict:
+        ''' 计数器快照，另外附带当前打开的 trace 与 span 个数 '''
+        self.stats.gauges["open_traces"] = len(self._open)
+        self.stats.gauges["open_spans"] = sum(len(trace.spans) for trace in self._open.values())
+        return {**self.stats.counters, **self.stats.gauges}
@@ -0,0 +1,388 @@
+import os
+import json
+import time
+import sqlite3
+
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
+
+from tracespantree.utils.io import iter_trace_files, iter_trace_records, read_trace
+from tracespantree.collections.kvtree import KVTree
+from tracespantree.collections.kvview import KVView
+from tracespantree.collections.adapters import SCHEMAS, SpanSchema, get_schema
+from tracespantree.collections.spantree import SpanTree
+
+
+""" TraceCorpus: 整个 trace 语料目录上的持久化倒排索引 (SQLite)
+    - 一次扫描目录下所有 .json/.jsonl 文件 (多进程并行解析)，记录每个 trace 所在的文件与位置 (.jsonl 为字节偏移)
+    - 倒排表: span name / span type / 指定字段的取值 -> (trace, span_id)，查询不需要打开任何 trace 文件
+    - 增量更新: 按文件的 mtime 与大小判断新增、修改、删除，只重新扫描变化的文件
+    - 查询命中之后只读取匹配的 trace 构建 SpanTree，.jsonl 文件直接 seek 到对应的行
+
+    注意这个模块依赖 sqlite3，没有在 tracespantree.collections 里面导入，使用时需要单独导入:
+        from tracespantree.collections.corpus import TraceCorpus
+"""
+
+
+_SCHEMA_VERSION = 2
+
+# term 的编码: 类别 + 分隔符 + 取值，字段取值的 term 为 "f\x1f字段\x1f取值"，三类 term 共用一张倒排表与一个索引
+_TERM_SEP = "\x1f"
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS meta     (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files    (file_id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime_ns INTEGER, size INTEGER);
+CREATE TABLE IF NOT EXISTS traces   (trace_pk INTEGER PRIMARY KEY, file_id INTEGER, trace_id TEXT,
+                                     offset INTEGER, length INTEGER, spans INTEGER);
+CREATE TABLE IF NOT EXISTS postings (term TEXT, trace_pk INTEGER, span_id TEXT,
+                                     PRIMARY KEY (term, trace_pk, span_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS traces_file    ON traces(file_id);
+CREATE INDEX IF NOT EXISTS traces_id      ON traces(trace_id);
+CREATE INDEX IF NOT EXISTS postings_trace ON postings(trace_pk);
+"""
+
+
+def _term(kind: str, *parts) -> str:
+    return _TERM_SEP.join((kind, *parts))
+
+
+def _term_value(value: Any) -> Optional[str]:
+    ''' 只索引标量字段，字符串原样保存，其它标量按 JSON 编码 (1 -> "1"，True -> "true")
+    '''
+    if isinstance(value, str):
+        return value
+    if value is None or isinstance(value, (dict, list, KVView)):
+        return None
+    return json.dumps(value)
+
+
+def _trace_id(trace: Any, spans: list, schema: SpanSchema) -> Optional[str]:
+    ''' trace 级别的 trace_id，没有的话读取第一个 span 上的 trace id (由 schema 决定)
+    '''
+    if isinstance(trace, dict):
+        for key in ("trace_id", "traceId", "traceID"):
+            if trace.get(key) is not None:
+                return str(trace[key])
+    if spans and isinstance(spans[0], dict):
+        trace_id = schema.trace_id(spans[0])
+        return str(trace_id) if trace_id is not None else None
+    return None
+
+
+def _iter_spans(schema: SpanSchema, trace: Any) -> list:
+    ''' 与 SpanTree 的取 span 规则一致，默认格式下顶层就有 spans 列表的时候不展开整个 trace
+    '''
+    if schema.iter_spans is not None:
+        return list(schema.iter_spans(trace))
+    if isinstance(trace, dict) and isinstance(trace.get("spans"), list):
+        return trace["spans"]
+    return KVTree.find_key(trace, target_key="spans") or []
+
+
+def _scan_file(path: str, schema: Union[str, SpanSchema], fields: tuple, sep: str) -> Optional[list]:
+    ''' 解析一个 trace 文件，返回 [(offset, length, trace_id, span 个数, [(term, span_id), ...]), ...]，
+        .json 文件整体无法解析时返回 None；在子进程里面运行，只返回倒排所需的 term，不返回 trace 本身
+    '''
+    schema = get_schema(schema)
+    try:
+        return _scan_records(iter_trace_records(path, schema.split_document), schema, fields, sep)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+
+def _scan_records(trace_records: Iterable, schema: SpanSchema, fields: tuple, sep: str) -> list:
+    records = []
+    for offset, length, trace in trace_records:
+        spans = _iter_spans(schema, trace)
+        terms = set()
+        for span in spans:
+            if not isinstance(span, dict):
+                continue
+            span_id = schema.span_id(span)
+            if span_id is None:
+                continue
+            span_id = str(span_id)
+
+            name, span_type = schema.name(span), schema.span_type(span)
+            if name is not None:
+                terms.add((_term("n", str(name)), span_id))
+            if span_type is not None:
+                terms.add((_term("t", str(span_type)), span_id))
+
+            if fields:
+                view = KVView(schema.flatten_attributes(span), sep)
+                for field in fields:
+                    # 0、False、"" 也要建立倒排，不能用 get (取值为假时返回默认值)
+                    value = _term_value(view.lookup(field))
+                    if value is not None:
+                        terms.add((_term("f", field, value), span_id))
+
+        records.append((offset, length, _trace_id(trace, spans, schema), len(spans), list(terms)))
+    return records
+
+
+class CorpusHit:
+    ''' 一次查询命中的 trace: 所在文件、位置，以及 trace 里面满足条件的 span id (字符串)，
+        split 为建立索引时拆分 .json 文档的函数 (SpanSchema.split_document)
+    '''
+    __slots__ = ("trace_pk", "trace_id", "path", "offset", "length", "span_ids", "split")
+
+    def __init__(self, trace_pk: int, trace_id: str, path: str, offset: int, length: int, span_ids: list,
+                 split: Callable = None):
+        self.trace_pk = trace_pk
+        self.trace_id = trace_id
+        self.path     = path
+        self.offset   = offset
+        self.length   = length
+        self.span_ids = span_ids
+        self.split    = split
+
+    def read(self) -> Any:
+        ''' 读取这个 trace 的原始数据 '''
+        return read_trace(self.path, self.offset, self.length, self.split)
+
+    def __repr__(self):
+        return f"CorpusHit(trace_id={self.trace_id!r}, path={self.path!r}, spans={len(self.span_ids)})"
+
+
+class TraceCorpus:
+    ''' trace 语料目录上的持久化倒排索引:
+
+        corpus = TraceCorpus("traces.idx", root="traces/", fields=["http.status_code"])
+        corpus.update()                                             # 首次全量扫描，之后只扫描新增或者修改过的文件
+        for tree, spans in corpus.query("checkout", where={"http.status_code": 500}):
+            ...
+
+    :param index_path: 索引文件 (SQLite 数据库) 的路径
+    :param root:       trace 语料目录 (或者单个文件)，下面的 .json/.jsonl 文件都会被索引
+    :param schema:     span 的字段布局，与 SpanTree 的 schema 参数相同
+    :param fields:     需要建立倒排的字段 (与 retrieve 的 target_field 写法相同，只索引标量取值)
+    :param sep:        字段路径的分隔符
+    :param workers:    并行扫描的进程数，None 表示使用 CPU 个数，1 表示在当前进程扫描 (自定义的 SpanSchema 无法跨进程传递，总是在当前进程扫描)
+    '''
+
+    def __init__(self, index_path: str, root: str, schema: Union[str, SpanSchema] = None, fields: Iterable[str] = (),
+                 sep: str = '.', workers: int = None):
+        self.index_path = index_path
+        self.root       = root
+        self.schema     = get_schema(schema)
+        self.fields     = tuple(fields)
+        self.sep        = sep
+        self.workers    = workers
+
+        self._conn = sqlite3.connect(index_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_DDL)
+        self._check_meta()
+
+    def _meta(self) -> dict:
+        return {
+            "version": _SCHEMA_VERSION,
+            "schema":  self.schema.format,
+            "fields":  list(self.fields),
+            "sep":     self.sep,
+        }
+
+    def _check_meta(self):
+        ''' 索引的配置 (格式、字段、分隔符) 与当前参数不一致时清空索引，下次 update 会全量重建
+        '''
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'config'").fetchone()
+        meta = json.dumps(self._meta(), sort_keys=True)
+        if row is not None and row[0] == meta:
+            return
+        with self._conn:
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM traces")
+            self._conn.execute("DELETE FROM files")
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('config', ?)", (meta,))
+
+    # ------------------------------------------------------------ 索引维护
+
+    def update(self) -> dict:
+        ''' 增量更新索引: 扫描新增与修改过的文件，删除已经不存在的文件，返回本次更新的统计信息，
+            其中 failed 为无法解析而跳过的 .json 文件个数 (.jsonl 里面无法解析的行直接跳过，不计入)
+        '''
+        t0 = time.perf_counter()
+        indexed = {path: (file_id, mtime_ns, size) for file_id, path, mtime_ns, size
+                   in self._conn.execute("SELECT file_id, path, mtime_ns, size FROM files")}
+
+        changed, seen = [], set()
+        for path in iter_trace_files(self.root):
+            path = os.path.abspath(path)
+            seen.add(path)
+            stat = os.stat(path)
+            known = indexed.get(path)
+            if known is None or known[1:] != (stat.st_mtime_ns, stat.st_size):
+                changed.append((path, stat.st_mtime_ns, stat.st_size))
+        removed = [path for path in indexed if path not in seen]
+
+        with self._conn:
+            for path in removed:
+                self._delete_file(indexed[path][0])
+
+        traces, failed = 0, 0
+        for (path, mtime_ns, size), records in zip(changed, self._scan([path for path, _, _ in changed])):
+            if records is None:
+                # 无法解析的 .json 文件按空文件记录，内容 (mtime 或者大小) 变化之后才会重新扫描
+                failed += 1
+                records = []
+            # 每个文件单独提交，扫描中途中断的时候已经写入的文件不需要重新扫描
+            with self._conn:
+                if path in indexed:
+                    self._delete_file(indexed[path][0])
+                self._insert_file(path, mtime_ns, size, records)
+            traces += len(records)
+
+        return {
+            "added":   sum(1 for path, _, _ in changed if path not in indexed),
+            "updated": sum(1 for path, _, _ in changed if path in indexed),
+            "removed": len(removed),
+            "failed":  failed,
+            "traces":  traces,
+            "seconds": round(time.perf_counter() - t0, 3),
+        }
+
+    def rebuild(self) -> dict:
+        ''' 清空索引之后全量扫描 '''
+        with self._conn:
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM traces")
+            self._conn.execute("DELETE FROM files")
+        return self.update()
+
+    def _scan(self, paths: list) -> Iterator[Optional[list]]:
+        ''' 按 paths 的顺序产出每个文件的扫描结果 (无法解析的文件为 None)，多个文件时使用进程池并行解析
+        '''
+        workers = self.workers if self.workers is not None else (os.cpu_count() or 1)
+        schema = self.schema.format if SCHEMAS.get(self.schema.format) is self.schema else self.schema
+        if workers <= 1 or len(paths) <= 1 or isinstance(schema, SpanSchema):
+            for path in paths:
+                yield _scan_file(path, schema, self.fields, self.sep)
+            return
+
+        # 只有真正并行扫描的时候才导入 concurrent.futures
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+            n = len(paths)
+            yield from pool.map(_scan_file, paths, [schema] * n, [self.fields] * n, [self.sep] * n)
+
+    def _delete_file(self, file_id: int):
+        self._conn.execute("DELETE FROM postings WHERE trace_pk IN (SELECT trace_pk FROM traces WHERE file_id = ?)", (file_id,))
+        self._conn.execute("DELETE FROM traces WHERE file_id = ?", (file_id,))
+        self._conn.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+
+    def _insert_file(self, path: str, mtime_ns: int, size: int, records: list):
+        cursor = self._conn.execute("INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)", (path, mtime_ns, size))
+        file_id = cursor.lastrowid
+        for position, (offset, length, trace_id, span_count, terms) in enumerate(records):
+            cursor = self._conn.execute(
+                "INSERT INTO traces (file_id, trace_id, offset, length, spans) VALUES (?, ?, ?, ?, ?)",
+                (file_id, trace_id if trace_id is not None else f"{path}#{position}", offset, length, span_count),
+            )
+            trace_pk = cursor.lastrowid
+            self._conn.executemany("INSERT OR IGNORE INTO postings (term, trace_pk, span_id) VALUES (?, ?, ?)",
+                                   ((term, trace_pk, span_id) for term, span_id in terms))
+
+    # ------------------------------------------------------------ 查询
+
+    def _conditions(self, name: Optional[str], span_type: Optional[str], where: Optional[dict]) -> list:
+        terms = []
+        if name is not None:
+            terms.append(_term("n", str(name)))
+        if span_type is not None:
+            terms.append(_term("t", str(span_type)))
+        for field, value in (where or {}).items():
+            if field not in self.fields:
+                raise ValueError(f"Field '{field}' is not indexed, indexed fields: {list(self.fields)}.")
+            value = _term_value(value)
+            if value is None:
+                raise TypeError(f"Only scalar values can be matched, got {type(where[field]).__name__} for field '{field}'.")
+            terms.append(_term("f", field, value))
+        if not terms:
+            raise ValueError("At least one of name, span_type or where must be given.")
+        return terms
+
+    def search(self, name: str = None, span_type: str = None, where: dict = None, limit: int = None) -> list[CorpusHit]:
+        ''' 查找同一个 span 同时满足所有条件的 trace，只读索引，不打开 trace 文件
+
+        :param name:      span name
+        :param span_type: span type
+        :param where:     {字段: 取值}，字段必须是建立索引时指定的 fields 之一
+        :param limit:     最多返回多少个 trace
+        '''
+        terms = self._conditions(name, span_type, where)
+
+        # 第一个条件作为驱动表，其余条件在同一个 (trace, span) 上做等值连接
+        joins = "".join(f" JOIN postings p{i} ON p{i}.trace_pk = p0.trace_pk AND p{i}.span_id = p0.span_id AND p{i}.term = ?"
+                        for i in range(1, len(terms)))
+        sql = (f"SELECT t.trace_pk, t.trace_id, f.path, t.offset, t.length, p0.span_id FROM postings p0{joins}"
+               f" JOIN traces t ON t.trace_pk = p0.trace_pk JOIN files f ON f.file_id = t.file_id"
+               f" WHERE p0.term = ? ORDER BY t.trace_pk")
+
+        hits, current = [], None
+        for trace_pk, trace_id, path, offset, length, span_id in self._conn.execute(sql, (*terms[1:], terms[0])):
+            if current is None or current.trace_pk != trace_pk:
+                if limit is not None and len(hits) >= limit:
+                    break
+                current = CorpusHit(trace_pk, trace_id, path, offset, length, [], self.schema.split_document)
+                hits.append(current)
+            current.span_ids.append(span_id)
+        return hits
+
+    def count(self, name: str = None, span_type: str = None, where: dict = None) -> int:
+        ''' 满足条件的 trace 个数 '''
+        return len(self.search(name, span_type, where))
+
+    def load(self, hits: Iterable[CorpusHit], **tree_kwargs) -> Iterator[tuple[SpanTree, list[dict]]]:
+        ''' 只读取命中的 trace 构建 SpanTree，产出 (tree, 命中的 span 列表)，tree_kwargs 透传给 SpanTree
+            (e.g. projection=configs 只保留抓取配置用到的字段)
+        '''
+        tree_kwargs.setdefault("schema", self.schema)
+        documents = {}      # .json 文件整体解析一次，同一个文件里面的多个 trace 共用
+        for hit in hits:
+            if hit.length >= 0:
+                trace = hit.read()
+            else:
+                if hit.path not in documents:
+                    documents.clear()
+                    with open(hit.path, "r", encoding="utf-8") as f:
+                        documents[hit.path] = self.schema.split_document(json.load(f))
+                trace = documents[hit.path][hit.offset]
+
+            tree = SpanTree(trace=trace, sep=self.sep, **tree_kwargs)
+            yield tree, self._spans_of(tree, hit.span_ids)
+
+    @staticmethod
+    def _spans_of(tree: SpanTree, span_ids: list) -> list[dict]:
+        # 索引里面的 span id 是字符串，原始 id 可能是整数，先直接查找，找不到再按字符串比较
+        spans, missing = [], []
+        for span_id in span_ids:
+            span = tree.span_map.get(span_id)
+            if span is None:
+                missing.append(span_id)
+            else:
+                spans.append(span)
+        if missing:
+            by_str = {str(span_id): span for span_id, span in tree.span_map.items()}
+            spans.extend(by_str[span_id] for span_id in missing if span_id in by_str)
+        return spans
+
+    def query(self, name: str = None, span_type: str = None, where: dict = None, limit: int = None,
+              **tree_kwargs) -> Iterator[tuple[SpanTree, list[dict]]]:
+        ''' search + load: 产出每个命中 trace 的 (SpanTree, 命中的 span 列表)
+        '''
+        return self.load(self.search(name, span_type, where, limit), **tree_kwargs)
+
+    def stats(self) -> dict:
+        ''' 索引规模: 文件、trace、倒排记录的个数 '''
+        count = lambda table: self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        return {"files": count("files"), "traces": count("traces"), "postings": count("postings")}
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,102 @@
+from bisect import bisect_left, bisect_right
+from typing import Sequence
+
+
+""" 静态区间索引 (centered interval tree + 按开始时间排序的数组)，用于 span 的时间区间查询
+    - 区间统一按左闭右开 [start, end) 处理，start 或 end 缺失 (NaN) 以及 end < start 的区间不参与索引
+    - stab(t):         所有满足 start <= t < end 的区间，O(log n + k)
+    - overlap(lo, hi): 所有与 [lo, hi) 相交的区间，拆成 "包含 lo 的区间" 与 "start 落在 (lo, hi) 之内的区间" 两个不相交的部分，
+                       前者由区间树回答，后者在排序数组上二分，整体 O(log n + k)
+    - 索引只保存区间的下标，查询结果按 (start, 下标) 排序
+"""
+
+
+class IntervalIndex:
+    ''' 在 starts/ends 两个等长数组上构建的静态区间索引，查询返回数组下标
+
+    :param starts: 每个区间的开始时间
+    :param ends:   每个区间的结束时间
+    '''
+
+    def __init__(self, starts: Sequence[float], ends: Sequence[float]):
+        self._starts = starts
+        self._ends   = ends
+
+        # NaN 与任何数比较都是 False，因此缺失时间戳的区间会被自然地过滤掉
+        valid = [i for i in range(len(starts)) if starts[i] <= ends[i]]
+        self._by_start      = sorted(valid, key=lambda i: (starts[i], i))
+        self._sorted_starts = [starts[i] for i in self._by_start]
+
+        # 节点: [center, 按 start 升序的区间, 按 end 降序的区间, 左孩子, 右孩子]，孩子为 -1 表示空
+        self._nodes = []
+        self._build([i for i in valid if starts[i] < ends[i]])
+
+    def __len__(self) -> int:
+        return len(self._by_start)
+
+    def _build(self, items: list):
+        starts, ends, nodes = self._starts, self._ends, self._nodes
+        stack = [(items, -1, 0)] if items else []
+        while stack:
+            items, parent, side = stack.pop()
+
+            # 以所有端点的下中位数作为中心，左右两侧的区间个数都严格减少 (不会出现全部落在一侧的情况)
+            endpoints = sorted([starts[i] for i in items] + [ends[i] for i in items])
+            center = endpoints[(len(endpoints) - 1) // 2]
+
+            left, right, here = [], [], []
+            for i in items:
+                if ends[i] <= center:
+                    left.append(i)
+                elif starts[i] > center:
+                    right.append(i)
+                else:
+                    here.append(i)
+
+            node = len(nodes)
+            nodes.append([center, sorted(here, key=starts.__getitem__), sorted(here, key=ends.__getitem__, reverse=True), -1, -1])
+            if parent >= 0:
+                nodes[parent][3 + side] = node
+            if left:
+                stack.append((left, node, 0))
+            if right:
+                stack.append((right, node, 1))
+
+    def _stab(self, t: float) -> list:
+        starts, ends, nodes = self._starts, self._ends, self._nodes
+        result, node = [], 0 if nodes else -1
+        while node >= 0:
+            center, by_start, by_end, left, right = nodes[node]
+            if t < center:
+                # 挂在这个节点上的区间都满足 end > center > t，只需要检查 start
+                for i in by_start:
+                    if starts[i] > t:
+                        break
+                    result.append(i)
+                node = left
+            else:
+                # 挂在这个节点上的区间都满足 start <= center <= t，只需要检查 end
+                for i in by_end:
+                    if ends[i] <= t:
+                        break
+                    result.append(i)
+                node = right
+        return result
+
+    def _sort(self, result: list) -> list:
+        starts = self._starts
+        result.sort(key=lambda i: (starts[i], i))
+        return result
+
+    def stab(self, t: float) -> list:
+        ''' 所有在 t 时刻处于活跃状态 (start <= t < end) 的区间下标 '''
+        return self._sort(self._stab(t))
+
+    def overlap(self, lo: float, hi: float) -> list:
+        ''' 所有与 [lo, hi) 相交的区间下标，lo == hi 时等价于 stab(lo) '''
+        if hi < lo:
+            raise ValueError(f"Invalid interval: end ({hi}) is smaller than start ({lo}).")
+        result = self._stab(lo)
+        if hi > lo:
+            result.extend(self._by_start[bisect_right(self._sorted_starts, lo): bisect_left(self._sorted_starts, hi)])
+        return self._sort(result)
@@ -1,5 +1,9 @@
 import json
-from typing import Any, Union
+from typing import Any, Optional, TextIO, Union
+
+from tracespantree.utils import instrument as _instrument
+from tracespantree.utils.instrument import perf_counter_ns
+from tracespantree.utils.pretty import render_pretty
 
 
 """ 特性梳理:
@@ -15,6 +19,15 @@ from typing import Any, Union
 
 
 
+_NO_WRITE = object()
+
+
+def looks_like_json_container(text: str) -> bool:
+    ''' 只有以 '{' 或 '[' 开头 (忽略前导空白) 的字符串才可能解析成 dict/list，其余字符串不需要付出 json.loads 失败的代价 '''
+    head = text[:1]
+    return head == "{" or head == "[" or (head.isspace() and text.lstrip()[:1] in ("{", "["))
+
+
 class KVTree(dict):    
     ''' 通过递归的方式展开数据，能够展开字符串格式的JSON或Dict，展开之后的字典可以视为一棵树
         用户直接传入 key 即可搜索对应的 value，若有重名value，用户可以使用多个 key1.key3.key5 构成的子序列进行约束
@@ -24,7 +37,16 @@ class KVTree(dict):
         self.sep = sep
         self.data = self.expand(data)
         self._pretty_str = None
-        
+
+    @classmethod
+    def _from_expanded(cls, data: Any, sep: str = '.') -> "KVTree":
+        """ 直接包装已经展开过的数据，不再调用 expand (expand 会原地改写其中的 list，破坏与原数据共享的子树) """
+        tree = cls.__new__(cls)
+        tree.sep = sep
+        tree.data = data
+        tree._pretty_str = None
+        return tree
+
 
     def __getitem__(self, key: Union[list, str]) -> Any:
         """ 重写 __getitem__ 方法，以便通过字符串路径（例如 'key1.key2.key3'）访问嵌套数据，默认行为等同于字典
@@ -47,29 +69,22 @@ class KVTree(dict):
         return self._pretty_str
     
     def _recursive_pretty_str(self, data, level: int = 0) -> str:
-        """ 递归地将字典数据格式化为树形结构字符串 
-            每层增加四个空格的缩进来确保可读性
+        """ 将字典数据格式化为树形结构字符串，每层增加四个空格的缩进来确保可读性
+            (基于 render_pretty 的显式栈实现，不会因为嵌套过深触发 RecursionError)
         """
-        result = list()
-        indent = "    " * level  
-        for key, value in data.items():
-            if isinstance(value, dict):
-                result.append(f"{indent}{key}:\n{self._recursive_pretty_str(value, level + 1)}")
-            elif isinstance(value, list):
-                result.append(f"{indent}{key}:\n")
-                for item in value:
-                    if isinstance(item, dict):
-                        result.append(self._recursive_pretty_str(item, level + 1))
-                    else:
-                        result.append(f"{indent}    {item}\n")
-            else:
-                result.append(f"{indent}{key}: {value}\n")
-        return str().join(result)
+        return render_pretty(data, level=level)
+
+    def dump(self, stream: TextIO = None, max_depth: int = None, max_items: int = None, max_str_len: int = None) -> Optional[str]:
+        """ 把树形字符串逐行写入 stream (例如 sys.stdout 或者打开的文件)，不会在内存里面拼出完整的字符串，
+            没有传入 stream 的时候返回字符串。截断参数详见 tracespantree.utils.pretty.iter_pretty_lines
+        """
+        return render_pretty(self.data, stream, max_depth=max_depth, max_items=max_items, max_str_len=max_str_len)
     
     
     def __setitem__(self, key: Union[str, list], val: Any) -> None:
         """ 重写 __setitem__ 方法，支持通过字符串路径设置嵌套字典的值 """
         self.update_key(self.data, target_key=key ,val=val)
+        self._pretty_str = None
         
     def get(self, key: Union[list, str], default: Any = None) -> Any:
         """ 重写 get 方法，以便通过字符串路径（例如 'key1.key2.key3'）访问嵌套数据
@@ -92,6 +107,19 @@ class KVTree(dict):
 
         """
         self._recursive_update(self.data, target_key=key ,val=val)
+        self._pretty_str = None
+        return self
+
+    def put_many(self, updates: dict, copy_on_write: bool = False) -> "KVTree":
+        """ 一次遍历批量写入多个字段，路径规则与 get 相同 (子序列约束)，详见 update_many_keys
+
+        :param updates:       {path: value}
+        :param copy_on_write: 为 True 时不修改当前 KVTree，返回一个新的 KVTree，只复制被修改路径上的 dict/list，其余子树与当前 KVTree 共享
+        """
+        data, _ = self.update_many_keys(self.data, updates, sep=self.sep, copy_on_write=copy_on_write)
+        if copy_on_write:
+            return KVTree._from_expanded(data, self.sep)
+        self._pretty_str = None
         return self
 
     @staticmethod
@@ -107,14 +135,17 @@ class KVTree(dict):
             return data
         
         # 如果是字符串，尝试将其解析为 JSON，
-        # 如果解析得到 dict 或 list，递归展开，若是无法解析为 JSON，直接返回原始字符串
+        # 如果解析得到 dict 或 list，递归展开，若是无法解析为 JSON 或者解析得到标量 (e.g. "0"、"true")，直接返回原始字符串
         if isinstance(data, str):
+            if not looks_like_json_container(data):
+                return data
             try: 
                 parsed_value = json.loads(data)
                 if isinstance(parsed_value, (dict, list)):
                     return KVTree.expand(parsed_value)
             except json.JSONDecodeError:
-                return data
+                pass
+            return data
         
         elif isinstance(data, dict):
             for key, value in data.items():
@@ -157,19 +188,128 @@ class KVTree(dict):
         ''' target_key 可以是多个key通过'.'连接在一起的序列，当这个子序列是根节点到目标节点的子序列时，
             能够实现缩小目标 key 范围的效果 (通常用于目标key存在同名的情况)
         ''' 
+        stats = _instrument._global_stats
+        t0 = perf_counter_ns() if stats is not None else 0
+        
         val, data, target_key_parts = None, KVTree.expand(data), target_key.split(sep)
         for part in target_key_parts:
             val = KVTree._recursive_search(data, part)
             data = val
             if data is None:
                 break
+        
+        if stats is not None:
+            stats.observe("kvtree.find_key", perf_counter_ns() - t0)
         return val or default
     
     @staticmethod
     def update_key(data:dict, target_key:str, val) -> bool:
-        return KVTree._recursive_update(KVTree.expand(data), target_key, val)
+        stats = _instrument._global_stats
+        if stats is None:
+            return KVTree._recursive_update(KVTree.expand(data), target_key, val)
+        
+        t0 = perf_counter_ns()
+        updated = KVTree._recursive_update(KVTree.expand(data), target_key, val)
+        stats.observe("kvtree.update_key", perf_counter_ns() - t0)
+        return updated
     
 
+    @staticmethod
+    def _build_path_trie(updates: dict, sep: str = '.') -> dict:
+        # 路径前缀树: part -> [待写入的值, 原始路径, 孩子]，多条路径的公共前缀只需要搜索一次
+        trie = {}
+        for path, val in updates.items():
+            node, children = None, trie
+            for part in KVTree._split_key(path, sep):
+                node = children.setdefault(part, [_NO_WRITE, None, {}])
+                children = node[2]
+            if node is not None:
+                node[0], node[1] = val, path
+        return trie
+
+    @staticmethod
+    def update_many_keys(data: dict, updates: dict, sep: str = '.', copy_on_write: bool = False) -> tuple:
+        ''' 一次深度优先遍历写入多个 key，每个 key 都可以是 key1.key3.key5 形式的子序列约束:
+            前面的 key 按照 find_key 的规则逐层定位，最后一个 key 按照 update_key 的规则写入第一个出现的位置。
+            遍历时同时维护所有路径的搜索状态，全部定位完毕之后立刻停止，不需要每个 key 各做一次完整的 DFS。
+
+            定位都在写入之前完成 (基于原始数据)，如果两个写入位置存在嵌套关系，较浅位置的写入覆盖较深位置的写入。
+
+        :param updates:       {path: value}
+        :param copy_on_write: 为 True 时不修改 data，只复制被修改路径上的 dict/list，未修改的子树与 data 共享，
+                              此时 data 需要是已经展开过的数据 (例如 KVTree.data)，其中的字符串不会再被展开
+        :return:              (写入之后的数据, 没有找到的路径列表)，copy_on_write 为 False 时返回的就是 data 本身
+        '''
+        stats = _instrument._global_stats
+        t0 = perf_counter_ns() if stats is not None else 0
+
+        if not copy_on_write:
+            data = KVTree.expand(data)
+        trie = KVTree._build_path_trie(updates, sep)
+        order = {path: i for i, path in enumerate(updates)}
+
+        # 栈帧: (节点, 从根到节点的路径 (父路径, 父节点, key), 深度, 仍在搜索的状态列表)
+        # 每个搜索状态是一个 dict (part -> 前缀树节点)，被多个子树共享，先命中的位置把 part 弹出，保证 "第一个出现的位置" 语义
+        writes, root_trail = [], ()
+        stack = [(data, root_trail, 0, [dict(trie)])] if trie else []
+        while stack:
+            node, trail, depth, searchers = stack.pop()
+            spawned = {}
+            if isinstance(node, dict):
+                for pending in searchers:
+                    if len(pending) <= len(node):
+                        hits = [part for part in pending if part in node]
+                    else:
+                        hits = [key for key in node if key in pending]
+                    for part in hits:
+                        val, path, children = pending.pop(part)
+                        if val is not _NO_WRITE:
+                            writes.append((depth, order[path], trail, node, part, val))
+                        if children:
+                            spawned.setdefault(part, []).append(dict(children))
+                items = node.items()
+            elif isinstance(node, list):
+                items = enumerate(node)
+            else:
+                continue
+
+            alive = [pending for pending in searchers if pending]
+            if not alive and not spawned:
+                continue
+            for key, value in reversed(list(items)):
+                active = alive + spawned[key] if key in spawned else alive
+                if active and isinstance(value, (dict, list)):
+                    stack.append((value, (trail, node, key), depth + 1, active))
+
+        # 先写深层，再写浅层，同一个位置按照 updates 的顺序，后面的覆盖前面的
+        writes.sort(key=lambda write: (-write[0], write[1]))
+        if copy_on_write:
+            copies = {}
+
+            def _copy_along(trail, node):
+                copied = copies.get(id(trail))
+                if copied is None:
+                    copied = dict(node) if isinstance(node, dict) else list(node)
+                    copies[id(trail)] = copied
+                    if trail is not root_trail:
+                        parent_trail, parent, key = trail
+                        _copy_along(parent_trail, parent)[key] = copied
+                return copied
+
+            for _, _, trail, node, part, val in writes:
+                _copy_along(trail, node)[part] = val
+            data = copies.get(id(root_trail), data)
+        else:
+            for _, _, _, node, part, val in writes:
+                node[part] = val
+
+        written = {write[1] for write in writes}
+        missing = [path for path, i in order.items() if i not in written]
+
+        if stats is not None:
+            stats.observe("kvtree.update_many_keys", perf_counter_ns() - t0)
+        return data, missing
+
     @staticmethod
     def update_batch_keys(raw_dict:dict, replace_dict:dict) -> dict:
         # NOTE: 使用 replace_dict 键值对批量更新 raw_dict 之中的键值对的，并返回更新之后的结果。
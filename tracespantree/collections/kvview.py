@@ -0,0 +1,157 @@
+import json
+
+from typing import Any, Iterator, Union
+
+from tracespantree.collections.kvtree import looks_like_json_container
+
+
+""" KVView: KVTree 的只读、零拷贝视图
+    - 直接引用原始的嵌套数据，不复制、不修改，构造的开销是常数
+    - 字符串化的 JSON 只有在搜索经过它的时候才会解析，解析结果按照字符串对象缓存，同一棵数据上的所有视图共享这个缓存
+    - 只有以 '{' 或 '[' 开头 (忽略前导空白) 的字符串才会尝试解析，普通字符串不会付出 json.loads 失败的代价
+    - get / __getitem__ 与 KVTree 的子序列约束搜索语义相同，搜索结果如果是 dict/list，返回共享缓存的子视图
+"""
+
+
+class KVView:
+    ''' 只读的嵌套数据视图，用法与 KVTree 的 get / __getitem__ 相同:
+
+        view = KVView(span)
+        view.get("input.messages.content")
+        view["output"].get("score")
+    '''
+    __slots__ = ("_data", "sep", "_parsed")
+
+    def __init__(self, data: Any, sep: str = '.', _parsed: dict = None):
+        self.sep     = sep
+        self._parsed = {} if _parsed is None else _parsed     # id(原始字符串) -> (原始字符串, 解析结果)，保留原始字符串以免 id 被复用
+        self._data   = self._resolve(data)
+
+    @property
+    def data(self) -> Any:
+        ''' 视图引用的原始数据 (未展开的部分仍然是字符串) '''
+        return self._data
+
+    def _resolve(self, value: Any) -> Any:
+        if not isinstance(value, str):
+            return value
+
+        if not looks_like_json_container(value):
+            return value
+
+        cached = self._parsed.get(id(value))
+        if cached is not None:
+            return cached[1]
+
+        try:
+            parsed = json.loads(value)
+        except json.JSONDecodeError:
+            parsed = value
+        if not isinstance(parsed, (dict, list)):
+            parsed = value
+        self._parsed[id(value)] = (value, parsed)
+        return parsed
+
+    def _wrap(self, value: Any) -> Any:
+        if isinstance(value, (dict, list)):
+            return KVView(value, self.sep, self._parsed)
+        return value
+
+    def _search(self, node: Any, target_key: str) -> Any:
+        ''' 与 KVTree._recursive_search 相同的先序搜索 (当前层先查 key，再依次深入每个孩子)，使用显式栈，
+            经过的字符串化 JSON 按需解析
+        '''
+        if isinstance(node, dict) and target_key in node:
+            return self._resolve(node[target_key])
+
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if isinstance(current, dict):
+                if current is not node and target_key in current:
+                    # 与递归版本一致: 命中的值为 None 时跳过这棵子树，继续搜索后面的兄弟
+                    value = self._resolve(current[target_key])
+                    if value is not None:
+                        return value
+                    continue
+                children = current.values()
+            elif isinstance(current, list):
+                children = current
+            else:
+                continue
+            stack.extend(child for child in map(self._resolve, reversed(list(children))) if isinstance(child, (dict, list)))
+        return None
+
+    def _lookup(self, key: Union[list, str]) -> Any:
+        val, node = None, self._data
+        for part in key if isinstance(key, list) else key.split(self.sep):
+            val = self._search(node, part)
+            node = val
+            if node is None:
+                break
+        return val
+
+    def get(self, key: Union[list, str], default: Any = None) -> Any:
+        ''' 子序列约束搜索，规则与 KVTree.get 相同，dict/list 结果以 KVView 返回
+        '''
+        val = self._lookup(key)
+        return self._wrap(val) if val else default
+
+    def lookup(self, key: Union[list, str], default: Any = None) -> Any:
+        ''' 与 get 相同，但是只有找不到 (取值为 None) 的时候才返回 default，0、False、"" 等取值原样返回
+        '''
+        val = self._lookup(key)
+        return self._wrap(val) if val is not None else default
+
+    def __getitem__(self, key: Union[list, str]) -> Any:
+        res = self.get(key)
+        if res is None:
+            raise KeyError(f"Key: {key} was Not Found!")
+        return res
+
+    def __contains__(self, key: Union[list, str]) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data) if isinstance(self._data, (dict, list)) else 0
+
+    def __iter__(self) -> Iterator:
+        if isinstance(self._data, dict):
+            return iter(self._data)
+        if isinstance(self._data, list):
+            return (self._wrap(self._resolve(item)) for item in self._data)
+        return iter(())
+
+    def keys(self):
+        return self._data.keys() if isinstance(self._data, dict) else ()
+
+    def items(self) -> Iterator:
+        ''' 顶层的 (key, value)，value 按需解析，dict/list 以 KVView 返回 '''
+        if isinstance(self._data, dict):
+            for key, value in self._data.items():
+                yield key, self._wrap(self._resolve(value))
+
+    def materialize(self) -> Any:
+        ''' 返回完全展开之后的深拷贝 (不修改原始数据)，可以用来构造 KVTree 或者序列化 '''
+        root = self._resolve(self._data)
+        if not isinstance(root, (dict, list)):
+            return root
+
+        result = {} if isinstance(root, dict) else []
+        stack = [(root, result)]
+        while stack:
+            source, target = stack.pop()
+            for key, value in (source.items() if isinstance(source, dict) else enumerate(source)):
+                value = self._resolve(value)
+                if isinstance(value, (dict, list)):
+                    copied = {} if isinstance(value, dict) else []
+                    stack.append((value, copied))
+                    value = copied
+                if isinstance(target, dict):
+                    target[key] = value
+                else:
+                    target.append(value)
+        return result
+
+    def __repr__(self):
+        return f"KVView({self._data!r})"
@@ -0,0 +1,259 @@
+import os
+import types
+
+from typing import Callable, Optional
+from collections import OrderedDict
+
+from tracespantree.utils.instrument import PhaseStats
+from tracespantree.collections.spanhash import _digest, payload_digest
+from tracespantree.collections.spanquery import SpanQuery
+
+
+""" 跨 trace 的抽取结果缓存 (ExtractionMemo):
+    - 同一个下游 span 带着相同的负载会出现在大量 trace 里面，batch_retrieve 对每一棵树都要重新做 span 内部搜索并执行回调
+    - 缓存的 key 为 (配置项指纹, 命中 span 的负载摘要): 配置项指纹覆盖 target_span_name、idx、is_type、sep 以及每个字段的
+      名称/路径/默认值/回调，负载摘要忽略 schema 的 id 字段 (span_id、parent_id 等每个 trace 都不同的字段)，
+      但是字段路径能够取到的 id 字段 (e.g. 直接抓取 span_id) 计入摘要
+    - 回调的指纹只包含跨进程稳定的信息: 闭包变量、partial 的参数、绑定方法的对象只允许是普通的值 (数字、字符串以及由它们组成的容器)，
+      否则 (e.g. 闭包里面引用了任意对象、可调用的实例) 认为无法指纹化，对应的配置项不使用缓存
+    - value 为这个配置项抓取到的 {字段名: 取值}，命中时跳过 span 内部搜索与回调，只保留 span 之间的搜索 (需要找到 span 才能计算摘要)
+    - LRU 淘汰，条目数有上限；可以用 pickle 持久化到磁盘，下次启动时加载
+
+    注意: 缓存假设回调是纯函数 (输出只取决于输入)；命中时返回的取值与缓存共享，应当视为只读。
+"""
+
+
+_FORMAT_VERSION = 1
+
+
+def _code_fingerprint(code) -> list:
+    # co_consts 里面嵌套的 code 对象 (e.g. lambda 里面的推导式) 递归展开，避免 repr 里面出现内存地址
+    parts = [code.co_code.hex(), repr(code.co_names)]
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            parts.extend(_code_fingerprint(const))
+        else:
+            parts.append(repr(const))
+    return parts
+
+
+_PLAIN_TYPES = (type(None), bool, int, float, complex, str, bytes)
+
+# 没有字节码、行为只取决于名称的可调用对象 (内置函数、类型、方法描述符)
+_NAMED_CALLABLES = (type, types.BuiltinFunctionType, types.MethodDescriptorType, types.WrapperDescriptorType,
+                    types.MethodWrapperType, types.ClassMethodDescriptorType)
+
+
+def _plain_repr(value) -> Optional[str]:
+    ''' 普通的值 (标量以及由标量组成的 tuple/list/set/dict) 的 repr，repr 里面不会出现内存地址；其它对象返回 None
+    '''
+    if isinstance(value, _PLAIN_TYPES):
+        return repr(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        items = [_plain_repr(item) for item in value]
+        if None in items:
+            return None
+        if isinstance(value, (set, frozenset)):
+            items.sort()
+        return f"{type(value).__name__}({', '.join(items)})"
+    if isinstance(value, dict):
+        items = [(_plain_repr(key), _plain_repr(item)) for key, item in value.items()]
+        if any(key is None or item is None for key, item in items):
+            return None
+        return "dict(" + ", ".join(f"{key}: {item}" for key, item in sorted(items)) + ")"
+    return None
+
+
+def callable_fingerprint(fn: Optional[Callable]) -> Optional[str]:
+    ''' 回调的指纹: 模块 + 限定名 + 字节码 + 常量 + 闭包变量，同一个回调在不同进程里面得到相同的指纹
+        闭包变量、partial 的参数或者绑定的对象不是普通的值 (repr 不稳定，行为也可能随对象状态变化) 时返回 None，表示无法指纹化
+    '''
+    if fn is None:
+        return "-"
+    func = getattr(fn, "func", None)
+    if func is not None and hasattr(fn, "args"):
+        # functools.partial
+        parts = (callable_fingerprint(func), _plain_repr(fn.args), _plain_repr(fn.keywords or {}))
+        return None if None in parts else _digest("partial", *parts)
+
+    owner = getattr(fn, "__self__", None)
+    owner_repr = ""
+    if owner is not None and not isinstance(owner, types.ModuleType):
+        # 绑定方法的结果取决于绑定的对象
+        owner_repr = _plain_repr(owner)
+        if owner_repr is None:
+            return None
+
+    name = f"{getattr(fn, '__module__', None)}.{getattr(fn, '__qualname__', type(fn).__qualname__)}"
+    code = getattr(fn, "__code__", None)
+    if code is None:
+        # 可调用的实例的行为取决于实例的状态，无法指纹化
+        return _digest(name, owner_repr) if isinstance(fn, _NAMED_CALLABLES) else None
+
+    closure = []
+    for cell in (fn.__closure__ or ()):
+        try:
+            contents = _plain_repr(cell.cell_contents)
+        except ValueError:
+            # 还没有赋值的闭包变量
+            contents = "<empty>"
+        if contents is None:
+            return None
+        closure.append(contents)
+    return _digest(name, owner_repr, *_code_fingerprint(code), *closure)
+
+
+class ExtractionMemo:
+    ''' 在多棵 SpanTree 之间共享的抽取结果缓存，传给 batch_retrieve(configs, memo=memo) 使用:
+
+        memo = ExtractionMemo(max_entries=100000, path="extract.memo")
+        for trace in traces:
+            rows.append(SpanTree(trace=trace).batch_retrieve(configs, memo=memo))
+        memo.save()
+        memo.counters()     # {"hits": ..., "misses": ..., "hit_ratio": ..., ...}
+
+    :param max_entries: 最多缓存多少个条目，超出时淘汰最久没有使用的条目
+    :param path:        持久化文件路径，文件存在时在构造的时候加载，save() 默认写回这个文件
+    '''
+
+    def __init__(self, max_entries: int = 100000, path: str = None):
+        if max_entries <= 0:
+            raise ValueError(f"max_entries must be positive, but got {max_entries}.")
+        self.max_entries = max_entries
+        self.path        = path
+        self.stats       = PhaseStats()
+
+        self._entries  = OrderedDict()      # (配置项指纹, 负载摘要) -> {字段名: 取值}，按最近一次使用排序
+        self._callback = {}                 # 回调 -> 指纹
+        self._configs  = {}                 # (id(配置项), target_span_name, sep) -> (配置项, 指纹)，同一份配置在每棵树上只计算一次指纹
+
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # ------------------------------------------------------------ key
+
+    def _callback_fingerprint(self, fn: Optional[Callable]) -> Optional[str]:
+        try:
+            if fn in self._callback:
+                return self._callback[fn]
+        except TypeError:
+            return callable_fingerprint(fn)
+        fingerprint = self._callback[fn] = callable_fingerprint(fn)
+        return fingerprint
+
+    def entry_fingerprint(self, target_span_name, cfg: dict, sep: str, target_fields: list) -> Optional[str]:
+        ''' 按配置项对象缓存 config_fingerprint 的结果，配置项需要在使用期间保持不变 (修改配置请传入新的字典)，
+            返回 None 表示配置项里面有无法指纹化的回调，不能使用缓存
+        '''
+        try:
+            key = (id(cfg), target_span_name, sep)
+            cached = self._configs.get(key)
+        except TypeError:
+            # target_span_name 为 list，不可哈希
+            key, cached = None, None
+        if cached is not None and cached[0] is cfg:
+            return cached[1]
+
+        fingerprint = self.config_fingerprint(target_span_name, cfg.get("idx", None), cfg.get("is_type", False), sep, target_fields)
+        if key is not None:
+            self._configs[key] = (cfg, fingerprint)
+        return fingerprint
+
+    def config_fingerprint(self, target_span_name, idx, is_type, sep: str, target_fields: list) -> Optional[str]:
+        ''' 一个配置项的指纹，target_fields 为 batch_retrieve 规范化之后的 [(字段名, 字段路径, 默认值, 回调), ...]，
+            有无法指纹化的回调时返回 None
+        '''
+        target = f"query:{target_span_name.source}" if isinstance(target_span_name, SpanQuery) else repr(target_span_name)
+        parts = [target, repr(idx), repr(is_type), sep]
+        for diy_name, field, default, callback in target_fields:
+            callback_fingerprint = self._callback_fingerprint(callback)
+            if callback_fingerprint is None:
+                return None
+            parts.extend((repr(diy_name), repr(field), repr(default), callback_fingerprint))
+        return _digest(*parts)
+
+    @staticmethod
+    def span_digest(span: dict, ignore_keys=()) -> str:
+        return payload_digest(span, ignore_keys)
+
+    # ------------------------------------------------------------ 读写
+
+    def get(self, key: tuple) -> Optional[dict]:
+        values = self._entries.get(key)
+        if values is None:
+            self.stats.incr("misses")
+            return None
+        self._entries.move_to_end(key)
+        self.stats.incr("hits")
+        return values
+
+    def put(self, key: tuple, values: dict) -> None:
+        entries = self._entries
+        entries[key] = values
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.stats.incr("evictions")
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def counters(self) -> dict:
+        ''' 命中次数、未命中次数、命中率、淘汰次数、因为回调无法指纹化而跳过缓存的次数与当前条目数 '''
+        counters = self.stats.counters
+        hits, misses = counters["hits"], counters["misses"]
+        return {
+            "hits":      hits,
+            "misses":    misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            "evictions": counters["evictions"],
+            "skips":     counters["skips"],
+            "entries":   len(self._entries),
+        }
+
+    # ------------------------------------------------------------ 持久化
+
+    def save(self, path: str = None) -> str:
+        ''' 把缓存写入磁盘 (先写临时文件再替换，写入过程中断不会损坏原有文件)，无法 pickle 的条目会被跳过
+        '''
+        import pickle
+
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path given to save the extraction memo.")
+
+        entries = self._entries
+        try:
+            payload = pickle.dumps((_FORMAT_VERSION, entries), protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            picklable = OrderedDict()
+            for key, values in entries.items():
+                try:
+                    pickle.dumps(values)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    continue
+                picklable[key] = values
+            payload = pickle.dumps((_FORMAT_VERSION, picklable), protocol=pickle.HIGHEST_PROTOCOL)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        return path
+
+    def load(self, path: str = None) -> "ExtractionMemo":
+        ''' 从磁盘加载缓存并合并进当前缓存 (超出 max_entries 的部分按 LRU 淘汰)，版本不一致的文件直接忽略
+        '''
+        import pickle
+
+        path = path or self.path
+        with open(path, "rb") as f:
+            version, entries = pickle.load(f)
+        if version != _FORMAT_VERSION:
+            return self
+        for key, values in entries.items():
+            self.put(key, values)
+        return self
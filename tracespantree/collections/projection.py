@@ -0,0 +1,299 @@
+import json
+
+from typing import Any, Callable, Iterable, Optional, Union
+
+from tracespantree.collections.kvtree import KVTree, looks_like_json_container
+from tracespantree.collections.adapters import SpanSchema
+from tracespantree.collections.spanquery import SpanQuery, as_query
+
+
+""" 投影下推 (projection pushdown): 建树之前按照抓取配置裁剪 span，而不是先展开全部负载再去抓取
+    - 名称/类型不可能被配置命中的 span 只保留骨架 (schema.skeleton_fields: 拓扑、类型、时间戳与状态码)
+    - 可能被命中的 span 上按照 _recursive_inner_search 的规则重放一遍搜索 (深度优先、取第一个命中、不回溯、idx 约束)，
+      只保留搜索经过的命中路径与最终取到的值，解析 (字符串化 JSON) 只发生在搜索真正访问到的位置
+    - 投影之后的 span 是完整 span 的子集 (字典保持键的顺序，list 里面被裁掉的元素替换为 None，长度不变)，
+      并且保留了每一次命中，以及挡住搜索的取值为 None 的同名字段，因此对投影之后的 span 抓取与对完整 span 抓取的结果相同
+
+    展开规则有两种: 直接传入 spans 时与 expand_span 相同 (只解析字典里面的字符串化 JSON，解析出来的 list 不再展开)；
+    传入 trace 时不投影的话整个 trace 会先经过 KVTree.expand (任意位置的字符串化 JSON 都会解析)，此时 deep 为 True。
+
+    字段路径表示为 (parts, idx, exact)，exact 为 True 时 parts 是从 span 出发的精确路径 (骨架字段)，
+    否则按照 _recursive_inner_search 的子序列规则搜索；parts 为空表示保留整个值。
+"""
+
+
+_WHOLE = ((), None, False)         # 保留整个值
+
+
+def _field_parts(field: Union[str, list, tuple], sep: str) -> tuple:
+    if isinstance(field, (list, tuple)):
+        return tuple(field)
+    return tuple(field.split(sep))
+
+
+def _expand_whole(value: Any, parse: bool, expand: Callable) -> Any:
+    ''' 与 SpanTree.expand_span 对同一个位置上的值的处理相同: 字典的字符串取值尝试解析成 JSON，
+        list 只展开直接的字典元素，parse 为 False 表示这个位置在 expand_span 里面不会被展开
+    '''
+    if not parse:
+        return value
+    if isinstance(value, str):
+        if not looks_like_json_container(value):
+            return value
+        try:
+            parsed = json.loads(value)
+        except json.JSONDecodeError:
+            return value
+        return expand(parsed) if isinstance(parsed, (dict, list)) else value
+    if isinstance(value, dict):
+        return expand(value)
+    if isinstance(value, list):
+        return [expand(item) if isinstance(item, dict) else item for item in value]
+    return value
+
+
+class _Pruner:
+    ''' 一个 span 的一次投影: 在按需展开的 span 上重放搜索，记录需要保留的位置，最后只物化这些位置
+
+        - 每个容器的子节点只展开一次 (_kids 按 id 缓存，解析出来的对象由缓存持有，id 在投影期间保持唯一)
+        - keep:  id(容器) -> 需要保留的 key / 下标
+        - whole: id(容器) -> 需要完整保留 (并展开) 的容器
+    '''
+
+    __slots__ = ("expand", "deep", "_kids", "keep", "whole")
+
+    def __init__(self, expand: Callable, deep: bool = False):
+        self.expand = expand
+        self.deep   = deep
+        self._kids  = {}
+        self.keep   = {}
+        self.whole  = {}
+
+    @staticmethod
+    def _parse(value: str):
+        if not looks_like_json_container(value):
+            return None
+        try:
+            parsed = json.loads(value)
+        except json.JSONDecodeError:
+            return None
+        return parsed if isinstance(parsed, (dict, list)) else None
+
+    def kids(self, node, parse: bool) -> list:
+        ''' 与 expand_span (deep 时与 KVTree.expand) 一致地展开一层，返回 [(key, 子节点, 子节点是否会被展开), ...] '''
+        kids = self._kids.get(id(node))
+        if kids is not None:
+            return kids
+        kids, deep = [], self.deep
+        if isinstance(node, dict):
+            for key, child in node.items():
+                child_parse = parse
+                if parse and isinstance(child, str):
+                    parsed = self._parse(child)
+                    if parsed is not None:
+                        # 解析出来的 list 在 expand_span 里面不会继续展开
+                        child, child_parse = parsed, deep or isinstance(parsed, dict)
+                kids.append((key, child, child_parse))
+        else:
+            for i, item in enumerate(node):
+                if deep:
+                    parsed = self._parse(item) if isinstance(item, str) else None
+                    kids.append((i, item if parsed is None else parsed, True))
+                else:
+                    kids.append((i, item, parse and isinstance(item, dict)))
+        self._kids[id(node)] = kids
+        return kids
+
+    def mark(self, node, key) -> None:
+        self.keep.setdefault(id(node), set()).add(key)
+
+    def search(self, node, parse: bool, part, idx: Optional[int]) -> tuple:
+        ''' 重放 SpanTree._where_inner_subtree，返回 (命中的值, 是否会被展开, 是否标记了需要保留的位置)，没有命中时值为 None
+            取值为 None 的同名字段会让搜索在这个字典里面结束 (不再访问其它子树)，需要原样保留
+        '''
+        if isinstance(node, dict):
+            kids = self.kids(node, parse)
+            for key, child, child_parse in kids:
+                if key == part:
+                    self.mark(node, key)
+                    return child, child_parse, True
+        elif isinstance(node, list):
+            kids = self.kids(node, parse)
+            size = len(node)
+            if idx is not None and -idx <= size and idx < size:
+                kids = [kids[idx]]
+        else:
+            return None, False, False
+
+        touched = False
+        for key, child, child_parse in kids:
+            value, value_parse, marked = self.search(child, child_parse, part, idx)
+            if marked:
+                self.mark(node, key)
+                touched = True
+            if value is not None:
+                return value, value_parse, True
+        return None, False, touched
+
+    def trace(self, root: dict, parts: tuple, idx: Optional[int], exact: bool) -> None:
+        ''' 按 _recursive_inner_search 的规则沿着 parts 逐段搜索，保留最终取到的值 (容器完整保留) '''
+        node, parse = root, True
+        for part in parts:
+            if node is None or not isinstance(node, (list, dict)):
+                break
+            if exact:
+                if not isinstance(node, dict):
+                    return
+                for key, child, child_parse in self.kids(node, parse):
+                    if key == part:
+                        self.mark(node, key)
+                        node, parse = child, child_parse
+                        break
+                else:
+                    return
+            else:
+                node, parse, _ = self.search(node, parse, part, idx)
+        if isinstance(node, (dict, list)):
+            self.whole[id(node)] = (node, parse)
+
+    def build(self, node, parse: bool) -> Any:
+        whole = self.whole.get(id(node))
+        if whole is not None:
+            if self.deep:
+                return self.expand(KVTree.expand(node))
+            return _expand_whole(node, parse, self.expand)
+        keys = self.keep.get(id(node), ())
+        if isinstance(node, dict):
+            kept = {}
+            for key, child, child_parse in self.kids(node, parse):
+                if key in keys:
+                    kept[key] = self.build(child, child_parse) if isinstance(child, (dict, list)) else child
+            return kept
+        # 被裁掉的元素替换为 None，保证长度与 idx 下标不变
+        kept = [None] * len(node)
+        if keys:
+            for i, item, item_parse in self.kids(node, parse):
+                if i in keys:
+                    kept[i] = self.build(item, item_parse) if isinstance(item, (dict, list)) else item
+        return kept
+
+
+class SpanProjection:
+    ''' 按抓取配置 / 查询裁剪 span，传给 SpanTree(projection=...) 之后在建树的时候生效:
+
+        projection = SpanProjection(configs)
+        tree = SpanTree(trace=trace, projection=projection)
+        tree.batch_retrieve(configs)
+
+    :param configs: batch_retrieve 的抓取配置，目标 span (路径的最后一个名称/类型，或者 SpanQuery 的最后一个 step) 只保留 target_fields
+    :param queries: SpanQuery 或者查询字符串，被查询命中的 span 保留完整负载，谓词用到的字段在对应 step 可能命中的 span 上保留
+    :param sep:     字段与 span 路径的分隔符，需要与 SpanTree 的 sep 相同
+    '''
+
+    def __init__(self, configs: dict = None, queries: Iterable[Union[str, SpanQuery]] = (), sep: str = '.'):
+        self.sep      = sep
+        self.by_name  = {}      # span name -> {字段路径}
+        self.by_type  = {}      # span type -> {字段路径}
+        self.patterns = []      # [(step, {字段路径})]，通配符、正则或者任意名称的 step，逐个 span 匹配
+
+        if configs:
+            self.add_config(configs)
+        for query in queries:
+            self.add_query(query)
+
+    def _add(self, key, by_type: bool, paths: set):
+        index = self.by_type if by_type else self.by_name
+        index.setdefault(key, set()).update(paths)
+
+    def _add_step(self, step, paths: set):
+        if step.exact is not None:
+            self._add(step.exact, step.by_type, paths)
+        else:
+            self.patterns.append((step, set(paths)))
+
+    def add_config(self, configs: dict) -> "SpanProjection":
+        ''' 合并一份 batch_retrieve 抓取配置 (格式详见 SpanTree.batch_retrieve) '''
+        for target_span_name, cfg in configs.items():
+            idx = cfg.get("idx", None)
+            target_fields = cfg.get("target_fields", [])
+            if isinstance(target_fields, dict):
+                target_fields = list(target_fields.values())
+            paths = {(_field_parts(field[0], self.sep), idx, False) for field in target_fields}
+
+            if isinstance(target_span_name, SpanQuery):
+                self.add_query(target_span_name, paths)
+                continue
+
+            parts = target_span_name if isinstance(target_span_name, list) else target_span_name.split(self.sep)
+            is_type = cfg.get("is_type", False)
+            is_types = is_type if isinstance(is_type, list) else [is_type] * len(parts)
+            # 与 _recursive_inter_search 相同，路径与 is_type 按较短的一方对齐
+            last = min(len(parts), len(is_types)) - 1
+            if last >= 0:
+                self._add(parts[last], bool(is_types[last]), paths)
+        return self
+
+    def add_query(self, query: Union[str, SpanQuery], paths: set = None) -> "SpanProjection":
+        ''' 合并一个查询: 最后一个 step 可能命中的 span 保留 paths (默认保留完整负载)，每个 step 保留谓词用到的字段 '''
+        query = as_query(query)
+        last = len(query.steps) - 1
+        for i, step in enumerate(query.steps):
+            step_paths = {(_field_parts(predicate.field, self.sep), None, False)
+                          for predicate in step.predicates if not predicate.field.startswith("@")}
+            if i == last:
+                step_paths |= paths if paths is not None else {_WHOLE}
+            if step_paths:
+                self._add_step(step, step_paths)
+        return self
+
+    def paths_for(self, span: dict, schema: SpanSchema) -> set:
+        ''' span 可能被抓取的所有字段路径，空集合表示这个 span 只需要骨架 '''
+        name = schema.name(span)
+        paths = set(self.by_name.get(name, ()))
+        span_type = None
+        if self.by_type or any(step.by_type for step, _ in self.patterns):
+            span_type = schema.span_type(span)
+            paths |= self.by_type.get(span_type, set())
+        for step, step_paths in self.patterns:
+            if step.match_key(span_type if step.by_type else name):
+                paths |= step_paths
+        return paths
+
+    def project(self, span: dict, schema: SpanSchema, expand: Callable[[Any], Any], deep: bool = False) -> dict:
+        ''' 返回投影 (并展开) 之后的 span，需要保留完整负载的 span 原地展开，与不做投影时相同
+
+        :param span:   原始 span
+        :param schema: span 的字段布局，提供骨架字段与属性列表的展开方式
+        :param expand: 展开完整保留的子树使用的函数 (SpanTree.expand_span)
+        :param deep:   按照 KVTree.expand 的规则展开 (不投影时整个 trace 会先经过 KVTree.expand)
+        '''
+        if deep and isinstance(span, str):
+            span = KVTree.expand(span)
+        if not isinstance(span, dict):
+            return span
+
+        paths = self.paths_for(span, schema)
+        if _WHOLE in paths:
+            return expand(KVTree.expand(span) if deep else span)
+
+        # 搜索总是在属性列表展开成字典之后进行，复制一份再展开，不修改调用方的 span
+        span = schema.flatten_attributes(dict(span))
+        pruner = _Pruner(expand, deep)
+        for field in schema.skeleton_fields:
+            pruner.trace(span, field, None, True)
+        for parts, idx, exact in paths:
+            pruner.trace(span, parts, idx, exact)
+        return pruner.build(span, True)
+
+
+def as_projection(projection: Union[SpanProjection, dict, str, SpanQuery, list, None], sep: str = '.') -> Optional[SpanProjection]:
+    ''' 抓取配置、查询 (或者查询列表) 转换成 SpanProjection，None 表示不做投影 '''
+    if projection is None or isinstance(projection, SpanProjection):
+        return projection
+    if isinstance(projection, dict):
+        return SpanProjection(configs=projection, sep=sep)
+    if isinstance(projection, (str, SpanQuery)):
+        return SpanProjection(queries=[projection], sep=sep)
+    if isinstance(projection, (list, tuple)):
+        return SpanProjection(queries=projection, sep=sep)
+    raise TypeError(f"Expected projection to be a batch_retrieve config, a query or a SpanProjection, but got {type(projection).__name__}.")
@@ -0,0 +1,166 @@
+from typing import Iterable
+
+from tracespantree.collections.kvtree import KVTree
+from tracespantree.collections.spanhash import DEFAULT_IGNORE_FIELDS, flatten_fields, subtree_hashes
+
+
+class SpanTreeDiff:
+    ''' 两棵 SpanTree 的结构化差异，所有路径都是从树根开始的 span name 路径 (使用树的 sep 拼接)，
+        同名兄弟节点按照原始顺序编号，第 k (k >= 1) 个重名节点写作 name[k]
+
+        - added:   新树里面多出来的子树 [(path, span_id), ...]，只记录子树的根
+        - removed: 旧树里面消失的子树 [(path, span_id), ...]，只记录子树的根
+        - moved:   整棵子树原样出现在另一个位置 [(old_path, new_path, old_span_id, new_span_id), ...]
+        - changed: 对齐之后字段有变化的 span [(path, old_span_id, new_span_id, fields), ...]，
+                   fields 是一个 KVTree，结构与 span 相同，叶子节点是 (old, new) 二元组 (字段缺失记为 None)，
+                   因此可以使用子序列约束查询字段的变化，例如 fields.get("data.message")
+    '''
+
+    def __init__(self):
+        self.added   = []
+        self.removed = []
+        self.moved   = []
+        self.changed = []
+
+    @property
+    def is_identical(self) -> bool:
+        return not (self.added or self.removed or self.moved or self.changed)
+
+    def __bool__(self):
+        return not self.is_identical
+
+    def to_dict(self) -> dict:
+        return {
+            "added":   [{"path": path, "span_id": span_id} for path, span_id in self.added],
+            "removed": [{"path": path, "span_id": span_id} for path, span_id in self.removed],
+            "moved":   [{"old_path": old_path, "new_path": new_path, "old_span_id": old_id, "new_span_id": new_id}
+                        for old_path, new_path, old_id, new_id in self.moved],
+            "changed": [{"path": path, "old_span_id": old_id, "new_span_id": new_id,
+                         "fields": {field: {"old": old, "new": new} for field, (old, new) in _leaf_changes(fields.data, fields.sep).items()}}
+                        for path, old_id, new_id, fields in self.changed],
+        }
+
+    def summary(self) -> str:
+        lines = []
+        lines.extend(f"+ {path}" for path, _ in self.added)
+        lines.extend(f"- {path}" for path, _ in self.removed)
+        lines.extend(f"~ {old_path} -> {new_path}" for old_path, new_path, _, _ in self.moved)
+        for path, _, _, fields in self.changed:
+            lines.append(f"* {path}")
+            for field, (old, new) in sorted(_leaf_changes(fields.data, fields.sep).items()):
+                lines.append(f"    {field}: {old!r} -> {new!r}")
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.summary() or "<identical>"
+
+
+def _leaf_changes(nested: dict, sep: str) -> dict:
+    changes, stack = {}, [("", nested)]
+    while stack:
+        prefix, node = stack.pop()
+        if isinstance(node, tuple):
+            changes[prefix] = node
+            continue
+        for key, child in node.items():
+            stack.append((f"{prefix}{sep}{key}" if prefix else key, child))
+    return changes
+
+
+def _field_changes(old_span: dict, new_span: dict, sep: str, ignore_fields) -> KVTree:
+    old_flat = flatten_fields(old_span, sep, ignore_fields)
+    new_flat = flatten_fields(new_span, sep, ignore_fields)
+
+    nested = {}
+    for path in old_flat.keys() | new_flat.keys():
+        old, new = old_flat.get(path), new_flat.get(path)
+        if path in old_flat and path in new_flat and old == new and type(old) is type(new):
+            continue
+
+        node, parts = nested, path.split(sep)
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = (old, new)
+
+    return KVTree(nested, sep=sep)
+
+
+def _align(tree, span_ids: Iterable, position: dict) -> dict:
+    ''' 把兄弟节点按照 (name, 同名序号) 分组，同名节点按照原始顺序编号
+    '''
+    keyed, seen = {}, {}
+    for span_id in sorted(span_ids, key=position.__getitem__):
+        name = tree.schema.name(tree.span_map[span_id])
+        k = seen.get(name, 0)
+        seen[name] = k + 1
+        keyed[(name, k)] = span_id
+    return keyed
+
+
+def _join(prefix: str, key: tuple, sep: str) -> str:
+    name, k = key
+    step = f"{name}[{k}]" if k else f"{name}"
+    return f"{prefix}{sep}{step}" if prefix else step
+
+
+def diff_trees(old_tree, new_tree, ignore_fields: Iterable[str] = DEFAULT_IGNORE_FIELDS) -> SpanTreeDiff:
+    ''' 比较两棵 SpanTree，先分别计算子树哈希，按照 name 路径对齐之后，子树哈希相同的节点直接跳过整棵子树，
+        因此整体复杂度与树的规模近似线性，而不是两两比较
+    '''
+    if ignore_fields is DEFAULT_IGNORE_FIELDS:
+        ignore_fields = old_tree.schema.id_fields + new_tree.schema.id_fields
+    ignore_fields = tuple(ignore_fields or ())
+    sep = old_tree.sep
+    old_hash, old_content = subtree_hashes(old_tree, ignore_fields)
+    new_hash, new_content = subtree_hashes(new_tree, ignore_fields)
+    old_pos = {span_id: i for i, span_id in enumerate(old_tree.span_map)}
+    new_pos = {span_id: i for i, span_id in enumerate(new_tree.span_map)}
+
+    result = SpanTreeDiff()
+    stack = [("", old_tree.get_components(), new_tree.get_components())]
+    while stack:
+        prefix, old_ids, new_ids = stack.pop()
+        old_keyed = _align(old_tree, old_ids, old_pos)
+        new_keyed = _align(new_tree, new_ids, new_pos)
+
+        for key, old_id in old_keyed.items():
+            path = _join(prefix, key, sep)
+            new_id = new_keyed.get(key)
+            if new_id is None:
+                result.removed.append((path, old_id))
+                continue
+            if old_hash[old_id] == new_hash[new_id]:
+                continue
+
+            if old_content[old_id] != new_content[new_id]:
+                fields = _field_changes(old_tree.span_map[old_id], new_tree.span_map[new_id], sep, ignore_fields)
+                result.changed.append((path, old_id, new_id, fields))
+
+            stack.append((path,
+                          [child_id for child_id in old_tree.sons.get(old_id, ()) if child_id in old_tree.span_map],
+                          [child_id for child_id in new_tree.sons.get(new_id, ()) if child_id in new_tree.span_map]))
+
+        for key, new_id in new_keyed.items():
+            if key not in old_keyed:
+                result.added.append((_join(prefix, key, sep), new_id))
+
+    # 删除与新增的子树如果哈希相同，说明是整棵子树移动了位置
+    removed_by_hash = {}
+    for path, old_id in result.removed:
+        removed_by_hash.setdefault(old_hash[old_id], []).append((path, old_id))
+
+    added, moved_old = [], set()
+    for path, new_id in result.added:
+        candidates = removed_by_hash.get(new_hash[new_id])
+        if candidates:
+            old_path, old_id = candidates.pop(0)
+            moved_old.add(old_id)
+            result.moved.append((old_path, path, old_id, new_id))
+        else:
+            added.append((path, new_id))
+
+    result.added = sorted(added)
+    result.removed = sorted((path, old_id) for path, old_id in result.removed if old_id not in moved_old)
+    result.moved.sort()
+    result.changed.sort(key=lambda item: item[0])
+    return result
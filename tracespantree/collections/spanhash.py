@@ -0,0 +1,229 @@
+import sys
+import json
+import hashlib
+
+from typing import Any, Iterable
+
+
+""" span 内容哈希与子树 (Merkle) 哈希:
+    - 内容哈希: span 展开之后拍平成 "字段路径 -> 叶子值"，忽略指定字段之后对排好序的字段做哈希，
+      与字段书写顺序无关，并且跨进程稳定 (不依赖 Python 内置的 hash)
+    - 子树哈希: H(name, 内容哈希, 排好序的孩子子树哈希)，两棵子树哈希相同即可认为整棵子树相同
+"""
+
+
+DEFAULT_IGNORE_FIELDS = ("span_id", "parent_id")
+
+
+def _digest(*parts: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode("utf-8", "surrogatepass"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def _canonical(value: Any) -> str:
+    try:
+        return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    except (TypeError, ValueError):
+        return repr(value)
+
+
+def is_ignored(path: str, ignore_fields: Iterable[str], sep: str = '.') -> bool:
+    ''' ignore_fields 里面的字段如果包含 sep，视为从 span 顶层开始的完整路径 (同时忽略其下所有字段)，
+        否则视为一个 key，任意层级出现这个 key 都会被忽略
+    '''
+    parts = None
+    for field in ignore_fields:
+        if sep in field:
+            if path == field or path.startswith(field + sep):
+                return True
+        else:
+            if parts is None:
+                parts = path.split(sep)
+            if field in parts:
+                return True
+    return False
+
+
+def flatten_fields(payload: Any, sep: str = '.', ignore_fields: Iterable[str] = DEFAULT_IGNORE_FIELDS) -> dict:
+    ''' 把展开之后的 span 拍平成 {字段路径: 叶子值}，列表元素使用下标作为路径的一部分，空 dict/list 也视为叶子
+    '''
+    ignore_fields = tuple(ignore_fields or ())
+    flat, stack = {}, [("", payload)]
+    while stack:
+        prefix, value = stack.pop()
+        if isinstance(value, dict) and value:
+            items = value.items()
+        elif isinstance(value, list) and value:
+            items = enumerate(value)
+        else:
+            if prefix:
+                flat[prefix] = value
+            continue
+
+        for key, child in items:
+            path = f"{prefix}{sep}{key}" if prefix else str(key)
+            if ignore_fields and is_ignored(path, ignore_fields, sep):
+                continue
+            stack.append((path, child))
+    return flat
+
+
+def content_hash(payload: Any, sep: str = '.', ignore_fields: Iterable[str] = DEFAULT_IGNORE_FIELDS) -> str:
+    flat = flatten_fields(payload, sep, ignore_fields)
+    return _digest(*(f"{path}={_canonical(flat[path])}" for path in sorted(flat)))
+
+
+def payload_digest(span: dict, ignore_keys: Iterable[str] = DEFAULT_IGNORE_FIELDS) -> str:
+    ''' 整个 span (忽略顶层的 ignore_keys) 的规范化 JSON 摘要，与字段书写顺序无关，跨进程稳定。
+        序列化在 C 里面完成，比 content_hash 快得多，但是只能忽略顶层字段，适合作为缓存的 key
+    '''
+    if isinstance(span, dict):
+        span = {key: value for key, value in span.items() if key not in ignore_keys}
+    return _digest(_canonical(span))
+
+
+def subtree_hashes(tree, ignore_fields: Iterable[str] = DEFAULT_IGNORE_FIELDS, with_payload: bool = True) -> tuple:
+    ''' 后序遍历计算每个 span 的子树哈希，返回 (子树哈希, 内容哈希) 两个 span_id -> hash 的字典
+
+    :param ignore_fields: 计算内容哈希时忽略的字段，规则详见 is_ignored
+    :param with_payload:  为 False 时只考虑 span name 与树结构，适合按调用模式分组
+    '''
+    span_map, sons, get_name = tree.span_map, tree.sons, tree.schema.name
+    subtree, content = {}, {}
+    if ignore_fields is DEFAULT_IGNORE_FIELDS:
+        # 默认忽略的是 span 格式 (schema) 里面的 id 字段，e.g. OTLP 的 spanId/parentSpanId/traceId
+        ignore_fields = tree.schema.id_fields
+
+    for root_id in tree.get_components():
+        stack = [(root_id, False)]
+        while stack:
+            span_id, expanded = stack.pop()
+            children = [child_id for child_id in sons.get(span_id, ()) if child_id in span_map]
+            if not expanded:
+                stack.append((span_id, True))
+                stack.extend((child_id, False) for child_id in children)
+                continue
+
+            # tags 懒展开之后会从 list 变成 dict，先统一展开，保证两棵树的哈希可以比较
+            span = tree._flatten_tags(span_map[span_id])
+            content[span_id] = content_hash(span, tree.sep, ignore_fields) if with_payload else ""
+            subtree[span_id] = _digest(str(get_name(span)), content[span_id], *sorted(subtree[child_id] for child_id in children))
+
+    return subtree, content
+
+
+class PayloadInterner:
+    ''' 对展开之后的 span 负载做 hash-consing: 相同的字符串、子字典、子列表只保留一个对象，其余位置共享引用。
+        池子里的容器按照 "孩子对象的 id" 作为 key，孩子先于父亲被驻留，因此相同的孩子必然是同一个对象，
+        判断两个容器是否相同只需要比较一层。
+
+        注意: 驻留之后的负载被多个 span 共享，应当视为只读，原地修改会同时影响所有共享这个对象的 span。
+              同一个 PayloadInterner 可以传给多棵 SpanTree，从而跨 trace 共享负载。
+    '''
+
+    def __init__(self):
+        self._pool  = {}
+        self._blobs = {}                    # 字符串化 JSON 的摘要 -> 展开并驻留之后的对象
+        self._known = set()                 # 池子里面容器的 id，这些容器 (及其孩子) 已经驻留过，不需要再遍历
+        self.hits   = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._pool)
+
+    @staticmethod
+    def _child_key(value):
+        if isinstance(value, (dict, list)):
+            return id(value)
+        return (type(value), value)
+
+    def _canonical(self, value):
+        if isinstance(value, str):
+            return sys.intern(value)
+        if not isinstance(value, (dict, list)):
+            return value
+
+        if isinstance(value, dict):
+            key = (dict, tuple((k, self._child_key(v)) for k, v in value.items()))
+        else:
+            key = (list, tuple(self._child_key(v) for v in value))
+
+        try:
+            canonical = self._pool.get(key)
+        except TypeError:
+            # 含有不可哈希的标量 (极少见)，放弃驻留
+            return value
+
+        if canonical is None:
+            self.misses += 1
+            self._pool[key] = value
+            self._known.add(id(value))
+            return value
+        self.hits += 1
+        return canonical
+
+    def intern(self, value: Any) -> Any:
+        ''' 自底向上驻留 value，返回驻留之后的对象 (value 本身或者池子里面与之相同的对象)
+        '''
+        if not isinstance(value, (dict, list)):
+            return self._canonical(value)
+        if id(value) in self._known:
+            return value
+
+        # 显式栈后序遍历，先替换孩子，再驻留容器本身
+        known = self._known
+        stack = [(value, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if not expanded:
+                stack.append((node, True))
+                children = node.values() if isinstance(node, dict) else node
+                stack.extend((child, False) for child in children if isinstance(child, (dict, list)) and id(child) not in known)
+                continue
+
+            if id(node) in known:
+                continue
+            if isinstance(node, dict):
+                for k, v in list(node.items()):
+                    node[k] = self._canonical(v)
+                # dict 的 key 也驻留，需要重建 dict 才能替换 key 对象本身
+                if any(type(k) is str for k in node):
+                    items = [(sys.intern(k) if type(k) is str else k, v) for k, v in node.items()]
+                    node.clear()
+                    node.update(items)
+            else:
+                for i, v in enumerate(node):
+                    node[i] = self._canonical(v)
+
+        return self._canonical(value)
+
+    @staticmethod
+    def _blob_key(raw: str) -> bytes:
+        return hashlib.blake2b(raw.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def get_blob(self, raw: str) -> Any:
+        ''' 查询某个字符串化 JSON 是否已经展开并驻留过，只保存摘要，不会长期持有原始字符串
+        '''
+        if not self._blobs:
+            return None
+        expanded = self._blobs.get(self._blob_key(raw))
+        if expanded is not None:
+            self.hits += 1
+        return expanded
+
+    def put_blob(self, raw: str, expanded: Any) -> Any:
+        expanded = self.intern(expanded)
+        self._blobs[self._blob_key(raw)] = expanded
+        return expanded
+
+    def intern_span(self, span: dict) -> dict:
+        ''' 驻留 span 的各个字段，span 本身 (含有唯一的 span_id) 不参与驻留，以免 tags 懒展开等原地修改互相影响
+        '''
+        if not isinstance(span, dict):
+            return span
+        for key, value in list(span.items()):
+            span[key] = self.intern(value)
+        return span
@@ -0,0 +1,426 @@
+import re
+import fnmatch
+import functools
+
+from typing import Any, Optional, Union
+
+
+""" 查询语法说明:
+    `sep` 拼接的子序列约束只能表达 "按名称/类型有序的祖先序列"，SpanQuery 在此基础上提供更丰富的选择器，
+    一个查询由若干 step 以及 step 之间的连接符构成:
+
+        query      := ['>'] step (combinator step)*
+        combinator := '>'                       直接孩子
+                    | '>>' ['{' [min] ',' [max] '}']   后代（可以约束相隔的层数），'>>{2}' 表示恰好相隔两层
+                    | 空白                       等价于 '>>'
+        step       := ['type:'] selector predicate*
+        selector   := '*'                       任意 span
+                    | name                      精确名称，名称中含有空白或 '>' 等特殊字符时使用引号 "..." 包裹
+                    | glob                      含有 '*' 或 '?' 的通配符名称，例如 fetch_*
+                    | /regex/                   正则表达式（search 语义）
+        predicate  := '[' field [op literal] ']'
+        op         := '==' | '!=' | '>' | '>=' | '<' | '<=' | '~='（正则匹配）
+
+    其中 field 与 retrieve 的 target_field 语义相同（也支持子序列约束），另外提供两个伪字段:
+        - @depth    span 所在深度，树根深度为 0
+        - @children span 孩子节点个数
+
+    query 开头的 '>' 表示第一个 step 必须是树根 (或者断链之后某个联通分量的根)。
+
+    示例:
+        'root > father_span_1 >> leaf_*'
+        'type:leaf[state_code != 0]'
+        '/^GET /[duration > 100] >>{,2} "db query"'
+"""
+
+
+class SpanQuerySyntaxError(ValueError):
+    pass
+
+
+class _Predicate:
+    ''' 单个字段谓词，字段缺失时只有 `== null` 成立
+    '''
+
+    _OPS = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        ">":  lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "<":  lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+    }
+
+    def __init__(self, field: str, op: str = None, literal: Any = None):
+        self.field   = field
+        self.op      = op
+        self.literal = literal
+        self._regex  = re.compile(str(literal)) if op == "~=" else None
+
+    def __call__(self, tree, span_id) -> bool:
+        value = self._field_value(tree, span_id)
+
+        # 只有字段名称，表示字段存在即可
+        if self.op is None:
+            return value is not None
+
+        if value is None:
+            return self.op == "==" and self.literal is None
+
+        if self._regex is not None:
+            return self._regex.search(str(value)) is not None
+
+        literal = self.literal
+        if isinstance(literal, (int, float)) and not isinstance(literal, bool) and isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                return self.op == "!="
+        try:
+            return self._OPS[self.op](value, literal)
+        except TypeError:
+            # 类型无法比较 (e.g. str > int)，视为不匹配
+            return self.op == "!="
+
+    def _field_value(self, tree, span_id):
+        if self.field == "@depth":
+            return tree.depth(span_id)
+        if self.field == "@children":
+            return len(tree.sons.get(span_id, ()))
+        span = tree._flatten_tags(tree.span_map[span_id])
+        return tree._recursive_inner_search(span, self.field)
+
+    def __repr__(self):
+        if self.op is None:
+            return f"[{self.field}]"
+        return f"[{self.field} {self.op} {self.literal!r}]"
+
+
+class _Step:
+    ''' 查询中的一步，包含选择器、谓词，以及与上一步之间允许相隔的层数 [min_gap, max_gap]
+    '''
+
+    def __init__(self, kind: str, pattern: Optional[str], by_type: bool = False):
+        self.kind       = kind              # 'any' | 'exact' | 'glob' | 'regex'
+        self.pattern    = pattern
+        self.by_type    = by_type
+        self.predicates = []
+        self.min_gap    = 1
+        self.max_gap    = None              # None 代表不限制层数
+
+        if kind == "glob":
+            self._regex = re.compile(fnmatch.translate(pattern))
+        elif kind == "regex":
+            self._regex = re.compile(pattern)
+        else:
+            self._regex = None
+
+    @property
+    def exact(self) -> Optional[str]:
+        return self.pattern if self.kind == "exact" else None
+
+    def match_key(self, key) -> bool:
+        if self.kind == "any":
+            return True
+        if key is None:
+            return False
+        if self.kind == "exact":
+            return key == self.pattern
+        if self.kind == "glob":
+            return self._regex.match(str(key)) is not None
+        return self._regex.search(str(key)) is not None
+
+    def match(self, tree, span_id) -> bool:
+        span = tree.span_map[span_id]
+        key = tree._span_type(span) if self.by_type else tree.schema.name(span)
+        if not self.match_key(key):
+            return False
+        return all(predicate(tree, span_id) for predicate in self.predicates)
+
+    def __repr__(self):
+        prefix = "type:" if self.by_type else ""
+        selector = {"any": "*", "regex": f"/{self.pattern}/"}.get(self.kind, self.pattern)
+        return f"{prefix}{selector}{''.join(map(repr, self.predicates))}"
+
+
+class _Parser:
+
+    _WORD_STOP    = set(' \t\r\n>[{"\'')
+    _PREDICATE_RE = re.compile(r'^\s*(?P<field>[^\s=!<>~]+)\s*(?:(?P<op>==|!=|>=|<=|~=|>|<)\s*(?P<literal>.+?))?\s*$', re.S)
+    _GAP_RE       = re.compile(r'^\s*(?P<min>\d*)\s*(?:(?P<comma>,)\s*(?P<max>\d*))?\s*$')
+
+    def __init__(self, source: str):
+        self.source = source
+        self.pos    = 0
+
+    def error(self, msg: str):
+        raise SpanQuerySyntaxError(f"{msg} at position {self.pos} in query {self.source!r}")
+
+    def peek(self, n: int = 1) -> str:
+        return self.source[self.pos:self.pos + n]
+
+    def skip_spaces(self) -> bool:
+        start = self.pos
+        while self.pos < len(self.source) and self.source[self.pos].isspace():
+            self.pos += 1
+        return self.pos > start
+
+    def read_until(self, closing: str, raw: bool = False) -> str:
+        ''' 读取到 closing 为止 (不含)，支持反斜杠转义，raw 模式只转义 closing 本身 (用于正则)
+        '''
+        chars = []
+        while self.pos < len(self.source):
+            ch = self.source[self.pos]
+            if ch == "\\" and self.pos + 1 < len(self.source):
+                escaped = self.source[self.pos + 1]
+                if raw and escaped != closing:
+                    chars.append(ch)
+                chars.append(escaped)
+                self.pos += 2
+                continue
+            if ch == closing:
+                self.pos += 1
+                return "".join(chars)
+            chars.append(ch)
+            self.pos += 1
+        self.error(f"Missing closing {closing!r}")
+
+    def read_bracket(self) -> str:
+        ''' 读取 [...] 之中的内容，忽略引号内部的 ']'
+        '''
+        start, quote = self.pos, None
+        while self.pos < len(self.source):
+            ch = self.source[self.pos]
+            if quote:
+                if ch == "\\":
+                    self.pos += 1
+                elif ch == quote:
+                    quote = None
+            elif ch in "\"'":
+                quote = ch
+            elif ch == "]":
+                self.pos += 1
+                return self.source[start:self.pos - 1]
+            self.pos += 1
+        self.error("Missing closing ']'")
+
+    def parse(self) -> tuple:
+        steps, anchored = [], False
+
+        self.skip_spaces()
+        if self.peek() == ">" and self.peek(2) != ">>":
+            anchored = True
+            self.pos += 1
+            self.skip_spaces()
+
+        steps.append(self.parse_step())
+        while True:
+            had_space = self.skip_spaces()
+            if self.pos >= len(self.source):
+                break
+
+            if self.peek(2) == ">>":
+                self.pos += 2
+                min_gap, max_gap = self.parse_gap()
+            elif self.peek() == ">":
+                self.pos += 1
+                min_gap, max_gap = 1, 1
+            elif had_space:
+                min_gap, max_gap = 1, None
+            else:
+                self.error("Expected combinator")
+
+            self.skip_spaces()
+            step = self.parse_step()
+            step.min_gap, step.max_gap = min_gap, max_gap
+            steps.append(step)
+
+        return steps, anchored
+
+    def parse_gap(self):
+        if self.peek() != "{":
+            return 1, None
+        self.pos += 1
+        m = self._GAP_RE.match(self.read_until("}"))
+        if m is None:
+            self.error("Invalid depth bounds")
+
+        min_gap = int(m.group("min")) if m.group("min") else 1
+        if m.group("comma"):
+            max_gap = int(m.group("max")) if m.group("max") else None
+        else:
+            max_gap = min_gap
+
+        if min_gap < 1 or (max_gap is not None and max_gap < min_gap):
+            self.error("Invalid depth bounds")
+        return min_gap, max_gap
+
+    def parse_step(self) -> _Step:
+        by_type = False
+        if self.source.startswith("type:", self.pos):
+            by_type = True
+            self.pos += len("type:")
+
+        ch = self.peek()
+        if not ch:
+            self.error("Expected span selector")
+
+        if ch in "\"'":
+            self.pos += 1
+            step = _Step("exact", self.read_until(ch), by_type)
+        elif ch == "/":
+            self.pos += 1
+            pattern = self.read_until("/", raw=True)
+            try:
+                step = _Step("regex", pattern, by_type)
+            except re.error as e:
+                self.error(f"Invalid regex {pattern!r}: {e}")
+        else:
+            start = self.pos
+            while self.pos < len(self.source) and self.source[self.pos] not in self._WORD_STOP:
+                self.pos += 1
+            word = self.source[start:self.pos]
+            if not word:
+                self.error("Expected span selector")
+
+            if word == "*":
+                step = _Step("any", None, by_type)
+            elif "*" in word or "?" in word:
+                step = _Step("glob", word, by_type)
+            else:
+                step = _Step("exact", word, by_type)
+
+        while self.peek() == "[":
+            self.pos += 1
+            step.predicates.append(self.parse_predicate(self.read_bracket()))
+        return step
+
+    def parse_predicate(self, text: str) -> _Predicate:
+        m = self._PREDICATE_RE.match(text)
+        if m is None:
+            self.error(f"Invalid predicate [{text}]")
+
+        field, op = m.group("field"), m.group("op")
+        if op is None:
+            return _Predicate(field)
+
+        literal = self.parse_literal(m.group("literal"))
+        if op == "~=":
+            try:
+                re.compile(str(literal))
+            except re.error as e:
+                self.error(f"Invalid regex {literal!r}: {e}")
+        return _Predicate(field, op, literal)
+
+    @staticmethod
+    def parse_literal(text: str) -> Any:
+        text = text.strip()
+        if len(text) >= 2 and text[0] == text[-1] and text[0] in "\"'":
+            return re.sub(r"\\(.)", r"\1", text[1:-1])
+
+        constants = {"true": True, "false": False, "null": None, "none": None}
+        if text.lower() in constants:
+            return constants[text.lower()]
+
+        for cast in (int, float):
+            try:
+                return cast(text)
+            except ValueError:
+                pass
+        return text
+
+
+class SpanQuery:
+    ''' 编译之后的 span 查询，同一个查询字符串只会编译一次 (参见 compile_query)
+
+        求值策略: 先用索引拿到最后一个 step 的候选 span (精确名称直接查 name_index)，再沿着 parent_map 向上回溯
+        验证前面的 step，回溯结果按 (span_id, step) 记忆化，避免同一个祖先被重复验证。
+    '''
+
+    def __init__(self, source: str):
+        self.source = source
+        self.steps, self.anchored = _Parser(source).parse()
+
+    def __repr__(self):
+        return f"SpanQuery({self.source!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, SpanQuery) and other.source == self.source
+
+    def __hash__(self):
+        return hash((SpanQuery, self.source))
+
+    def exact_names(self) -> Optional[set]:
+        ''' 如果每个 step 都是精确名称，返回这些名称，否则返回 None
+        '''
+        if any(step.by_type or step.exact is None for step in self.steps):
+            return None
+        return {step.exact for step in self.steps}
+
+    def _candidates(self, tree, step: _Step) -> Optional[list]:
+        if step.exact is None:
+            return None
+        index = tree.type_index if step.by_type else tree.name_index
+        return index.get(step.exact, [])
+
+    def evaluate(self, tree, limit: int = None) -> list:
+        ''' 返回树上所有匹配的 span_id，按照 span 的原始顺序排列
+        '''
+        # 任意一个精确名称的 step 在索引中不存在，直接剪枝
+        for step in self.steps:
+            if step.exact is not None and not self._candidates(tree, step):
+                return []
+
+        last = len(self.steps) - 1
+        candidates = self._candidates(tree, self.steps[last])
+        if candidates is None:
+            candidates = tree.span_map.keys()
+
+        memo, results = {}, []
+        for span_id in candidates:
+            if self._match_at(tree, span_id, last, memo):
+                results.append(span_id)
+                if limit is not None and len(results) >= limit:
+                    break
+        return results
+
+    def _match_at(self, tree, span_id, i: int, memo: dict) -> bool:
+        key = (span_id, i)
+        if key in memo:
+            return memo[key]
+
+        step = self.steps[i]
+        matched = step.match(tree, span_id)
+        if matched and i == 0:
+            matched = not self.anchored or tree.parent_map.get(span_id) not in tree.span_map
+        elif matched:
+            matched = False
+            # parent_map 可能成环，沿着 parent_map 往上走，走回已经访问过的节点时停止
+            gap, current_id, seen = 0, span_id, {span_id}
+            while step.max_gap is None or gap < step.max_gap:
+                current_id = tree.parent_map.get(current_id)
+                if current_id not in tree.span_map or current_id in seen:
+                    break
+                seen.add(current_id)
+                gap += 1
+                if gap >= step.min_gap and self._match_at(tree, current_id, i - 1, memo):
+                    matched = True
+                    break
+
+        memo[key] = matched
+        return matched
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(source: str) -> SpanQuery:
+    ''' 编译查询字符串，结果按照查询字符串缓存
+    '''
+    return SpanQuery(source)
+
+
+def as_query(query: Union[str, SpanQuery]) -> SpanQuery:
+    if isinstance(query, SpanQuery):
+        return query
+    if isinstance(query, str):
+        return compile_query(query)
+    raise TypeError(f"Expected query to be of type str or SpanQuery, but got {type(query).__name__}.")
@@ -1,14 +1,67 @@
+import io
+import sys
 import json
+import math
 import random
-import warnings
-import concurrent.futures
 
-from typing import Any, Optional, Union
+from array import array
+from typing import Any, Iterable, Iterator, Optional, TextIO, Union
 from collections.abc import Callable, Generator
 from collections import OrderedDict
 
+from tracespantree.utils import instrument as _instrument
+from tracespantree.utils.instrument import PhaseStats, perf_counter_ns, deep_sizeof
 from tracespantree.utils.decorator import try_catch
-from tracespantree.collections.kvtree import KVTree
+from tracespantree.utils.pretty import iter_pretty_lines
+from tracespantree.collections.kvtree import KVTree, looks_like_json_container
+from tracespantree.collections.kvview import KVView
+from tracespantree.collections.adapters import SpanSchema, get_schema
+from tracespantree.collections.spanquery import SpanQuery, as_query
+from tracespantree.collections.projection import SpanProjection, as_projection
+from tracespantree.collections.analytics import TraceAnalytics, analyze_tree, as_number
+from tracespantree.collections.intervals import IntervalIndex
+from tracespantree.collections.ancestry import AncestryIndex
+from tracespantree.collections.spanhash import DEFAULT_IGNORE_FIELDS, PayloadInterner, payload_digest, subtree_hashes
+from tracespantree.collections.memo import ExtractionMemo
+from tracespantree.collections.spandiff import SpanTreeDiff, diff_trees
+
+
+def _warn(msg: str, *args):
+    """ 抽取过程中的失败信息走 logging (logger 名称为 tracespantree)，可以通过 logx.logger_initiate(name="tracespantree", ...)
+        配置输出、限流与去重，只有真正出现失败的时候才导入 logging
+    """
+    import logging
+    logging.getLogger("tracespantree").warning(msg, *args, stacklevel=2)
+
+
+def _named_target_fields(target_span_name, target_fields, sep: str = '.') -> list:
+    """ batch_retrieve 的字段命名规则，返回 [(字段名, 字段路径, 默认值, 回调), ...]:
+        - target_fields 为 List 时字段名为 "目标 span 名称的最后一段 字段路径的最后一段" (SpanQuery 取最后一个 step)
+        - target_fields 为 Dict 时字段名就是 key
+    """
+    if isinstance(target_fields, list):
+        if isinstance(target_span_name, SpanQuery):
+            name_prefix = repr(target_span_name.steps[-1])
+        else:
+            name_prefix = target_span_name.split(sep)[-1]
+        return [(f"{name_prefix} {value[0].split(sep)[-1]}", *value) for value in target_fields]
+    if isinstance(target_fields, dict):
+        return [(key, *value) for key, value in target_fields.items()]
+    return target_fields
+
+
+def result_columns(configs: dict, sep: str = '.') -> list:
+    """ 抓取配置对应的结果列 (与 batch_retrieve 返回的字典的 key 顺序相同)，用来在写出结果之前确定表头，
+        重名的字段只保留第一次出现的位置，没有 target_fields 的配置项不产生任何列
+    """
+    columns = {}
+    for target_span_name, cfg in configs.items():
+        target_fields = cfg.get("target_fields", [])
+        if not target_fields:
+            continue
+        for diy_name, *_ in _named_target_fields(target_span_name, target_fields, sep):
+            columns.setdefault(diy_name, None)
+    return list(columns)
 
 
 class SpanTree:
@@ -19,7 +72,7 @@ class SpanTree:
             self._cache_buf   = OrderedDict()  # 使用 OrderedDict 来保持插入顺序
             self._max_size    = max_size       # 设置缓存的最大大小
 
-        def cache_key(self, target_span_name: Union[str, list]):
+        def cache_key(self, target_span_name: Union[str, list, SpanQuery]):
             if isinstance(target_span_name, list):
                 return self._outter_tree.sep.join(target_span_name)
             return target_span_name
@@ -29,7 +82,7 @@ class SpanTree:
             if self._max_size <= 0 or span is None:
                 return self
             
-            cv = span.get("span_id")      
+            cv = self._outter_tree.schema.span_id(span)
             ck = self.cache_key(target_span_name)
             
             self._cache_buf[ck] = cv
@@ -42,12 +95,17 @@ class SpanTree:
 
         # 获取缓存项
         def get(self, target_span_name):
-            span_id = self._cache_buf.get(target_span_name) 
+            span_id = self._cache_buf.get(self.cache_key(target_span_name))
             return self._outter_tree.span_map.get(span_id)
         
         def is_cache(self, target_span_name):
             ckey = self.cache_key(target_span_name)
-            return ckey in self._cache_buf
+            hit = ckey in self._cache_buf
+            
+            stats = self._outter_tree._stats
+            if stats is not None:
+                stats.incr("cache_hit" if hit else "cache_miss")
+            return hit
         
     
     def __init__(self, spans: list = None, 
@@ -55,7 +113,11 @@ class SpanTree:
                        super_id: str = None,
                        sep: str = '.', 
                        keymaps: dict = None,
-                       cache_size = 32):
+                       cache_size = 32,
+                       intern: Union[bool, PayloadInterner] = False,
+                       instrument: bool = None,
+                       schema: Union[str, SpanSchema] = None,
+                       projection: Union[dict, str, SpanQuery, SpanProjection] = None):
         """ 用户只需要关心trace参数，传入Trace，自动建树，通过树上搜索增加trace抓取的灵活性
 
         :param spans:       Trace 里面的 spans 字段
@@ -65,13 +127,29 @@ class SpanTree:
         :param cache_size:  缓存区大小，默认 32
         :param keymaps:     对于每个span必须 name, span_id, parent_id，如果使用其它名称，可以自己编写映射规则，
                             这个参数主要是为了通用性，平时 Doubao/Cici Trace 分析可以忽略这个参数。
+        :param intern:      建树时是否驻留 span 负载，相同的字符串、子字典、子列表只保留一份 (驻留之后的负载视为只读)，
+                            也可以传入一个 PayloadInterner 在多棵 SpanTree 之间共享驻留池，适合扇出严重、负载重复的 trace。
+        :param instrument:  是否记录各阶段耗时与缓存命中等埋点 (通过 stats() 查看)，默认跟随 instrument.enable() 的全局开关
+        :param schema:      span 的字段布局，可以是 'default'、'otlp'、'jaeger'、'zipkin' 或者自定义的 SpanSchema，
+                            非默认格式直接传入整份导出数据作为 trace，span 按引用挂到树上，通过访问函数读取 id/name/时间戳，不做字段重映射
+        :param projection:  投影下推，可以是 batch_retrieve 的抓取配置、查询 (SpanQuery 或者查询字符串) 或者 SpanProjection，
+                            不可能被命中的 span 只保留骨架字段，命中的 span 只保留配置的字段路径能够到达的子树，被裁掉的负载不会展开，
+                            之后只能抓取投影范围之内的字段，详见 projection 模块
         """
         
         if not spans and not trace: 
             raise ValueError("参数spans和trace至少要有一个不为空!")
         
+        self.schema = get_schema(schema)
+        deep_expand = False
         if trace is not None:
-            spans = KVTree.find_key(trace, target_key="spans")
+            if self.schema.iter_spans is not None:
+                spans = list(self.schema.iter_spans(trace))
+            elif projection is not None and isinstance(trace, dict) and isinstance(trace.get("spans"), list):
+                # 投影时不展开整个 trace，否则被裁掉的负载也会被解析一遍
+                spans, deep_expand = trace["spans"], True
+            else:
+                spans = KVTree.find_key(trace, target_key="spans")
 
         # 初始化分割符信息
         self.sep = sep
@@ -83,6 +161,22 @@ class SpanTree:
         self.parent_map   = None                        # 通过 span_id 访问其父节点id、
         self.sons         = None                        # 通过 span_id访问其所有孩子节点的 id
         self.components   = None                        # 树上联通分量的个数
+        self._interner    = (intern if isinstance(intern, PayloadInterner) else PayloadInterner()) if intern else None
+        self._subtree_hashes = {}                       # with_payload -> {span_id: subtree hash}，首次使用的时候计算
+        self._payload_digests = {}                      # (span_id, 忽略的 id 字段) -> 负载摘要，使用 ExtractionMemo 的时候按需计算
+        self.name_index   = None                        # 通过 span name 访问所有同名 span 的 id (按 span 原始顺序)
+        self._type_index  = None                        # 通过 span type 访问 span id，首次按类型查询的时候才会构建
+        self._span_ids    = None                        # 按 span_map 顺序排列的 span_id，下标与 start_times/end_times 对齐
+        self.position     = None                        # span_id -> 下标
+        self.start_times  = None                        # 每个 span 的开始时间 (array('d'))，缺失时为 NaN
+        self.end_times    = None                        # 每个 span 的结束时间，缺失时使用 开始时间 + duration，仍然缺失则为 NaN
+        self._interval_index = None                     # 所有 span 时间区间上的区间树，首次做时间区间查询的时候才会构建
+        self._ancestry    = None                        # 深度、先序编号、子树范围与 LCA 稀疏表，详见 AncestryIndex
+        self._children    = None                        # 下标 -> 孩子下标列表 (按开始时间排序)，与 sons 相同但是使用下标
+        self._insertion_traversal = None                # 按 span 原始顺序遍历时使用的 (AncestryIndex, 孩子下标列表)，首次使用的时候构建
+        self._stats       = PhaseStats() if (instrument or (instrument is None and _instrument.is_enabled())) else None
+        self.projection   = as_projection(projection, sep)          # 建树时裁剪 span 负载，None 表示保留全部负载
+        self._deep_expand = deep_expand                             # 投影时按 KVTree.expand 的规则展开 (与不投影时先展开整个 trace 相同)
         
         self._init_meta(spans, super_id, keymaps)
         self._cache_buf = SpanTree.SpanCache(tree = self, max_size=cache_size)
@@ -96,16 +190,18 @@ class SpanTree:
             ''' 此处的建树，是以span粒度构建的，每个服务的调用会产生一个span，换句话说，每个树节点是一个span，树节点展开之后仍然是一棵树
                     - span_id: 通过 span_id 访问树节点所有内容
                     - parent_id: 通过 span_id 访问树节点的父节点
-                    - sons: 通过 span_id 访问每个树节点挂载的所有的孩子的节点，sons 是一个 dict[set] 结构
+                    - sons: 通过 span_id 访问每个树节点挂载的所有的孩子的节点，sons 是一个 dict[list] 结构，孩子按开始时间排序
             '''
             # 维护每个节点的入度与出度，使用 span_id 作为key
-            span_map, parent_map, sons = {}, {}, {}
+            span_map, parent_map, sons, name_index = {}, {}, {}, {}
+            get_span_id, get_parent_id, get_name = self.schema.span_id, self.schema.parent_id, self.schema.name
             for span in spans:
                 if isinstance(span, dict):
-                    span_id = span.get("span_id")
-                    parent_id = span.get("parent_id")
+                    span_id = get_span_id(span)
+                    parent_id = get_parent_id(span)
                     
                     span_map[span_id], parent_map[span_id] = span, parent_id
+                    name_index.setdefault(get_name(span), []).append(span_id)
                     
                     if super_id and parent_id == super_id:
                         self.root = span
@@ -126,7 +222,7 @@ class SpanTree:
             
             if super_id is None and len(spans) > 0:
                 random_span = random.choice(spans) 
-                current_id = random_span.get("span_id")
+                current_id = get_span_id(random_span)
                 while current_id in parent_map:
                     parent_id = parent_map[current_id]
                     if parent_id not in parent_map:
@@ -135,7 +231,19 @@ class SpanTree:
                         break
                     current_id = parent_id
                                             
+            # 开始/结束时间只解析一次，按 span_map 的顺序存成数组，孩子节点按 (开始时间, 原始顺序) 排序，缺失开始时间的排在最后
+            span_ids = list(span_map)
+            position = {span_id: i for i, span_id in enumerate(span_ids)}
+            start_times, end_times = self._parse_times(span_map.values())
+            def start_order(span_id):
+                i = position[span_id]
+                return (math.inf if math.isnan(start_times[i]) else start_times[i], i)
+            sons = {parent_id: sorted(children, key=start_order) for parent_id, children in sons.items()}
+
             self.span_map, self.parent_map, self.sons = span_map, parent_map, sons
+            self.name_index, self._type_index = name_index, None
+            self._span_ids, self.position, self.start_times, self.end_times = span_ids, position, start_times, end_times
+            self._interval_index = None
             
         
             self.components = []
@@ -143,10 +251,27 @@ class SpanTree:
                 parent_id = parent_map.get(span_id)
                 if parent_id not in span_map:
                     self.components.append(span_id)
+
+            # 深度、先序编号与子树范围在建树时一次先序遍历算出，LCA 的稀疏表首次调用 lca 的时候构建
+            children = [()] * len(span_ids)
+            for parent_id, kids in sons.items():
+                if parent_id in position:
+                    children[position[parent_id]] = [position[kid] for kid in kids]
+            self._ancestry = AncestryIndex(len(span_ids), [position[root_id] for root_id in self.components], children)
+            self._children, self._insertion_traversal = children, None
             
+        stats = self._stats
+        if stats is not None:
+            return self._init_meta_instrumented(_build_tree, spans, super_id, keymaps)
+        
         # 预处理 Trace 数据
         spans = self.setup_keys(spans, keymaps)
-        spans = [self.expand_span(span) for span in spans]
+        if self.projection is not None:
+            spans = [self.projection.project(span, self.schema, self.expand_span, self._deep_expand) for span in spans]
+        else:
+            spans = [self.expand_span(span) for span in spans]
+        if self._interner is not None:
+            spans = [self._interner.intern_span(span) for span in spans]
         
         
         # 建树
@@ -156,6 +281,32 @@ class SpanTree:
         return self
         
     
+    def _init_meta_instrumented(self, build_tree: Callable, spans: list, super_id = None, keymaps: dict = None):
+        ''' 与 _init_meta 的预处理、建树流程相同，额外记录每个阶段的耗时
+        '''
+        stats = self._stats
+        
+        t0 = perf_counter_ns()
+        spans = self.setup_keys(spans, keymaps)
+        stats.observe("setup_keys", perf_counter_ns() - t0)
+        
+        expanded, projection = [], self.projection
+        for span in spans:
+            t0 = perf_counter_ns()
+            if projection is not None:
+                span = projection.project(span, self.schema, self.expand_span, self._deep_expand)
+            else:
+                span = self.expand_span(span)
+            if self._interner is not None:
+                span = self._interner.intern_span(span)
+            stats.observe("project_span" if projection is not None else "expand_span", perf_counter_ns() - t0)
+            expanded.append(span)
+        
+        t0 = perf_counter_ns()
+        build_tree(expanded, super_id)
+        stats.observe("build_tree", perf_counter_ns() - t0)
+        return self
+    
     def expand_span(self, span: dict):
         ''' 展开 span，递归地解析 JSON 字符串为字典。如果解析失败，保留原始值
         '''
@@ -164,10 +315,20 @@ class SpanTree:
         
         for key, value in span.items():
             if isinstance(value, str):
+                if not looks_like_json_container(value):
+                    continue
+                # 开启驻留之后，相同的字符串化 JSON 只解析一次
+                if self._interner is not None:
+                    expanded = self._interner.get_blob(value)
+                    if expanded is not None:
+                        span[key] = expanded
+                        continue
                 try:
                     parsed_value = json.loads(value)
                     if isinstance(parsed_value, (dict, list)):
                         span[key] = self.expand_span(parsed_value)
+                        if self._interner is not None:
+                            span[key] = self._interner.put_blob(value, span[key])
                 except json.JSONDecodeError:
                     pass  
             elif isinstance(value, dict):
@@ -177,6 +338,55 @@ class SpanTree:
         return span
  
     
+    def _parse_times(self, spans: Iterable[dict]) -> tuple[array, array]:
+        ''' 按顺序读取每个 span 的开始/结束时间，返回两个 array('d')，无法转换成数值的时间戳记为 NaN
+        '''
+        get_start, get_end, get_duration = self.schema.start, self.schema.end, self.schema.duration
+        start_times, end_times = array('d'), array('d')
+        for span in spans:
+            start, end = as_number(get_start(span)), as_number(get_end(span))
+            if end is None and start is not None:
+                duration = as_number(get_duration(span))
+                end = start + duration if duration is not None else None
+            start_times.append(math.nan if start is None else start)
+            end_times.append(math.nan if end is None else end)
+        return start_times, end_times
+
+    @property
+    def type_index(self) -> dict:
+        ''' 通过 span type 访问 span id 的索引，tags 采用懒展开策略，因此这个索引也在首次使用的时候才构建
+        '''
+        if self._type_index is None:
+            type_index = {}
+            for span_id, span in self.span_map.items():
+                type_index.setdefault(self._span_type(span), []).append(span_id)
+            self._type_index = type_index
+        return self._type_index
+
+    def _span_type(self, span: dict):
+        ''' 读取 span type，默认格式优先读取 span 的 type 字段，没有的话再看 tags 里面的 span_type (不展开 tags)
+        '''
+        return self.schema.span_type(span)
+
+    def select(self, query: Union[str, SpanQuery], limit: int = None) -> list[dict]:
+        ''' 使用 SpanQuery 查询语法搜索 span，返回所有匹配的 span (按 span 原始顺序)，查询语法详见 spanquery 模块
+
+        :param query: 查询字符串或者已经编译好的 SpanQuery，查询字符串会按原文缓存编译结果
+        :param limit: 最多返回多少个 span，默认返回全部
+        '''
+        stats = self._stats
+        t0 = perf_counter_ns() if stats is not None else 0
+        span_ids = as_query(query).evaluate(self, limit=limit)
+        if stats is not None:
+            stats.observe("query", perf_counter_ns() - t0)
+        return [self._flatten_tags(self.span_map[span_id]) for span_id in span_ids]
+
+    def select_one(self, query: Union[str, SpanQuery]) -> Optional[dict]:
+        ''' 返回第一个满足查询条件的 span，找不到的时候返回 None
+        '''
+        spans = self.select(query, limit=1)
+        return spans[0] if spans else None
+
     def get_parent(self, span = None, target_span_name: Union[str, list] = None, is_type: Union[bool, list] = False) -> dict:
         if not span and not target_span_name:
             raise Exception("参数 span 和 target_span_name 不可以同时为空！")
@@ -184,52 +394,247 @@ class SpanTree:
         # 如果传入 span 为空，则按 taget_span_name 规则查找
         span = span or self.retrieve_span(target_span_name, is_type)        
         
-        span_id = span.get("span_id")
+        span_id = self.schema.span_id(span)
         parent_id = self.parent_map[span_id]
         return KVTree(self.span_map[parent_id])
     
-    def get_sons(self, span = None, target_span_name: Union[str, list] = None, is_type: Union[bool, list] = False) -> Generator:
+    def get_sons(self, span = None, target_span_name: Union[str, list] = None, is_type: Union[bool, list] = False,
+                       order: str = "start") -> Generator:
         if not span and not target_span_name:
             raise Exception("参数 span 和 target_span_name 不可以同时为空！")
         
         # 如果传入 span 为空，则按 taget_span_name 规则查找
         span = span or self.retrieve_span(target_span_name, is_type)        
         
-        span_id = span.get("span_id")
-        sons = self.sons[span_id]
-        return (self.span_map[son_id] for son_id in sons)
+        # 孩子节点按开始时间排序 (order="insertion" 时按 span 原始顺序)，叶子节点没有孩子
+        i = self.position.get(self.schema.span_id(span))
+        if i is None:
+            return iter(())
+        _, children = self._traversal(order)
+        return (self.span_map[self._span_ids[child]] for child in children[i])
+
+    def _traversal(self, order: str) -> tuple[AncestryIndex, list]:
+        ''' 按指定顺序遍历时使用的先序索引与孩子下标列表: "start" 按开始时间 (建树时已经算好)，"insertion" 按 span 原始顺序
+        '''
+        if order == "start":
+            return self._ancestry, self._children
+        if order == "insertion":
+            if self._insertion_traversal is None:
+                children = [sorted(kids) for kids in self._children]
+                roots = [self.position[root_id] for root_id in self.components]
+                self._insertion_traversal = (AncestryIndex(len(children), roots, children), children)
+            return self._insertion_traversal
+        raise ValueError(f"Unknown traversal order '{order}', expected 'start' or 'insertion'.")
+
+    def iter_dfs(self, start: Union[dict, str] = None, order: str = "start", prune: Callable[[dict, int], bool] = None,
+                       max_depth: int = None, reverse: bool = False) -> Iterator[tuple[dict, int]]:
+        ''' 深度优先 (先序) 遍历，逐个产出 (span, depth)，直接在建树时算好的先序序列上迭代，不使用递归也不维护栈
+
+        :param start:     起点 span 或者 span_id，默认遍历所有连通分量 (按 get_components 的顺序)，depth 从起点开始计数 (起点为 0)
+        :param order:     孩子的访问顺序，"start" 按开始时间 (与 sons 相同)，"insertion" 按 span 原始顺序
+        :param prune:     (span, depth) -> bool，返回 True 时不再访问这个 span 的后代 (span 本身照常产出)
+        :param max_depth: 最多访问到第几层
+        :param reverse:   逆先序产出，每个 span 都在它的所有后代之后产出，适合自底向上汇总 (e.g. 子树时长)
+
+        不在任何一棵树上的 span (parent_map 成环) 不会被访问。
+        '''
+        index, _ = self._traversal(order)
+        if start is None:
+            lo, hi, base = 0, len(index.order) - 1, 0
+        else:
+            i = self.position.get(self._as_span_id(start))
+            if i is None or index.tin[i] < 0:
+                return
+            lo, hi, base = index.tin[i], index.tout[i], index.depth[i]
+
+        if reverse:
+            yield from reversed(list(self.iter_dfs(start, order, prune, max_depth)))
+            return
+
+        # 先序编号 [lo, hi] 就是一棵 (或者多棵) 子树，剪枝时直接跳到子树最后一个节点之后，不需要额外的栈
+        preorder, depths, tout = index.order, index.depth, index.tout
+        span_map, span_ids = self.span_map, self._span_ids
+        k = lo
+        while k <= hi:
+            node = preorder[k]
+            depth, span = depths[node] - base, span_map[span_ids[node]]
+            yield span, depth
+            if (max_depth is not None and depth >= max_depth) or (prune is not None and prune(span, depth)):
+                k = tout[node] + 1
+            else:
+                k += 1
+
+    def iter_levels(self, start: Union[dict, str] = None, order: str = "start", prune: Callable[[dict, int], bool] = None,
+                          max_depth: int = None) -> Iterator[tuple[int, list[dict]]]:
+        ''' 按层遍历，逐层产出 (depth, 这一层的 span 列表)，参数含义与 iter_dfs 相同，同一层的 span 按父节点的顺序与孩子的顺序排列
+        '''
+        index, children = self._traversal(order)
+        if start is None:
+            level = [self.position[root_id] for root_id in self.components]
+        else:
+            i = self.position.get(self._as_span_id(start))
+            if i is None or index.tin[i] < 0:
+                return
+            level = [i]
+
+        span_map, span_ids, depth = self.span_map, self._span_ids, 0
+        while level:
+            spans = [span_map[span_ids[node]] for node in level]
+            yield depth, spans
+            if max_depth is not None and depth >= max_depth:
+                return
+            next_level = []
+            for node, span in zip(level, spans):
+                if prune is None or not prune(span, depth):
+                    next_level.extend(children[node])
+            level, depth = next_level, depth + 1
+
+    def iter_bfs(self, start: Union[dict, str] = None, order: str = "start", prune: Callable[[dict, int], bool] = None,
+                       max_depth: int = None) -> Iterator[tuple[dict, int]]:
+        ''' 广度优先遍历，逐个产出 (span, depth)，参数含义与 iter_dfs 相同
+        '''
+        for depth, spans in self.iter_levels(start, order, prune, max_depth):
+            for span in spans:
+                yield span, depth
 
     def get_ancestors(self, span_id: str) -> list[dict]:
-        ''' 获取指定 span_id 所有祖先节点。
+        ''' 获取指定 span_id 所有祖先节点 (由近及远)。
+        '''
+        return list(self.iter_ancestors(span_id))
+
+    def _as_span_id(self, span: Union[dict, str]):
+        return self.schema.span_id(span) if isinstance(span, dict) else span
+
+    def iter_ancestors(self, span: Union[dict, str]) -> Iterator[dict]:
+        ''' 由近及远逐个产出祖先节点，不构造列表，适合只需要找到第一个满足条件的祖先的场景
+        '''
+        span_id = self._as_span_id(span)
+        i = self.position.get(span_id)
+        if i is None:
+            return
+        ancestry, span_ids = self._ancestry, self._span_ids
+        if ancestry.depth[i] >= 0:
+            parent = ancestry.parent[i]
+            while parent >= 0:
+                yield self.span_map[span_ids[parent]]
+                parent = ancestry.parent[parent]
+            return
+
+        # parent_map 成环的节点不在任何一棵树上，沿着 parent_map 往上走，走回已经访问过的节点时停止
+        seen, current_id = {span_id}, self.parent_map.get(span_id)
+        while current_id in self.span_map and current_id not in seen:
+            seen.add(current_id)
+            yield self.span_map[current_id]
+            current_id = self.parent_map.get(current_id)
+
+    def depth(self, span: Union[dict, str]) -> Optional[int]:
+        ''' span 所在的深度 (树根为 0)，O(1)，span 不存在或者不在任何一棵树上 (parent_map 成环) 时返回 None
+        '''
+        i = self.position.get(self._as_span_id(span))
+        if i is None or self._ancestry.depth[i] < 0:
+            return None
+        return self._ancestry.depth[i]
+
+    def is_ancestor(self, ancestor: Union[dict, str], span: Union[dict, str], proper: bool = True) -> bool:
+        ''' ancestor 是否是 span 的祖先，O(1)
+
+        :param proper: 为 False 时 span 也视为自身的祖先
+        '''
+        i, j = self.position.get(self._as_span_id(ancestor)), self.position.get(self._as_span_id(span))
+        if i is None or j is None:
+            return False
+        return self._ancestry.is_ancestor(i, j, proper)
+
+    def lca(self, a: Union[dict, str], b: Union[dict, str]) -> Optional[dict]:
+        ''' 两个 span 的最近公共祖先 (可能是其中一个 span 本身)，首次调用时构建稀疏表 O(n log n)，之后每次查询 O(1)，
+            两个 span 不在同一棵树上时返回 None
+        '''
+        i, j = self.position.get(self._as_span_id(a)), self.position.get(self._as_span_id(b))
+        if i is None or j is None:
+            return None
+        k = self._ancestry.lca(i, j)
+        return self.span_map[self._span_ids[k]] if k is not None else None
+
+    def path_between(self, a: Union[dict, str], b: Union[dict, str]) -> list[dict]:
+        ''' 树上从 a 到 b 的路径 (a -> ... -> LCA -> ... -> b，两端都包含)，两个 span 不在同一棵树上时返回空列表
         '''
-        ancestors = []
-        current_id = span_id
-        while current_id in self.parent_map:
-            parent_id = self.parent_map[current_id]
-            parent_span = self.span_map.get(parent_id)
-            if parent_span:
-                ancestors.append(parent_span)
-            current_id = parent_id
-        return ancestors
+        i, j = self.position.get(self._as_span_id(a)), self.position.get(self._as_span_id(b))
+        if i is None or j is None:
+            return []
+        ancestry = self._ancestry
+        k = ancestry.lca(i, j)
+        if k is None:
+            return []
+
+        up, down = [], []
+        while i != k:
+            up.append(i)
+            i = ancestry.parent[i]
+        while j != k:
+            down.append(j)
+            j = ancestry.parent[j]
+        span_ids = self._span_ids
+        return [self.span_map[span_ids[node]] for node in (*up, k, *reversed(down))]
+
+    @property
+    def interval_index(self) -> IntervalIndex:
+        ''' 所有 span 时间区间 [start, end) 上的区间树，首次做时间区间查询的时候构建，没有时间戳的 span 不参与索引
+        '''
+        if self._interval_index is None:
+            self._interval_index = IntervalIndex(self.start_times, self.end_times)
+        return self._interval_index
+
+    def _spans_at(self, positions: list) -> list[dict]:
+        span_ids = self._span_ids
+        return [self.span_map[span_ids[i]] for i in positions]
+
+    def span_interval(self, span_id) -> Optional[tuple[float, float]]:
+        ''' span 的 (开始时间, 结束时间)，时间戳缺失的时候返回 None
+        '''
+        i = self.position.get(span_id)
+        if i is None or math.isnan(self.start_times[i]) or math.isnan(self.end_times[i]):
+            return None
+        return self.start_times[i], self.end_times[i]
+
+    def active_at(self, t: float) -> list[dict]:
+        ''' 在 t 时刻处于活跃状态 (start <= t < end) 的所有 span，按开始时间排序，O(log n + k)
+        '''
+        return self._spans_at(self.interval_index.stab(t))
+
+    def overlapping(self, start: float, end: float) -> list[dict]:
+        ''' 时间区间与 [start, end) 相交的所有 span，按开始时间排序，O(log n + k)
+        '''
+        return self._spans_at(self.interval_index.overlap(start, end))
+
+    def concurrent_with(self, span: Union[dict, str], exclude_lineage: bool = True) -> list[dict]:
+        ''' 与指定 span 在时间上重叠 (并发执行) 的 span，按开始时间排序，不包含 span 本身
+
+        :param span:            span 或者 span_id
+        :param exclude_lineage: 是否排除 span 的祖先与后代 (祖先的时间区间本来就包含这个 span)
+        '''
+        span_id = self._as_span_id(span)
+        interval = self.span_interval(span_id)
+        if interval is None:
+            return []
+
+        i, ancestry, span_ids = self.position[span_id], self._ancestry, self._span_ids
+        result = []
+        for j in self.interval_index.overlap(*interval):
+            if j == i or (exclude_lineage and (ancestry.is_ancestor(j, i) or ancestry.is_ancestor(i, j))):
+                continue
+            result.append(self.span_map[span_ids[j]])
+        return result
  
        
     def _flatten_tags(self, span):
-        """ 采用懒展开策略，只有当搜索了特定的 span 才会这个展开 span 并且获取其中关键的 tags 字段
-            一旦展开 tags 将从 list 变成 dict，从而跳过下面的扁平化逻辑
+        """ 采用懒展开策略，只有当搜索了特定的 span 才会这个展开 span 并且获取其中关键的 tags 字段 (属性字段由 schema 决定，
+            e.g. OTLP 的 attributes)，一旦展开 tags 将从 list 变成 dict，从而跳过下面的扁平化逻辑
         """
         if span is None:
             return span
 
-        tags = span.get("tags", [])    
-        span_id = span.get("span_id", None)
-        
-        if isinstance(tags, list):
-            # 由于每个tag value字段仅有一个字典且这个字典仅有一个元素，可以使用迭代器获取包裹在内部的关键值
-            tags = {tag.get("key"): next(iter(tag.get("value").values()))
-                            for tag in tags}
-            self.span_map[span_id]["tags"] = tags
-            
-        return self.span_map[span_id]
+        span = self.span_map[self.schema.span_id(span)]
+        return self.schema.flatten_attributes(span)
             
     def _where_inner_subtree(self, subtree, target_part, idx: int = None):
         if isinstance(subtree, dict):
@@ -283,12 +688,9 @@ class SpanTree:
         :param is_type:         是否使用类型进行搜索
         """
         subtree = self._flatten_tags(subtree)
-        span_name, span_type, span_id = subtree.get("name"), subtree.get("tags", {}).get("span_type"), subtree.get("span_id")
-        
-        if is_type:
-            span_key = span_type
-        else:
-            span_key = span_name
+        span_id = self.schema.span_id(subtree)
+        get_key = self._span_type if is_type else self.schema.name
+        span_key = get_key(subtree)
 
         if span_key == target_span_key:
             return subtree
@@ -296,11 +698,7 @@ class SpanTree:
         # 当前层宽度优先搜索
         for child_id in self.sons.get(span_id, []):
             child_span = self.span_map[child_id]
-            if is_type:
-                child_span_key = child_span.get('type')
-            else:
-                child_span_key = child_span.get('name')
-            if target_span_key == child_span_key:
+            if target_span_key == get_key(child_span):
                 return child_span
         
         # 深度优先搜索
@@ -324,6 +722,12 @@ class SpanTree:
         
         if not is_type and self._cache_buf.is_cache(target_span_name):
             return self._cache_buf.get(target_span_name)
+        
+        # 编译好的查询直接走索引求值
+        if isinstance(target_span_name, SpanQuery):
+            node = self.select_one(target_span_name)
+            self._cache_buf.put(target_span_name=target_span_name, span = node)
+            return node
             
         if not isinstance(is_type, (bool, list)): 
             raise TypeError(f"Expected 'is_type' to be of type bool or list, but got {type(is_type).__name__}.")
@@ -360,15 +764,22 @@ class SpanTree:
         
 
     
-    def retrieve_span(self, target_span_name: Union[str, list], is_type: Union[bool, list] = False):
+    def retrieve_span(self, target_span_name: Union[str, list, SpanQuery], is_type: Union[bool, list] = False, view: bool = False):
+        """ 搜索 span，view 为 True 时返回只读的 KVView (不复制、不展开 span)，否则返回 KVTree
+        """
+        if view:
+            span = self._recursive_inter_search(target_span_name, is_type = is_type)
+            return KVView(span, sep=self.sep) if span is not None else None
+        
         if not is_type and self._cache_buf.is_cache(target_span_name):
             return self._cache_buf.get(target_span_name)
         
         return KVTree(self._recursive_inter_search(target_span_name, is_type = is_type))
 
-    def retrieve(self, target_span_name: Union[str, list], target_field: Union[str, list], callback: Callable = None, idx: int = None, is_type: Union[bool, list] = False):
+    def retrieve(self, target_span_name: Union[str, list, SpanQuery], target_field: Union[str, list], callback: Callable = None, idx: int = None, is_type: Union[bool, list] = False):
         """
-        param {str} target_span_name    Trace 里面我们期望抓取的 span 名称，若有多个span重名，我们可以使用 '.' 作为分隔符进行约束搜索，搜索规则详见下文
+        param {str} target_span_name    Trace 里面我们期望抓取的 span 名称，若有多个span重名，我们可以使用 '.' 作为分隔符进行约束搜索，搜索规则详见下文，
+                                        也可以传入编译好的 SpanQuery (参见 select)，此时忽略 is_type
         param {str} target_field        Trace 里面我们期望抓取的 span 内部的某个字段，若有多个字段重名，我们可以使用 '.' 作为分隔符约束搜索，搜索规则详见下文
         param {int} idx                 如果填写了idx，那么搜索过程之中，遇到 list，我们只看 第idx个元素
         param {bool} is_type            如果填写了true，target_span_name 会按 span type 进行搜索，而不是按照 span name 进行搜索
@@ -381,6 +792,10 @@ class SpanTree:
                      
                      我们可以使用 span3.span5、spanX.span5 来区分上述两个span
         """ 
+        stats = self._stats
+        if stats is not None:
+            return self._retrieve_instrumented(target_span_name, target_field, callback, idx, is_type)
+        
         span = self._recursive_inter_search(target_span_name, is_type)
         value = self._recursive_inner_search(span, target_field, idx)
         
@@ -390,8 +805,34 @@ class SpanTree:
         
         return value
 
+    def _retrieve_instrumented(self, target_span_name, target_field, callback: Callable = None, idx: int = None, is_type = False):
+        ''' 与 retrieve 相同，额外记录 inter/inner 搜索与回调的耗时
+        '''
+        stats = self._stats
+        
+        t0 = perf_counter_ns()
+        span = self._recursive_inter_search(target_span_name, is_type)
+        t1 = perf_counter_ns()
+        value = self._recursive_inner_search(span, target_field, idx)
+        t2 = perf_counter_ns()
+        stats.observe("inter_search", t1 - t0)
+        stats.observe("inner_search", t2 - t1)
+        
+        if callback is not None:
+            decorated_callback = try_catch("Error occurred in Callback function")(callback)
+            stats.incr("callback_calls")
+            try:
+                value = decorated_callback(value)
+            except Exception:
+                stats.incr("callback_errors")
+                raise
+            finally:
+                stats.observe("callback", perf_counter_ns() - t2)
+        
+        return value
+
     
-    def batch_retrieve(self, configs):
+    def batch_retrieve(self, configs, memo: ExtractionMemo = None):
         """ 传入一个抓取配置，按照配置批量抓取
 
         :param configs: 配置参数，每个配置都要安装下面格式来写
@@ -412,10 +853,14 @@ class SpanTree:
                 - target_field_name : 待抓取字段的名称
                 - default           : 待抓取字段的默认值，如果抓不到指定字段则用默认值替代
                 - callback          : 待抓取字段的回调函数，找到相应字段之后通过这个函数对其进行处理
+
+        :param memo: 跨 trace 共享的 ExtractionMemo，某个配置项命中的 span 与之前见过的 span 负载相同 (忽略 id 字段) 时，
+                     直接复用之前的抓取结果，跳过 span 内部搜索与回调，详见 memo 模块
         """
         
         # 存储批量抓取的结果
         results = {}  
+        stats = self._stats
         def process_one_span(target_span_name, cfg):
             span_results = {}
             
@@ -430,14 +875,25 @@ class SpanTree:
                     f"(field_name, default, callback)."
                 )
 
-            if isinstance(target_fields, list):
-                name_prefix = target_span_name.split(self.sep)[-1]
-                target_fields = [(f"{name_prefix} {value[0].split(self.sep)[-1]}", *value) for value in target_fields]
-                
-            elif isinstance(target_fields, dict):
-                target_fields = [(key, *value) for key, value in target_fields.items()]                
+            target_fields = _named_target_fields(target_span_name, target_fields, self.sep)
             
+            # 先找到目标 span，负载与之前见过的 span 相同时直接复用之前的抓取结果
+            memo_key = None
+            fingerprint = memo.entry_fingerprint(target_span_name, cfg, self.sep, target_fields) if memo is not None else None
+            if memo is not None and fingerprint is None:
+                # 回调的行为取决于无法稳定指纹化的状态 (e.g. 闭包里面的对象)，这个配置项不使用缓存
+                memo.stats.incr("skips")
+            elif memo is not None:
+                span = self._recursive_inter_search(target_span_name, is_type)
+                if span is not None:
+                    memo_key = (fingerprint, self._payload_digest(span, [field for _, field, _, _ in target_fields]))
+                    cached = memo.get(memo_key)
+                    if stats is not None:
+                        stats.incr("memo_hit" if cached is not None else "memo_miss")
+                    if cached is not None:
+                        return cached
 
+            failed = False
             for _, field in enumerate(target_fields):
                 diy_name, target_field_name, default, callback = field
 
@@ -455,10 +911,14 @@ class SpanTree:
                     if value_got is not None:
                         value = value_got
                 except Exception as e:
-                    print(f"Failed to retrieve '{target_field_name}' from span '{target_span_name}': {e}")
+                    failed = True
+                    _warn("Failed to retrieve '%s' from span '%s': %s", target_field_name, target_span_name, e)
                 
                 span_results[diy_name] = value
 
+            # 抓取失败的结果不缓存，下次遇到相同的 span 仍然重新抓取
+            if memo_key is not None and not failed:
+                memo.put(memo_key, span_results)
             return span_results
 
         # 使用普通循环代替线程池，因为一次搜索耗时很短，完全没有必要并发
@@ -467,11 +927,26 @@ class SpanTree:
                 span_results = process_one_span(target_span_name, cfg)
                 results.update(span_results)
             except Exception as e:
-                print(f"Error processing span '{target_span_name}': {e}")
+                _warn("Error processing span '%s': %s", target_span_name, e)
 
         return results
 
    
+    def _payload_digest(self, span: dict, fields: Iterable = ()) -> str:
+        ''' span 负载的摘要，忽略抓取不到的 id 字段，同一棵树上按 (span_id, 忽略的字段) 缓存
+
+            搜索总是先在 span 顶层查找字段路径的第一段，因此第一段就是 id 字段名的时候可以取到 id 字段；
+            取值为容器的 id 字段 (e.g. Jaeger 的 references) 在深度优先搜索的时候也可能被访问到，这两种情况都要计入摘要
+        '''
+        first_parts = {field[0] if isinstance(field, (list, tuple)) else str(field).split(self.sep)[0] for field in fields}
+        ignore = tuple(key for key in self.schema.id_fields
+                       if key not in first_parts and not isinstance(span.get(key), (dict, list)))
+        cache_key = (self.schema.span_id(span), ignore)
+        digest = self._payload_digests.get(cache_key)
+        if digest is None:
+            digest = self._payload_digests[cache_key] = payload_digest(span, ignore)
+        return digest
+
     def get_components(self):
         """ 获取树上的所有联通分量的，
             通常联通分量只有一个，除非发生了断链的情况
@@ -485,10 +960,110 @@ class SpanTree:
         return len(self.get_components()) > 1
 
     def is_all_spans_ok(self):
-        """ 检查是否所有树上的span节点状态码均正常
+        """ 检查是否所有树上的span节点状态码均正常，状态码通过 schema.status 读取，与 analyze 相同: 0 或者 None 表示正常
         """
-        return any([span.get('status_code') == 0 for span in self.span_map.values()])
-    
+        get_status = self.schema.status
+        for span in self.span_map.values():
+            status = get_status(span)
+            if status is not None and status != 0:
+                return False
+        return True
+
+    def analyze(self, duration_key: Union[str, Callable] = None, start_key: Union[str, Callable] = None, 
+                      end_key: Union[str, Callable] = None, status_key: Union[str, Callable] = None) -> TraceAnalytics:
+        """ 一次后序遍历计算子树时长、自身耗时、关键路径、扇出/深度直方图以及错误传播，结果详见 TraceAnalytics，
+            每个参数都可以是字段名或者 span -> value 的访问函数，不传的时候使用 schema 的访问函数 (默认格式为 duration 与 status_code)
+
+        :param duration_key:    span 时长字段，缺失的时候尝试使用 end_key - start_key
+        :param start_key:       span 开始时间字段 (数值)，可选
+        :param end_key:         span 结束时间字段 (数值)，可选
+        :param status_key:      span 状态码字段，不为 0 视为出错
+        """
+        return analyze_tree(self, duration_key=duration_key or self.schema.duration, start_key=start_key or self.schema.start,
+                            end_key=end_key or self.schema.end, status_key=status_key or self.schema.status)
+
+    def subtree_hash(self, span_id, with_payload: bool = True) -> str:
+        """ 获取 span 的子树哈希 (Merkle 哈希)，哈希相同说明两棵子树完全相同，首次调用时一次后序遍历算出所有节点的哈希
+
+        :param with_payload: 为 False 时只考虑 span name 与树结构，即 "调用模式" 相同就视为相同
+        """
+        return self._all_subtree_hashes(with_payload)[span_id]
+
+    def _all_subtree_hashes(self, with_payload: bool = True) -> dict:
+        if with_payload not in self._subtree_hashes:
+            self._subtree_hashes[with_payload], _ = subtree_hashes(self, with_payload=with_payload)
+        return self._subtree_hashes[with_payload]
+
+    def group_identical_subtrees(self, with_payload: bool = False, min_size: int = 2) -> list[list]:
+        """ 按照子树哈希对 span 分组，返回所有至少出现 min_size 次的分组 (每组是 span_id 列表)，按组大小降序排列，
+            默认只比较调用模式，常用于在扇出严重的 trace 里面找出重复的调用
+        """
+        groups = {}
+        for span_id, h in self._all_subtree_hashes(with_payload).items():
+            groups.setdefault(h, []).append(span_id)
+        return sorted((group for group in groups.values() if len(group) >= min_size), key=len, reverse=True)
+
+    def stats(self, memory: bool = True) -> PhaseStats:
+        """ 返回这棵树的埋点统计 (副本)，可以通过 to_dict() 或 to_prometheus(path) 导出，
+            未开启埋点的时候只有内存占用的统计
+
+        :param memory: 是否统计内存占用: 拓扑结构 (span_map/parent_map/sons/索引等容器本身) 与负载 (span 内容) 分开统计，
+                       被多个 span 共享的负载 (e.g. 开启 intern) 只统计一次
+        """
+        stats = self._stats.copy() if self._stats is not None else PhaseStats()
+        stats.gauges["spans"] = len(self.span_map)
+        if memory:
+            topology = sum(sys.getsizeof(container) for container in (self.span_map, self.parent_map, self.sons, self.name_index))
+            topology += sum(sys.getsizeof(children) for children in self.sons.values())
+            topology += sum(sys.getsizeof(span_ids) for span_ids in self.name_index.values())
+            stats.gauges["memory_topology_bytes"] = topology
+            seen = set()
+            stats.gauges["memory_payload_bytes"] = sum(deep_sizeof(span, seen) for span in self.span_map.values())
+        return stats
+
+    def diff(self, other: "SpanTree", ignore_fields: Iterable[str] = DEFAULT_IGNORE_FIELDS) -> SpanTreeDiff:
+        """ 与另一棵 SpanTree (通常是基线) 做结构化比较，返回新增、删除、移动以及字段变化的 span，详见 SpanTreeDiff
+
+        :param other:           作为新版本参与比较的 SpanTree，self 视为旧版本 (基线)
+        :param ignore_fields:   比较时忽略的字段，不含 sep 的字段名在任意层级都会被忽略 (e.g. 'timestamp')，
+                                含有 sep 的字段视为从 span 顶层开始的完整路径，默认忽略 span_id 与 parent_id
+        """
+        return diff_trees(self, other, ignore_fields=ignore_fields)
+
+    def dump(self, stream: TextIO = None, payload: bool = True, max_span_depth: int = None, max_depth: int = 4,
+                   max_items: int = 20, max_str_len: int = 200) -> Optional[str]:
+        """ 把整棵树 (每个 span 及其负载) 逐行写入 stream，适合在 CI 日志里面输出失败的 trace，
+            显式栈遍历且逐行写入，不会在内存里面拼出完整的字符串，没有传入 stream 的时候返回字符串
+
+        :param payload:         是否输出 span 的负载 (除 name/span_id/parent_id 等拓扑字段之外的字段)
+        :param max_span_depth:  最多输出多少层 span (树根为第 0 层)，更深的 span 只统计个数
+        :param max_depth:       负载最多展开多少层，max_items/max_str_len 同样作用于负载，详见 tracespantree.utils.pretty
+        """
+        if stream is None:
+            buffer = io.StringIO()
+            self.dump(buffer, payload, max_span_depth, max_depth, max_items, max_str_len)
+            return buffer.getvalue()
+
+        ancestry, position = self._ancestry, self.position
+        for span, depth in self.iter_dfs(max_depth=max_span_depth):
+            span_id = self.schema.span_id(span)
+            indent = "    " * depth
+            stream.write(f"{indent}- {self.schema.name(span)} (span_id={span_id})\n")
+
+            if payload:
+                fields = {key: value for key, value in span.items() if key not in self.schema.topology_keys}
+                for line in iter_pretty_lines(fields, max_depth=depth + 1 + max_depth if max_depth is not None else None,
+                                              max_items=max_items, max_str_len=max_str_len, level=depth + 1):
+                    stream.write(line)
+
+            if max_span_depth is not None and depth >= max_span_depth:
+                # 子树在先序序列上是连续的一段，后代个数直接由先序编号算出
+                i = position[span_id]
+                hidden = ancestry.tout[i] - ancestry.tin[i]
+                if hidden:
+                    stream.write(f"{indent}    ... ({hidden} descendant spans)\n")
+        return None
+
         
     def setup_keys(self, spans, keymaps = None):
         ''' 用户传入的trace信息，其中的 spans 未必包含 name, span_id, parent_id 这些信息(有可能是名字的不同), 
@@ -0,0 +1,2 @@
+''' 工具模块，这里不做任何导入: 各个子模块 (尤其是 logx、ploter) 在使用的时候再单独导入，保证 import tracespantree 足够轻量
+'''
@@ -1,10 +1,21 @@
-import time
-import asyncio
-
-import urllib3
 import warnings
 import functools
 
+from tracespantree.utils import instrument
+from tracespantree.utils.instrument import perf_counter_ns
+
+
+# 与 inspect.CO_COROUTINE 相同，直接读取 code flags，避免为了一个判断导入 asyncio/inspect (二者导入耗时都是十毫秒量级)
+_CO_COROUTINE = 0x0080
+
+
+def _is_coroutine_function(func) -> bool:
+    while isinstance(func, functools.partial):
+        func = func.func
+    func = getattr(func, "__func__", func)
+    code = getattr(func, "__code__", None)
+    return code is not None and bool(code.co_flags & _CO_COROUTINE)
+
 
 
 def try_catch(error_msg):
@@ -12,7 +23,7 @@ def try_catch(error_msg):
         并以指定的错误信息包装后重新抛出。
     '''
     def decorator(func):
-        if asyncio.iscoroutinefunction(func): 
+        if _is_coroutine_function(func): 
             @functools.wraps(func)
             async def async_wrapper(*args, **kwargs):
                 try:
@@ -33,26 +44,38 @@ def try_catch(error_msg):
 
 
 # 测量函数的执行时间，并且根据 return_time 参数决定是否返回耗时。
-def time_calc(return_time=False):
+# verbose 控制是否打印耗时；全局开启埋点 (instrument.enable()) 之后，耗时同时记录到全局 PhaseStats 的 phase 阶段 (默认使用函数名)
+def time_calc(return_time=False, verbose=True, phase=None):
     def decorator(func):
-        if asyncio.iscoroutinefunction(func):
+        phase_name = phase or func.__qualname__
+
+        def record(start_ns):
+            elapsed_ns = perf_counter_ns() - start_ns
+            stats = instrument._global_stats
+            if stats is not None:
+                stats.observe(phase_name, elapsed_ns)
+            return elapsed_ns / 1e9
+
+        if _is_coroutine_function(func):
+            @functools.wraps(func)
             async def async_wrapper(*args, **kwargs):
-                start_time = time.time()
+                start_ns = perf_counter_ns()
                 result = await func(*args, **kwargs)
-                end_time = time.time()
-                execution_time = end_time - start_time
-                print(f"异步函数 {func.__name__} 执行完成，耗时 {execution_time:.6f} 秒")
+                execution_time = record(start_ns)
+                if verbose:
+                    print(f"异步函数 {func.__name__} 执行完成，耗时 {execution_time:.6f} 秒")
                 if return_time:
                     return result, execution_time
                 return result
             return async_wrapper
         else:
+            @functools.wraps(func)
             def sync_wrapper(*args, **kwargs):
-                start_time = time.time()
+                start_ns = perf_counter_ns()
                 result = func(*args, **kwargs)  # 执行同步函数
-                end_time = time.time()
-                execution_time = end_time - start_time
-                print(f"同步函数 {func.__name__} 执行完成，耗时 {execution_time:.6f} 秒")
+                execution_time = record(start_ns)
+                if verbose:
+                    print(f"同步函数 {func.__name__} 执行完成，耗时 {execution_time:.6f} 秒")
                 if return_time:
                     return result, execution_time
                 return result
@@ -0,0 +1,318 @@
+import os
+import sys
+import csv
+import json
+
+from typing import Iterable, Optional
+
+
+""" 抓取结果 (每个 trace 一行 {列名: 取值}) 的流式写出: CSV、JSONL、Parquet、Excel
+    - 所有 writer 都是逐批写入，不在内存里面攒下整份结果，表头可以用 result_columns(configs) 预先确定
+    - CSV 与 JSONL 支持追加写入 (命令行的 --follow 模式)，CSV 追加时沿用已有文件的表头
+    - Parquet 依赖 pyarrow，Excel 依赖 openpyxl，只有真正写这两种格式的时候才导入
+"""
+
+
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".parquet": "parquet", ".xlsx": "xlsx"}
+
+
+def infer_format(path: str, default: str = "jsonl") -> str:
+    ''' 按输出文件的后缀推断格式，"-" (标准输出) 或者无法识别的后缀返回 default
+    '''
+    if path == "-":
+        return default
+    return FORMATS.get(os.path.splitext(path)[1].lower(), default)
+
+
+def _text(value) -> str:
+    # 非标量的取值编码成 JSON 文本，None 写成空字符串
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return value
+
+
+class RowWriter:
+    ''' 逐批写出抓取结果的基类:
+
+        with open_writer("rows.csv") as writer:
+            writer.write_rows(rows)
+
+    :param path:   输出文件路径，"-" 表示标准输出
+    :param append: 追加写入已有的文件 (不是所有格式都支持)
+    '''
+
+    format = None
+    supports_append = True
+
+    def __init__(self, path: str, append: bool = False):
+        if append and not self.supports_append:
+            raise ValueError(f"The {self.format} writer does not support appending to an existing file.")
+        self.path   = path
+        self.append = append
+        self.rows   = 0
+
+    def write_rows(self, rows: Iterable[dict]) -> int:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _TextRowWriter(RowWriter):
+
+    def __init__(self, path: str, append: bool = False):
+        super().__init__(path, append)
+        if path == "-":
+            self._file, self._owned = sys.stdout, False
+        else:
+            self._file, self._owned = open(path, "a" if append else "w", encoding="utf-8", newline=""), True
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._owned and not self._file.closed:
+            self._file.close()
+        elif not self._owned:
+            self._file.flush()
+
+
+class JsonlRowWriter(_TextRowWriter):
+    format = "jsonl"
+
+    def write_rows(self, rows: Iterable[dict]) -> int:
+        n, write = 0, self._file.write
+        for row in rows:
+            write(json.dumps(row, ensure_ascii=False, default=str))
+            write("\n")
+            n += 1
+        self.rows += n
+        return n
+
+
+class CsvRowWriter(_TextRowWriter):
+    ''' 表头取自 columns，没有给出时取第一行的键；追加写入非空文件时沿用文件已有的表头，之后缺失的列留空、多出来的列忽略
+    '''
+    format = "csv"
+
+    def __init__(self, path: str, append: bool = False, columns: Optional[list] = None):
+        header = None
+        if append and path != "-" and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "r", encoding="utf-8", newline="") as f:
+                header = next(csv.reader(f), None)
+        super().__init__(path, append)
+        self.columns = header or (list(columns) if columns else None)
+        self._writer = None
+        if self.columns is not None:
+            self._writer = csv.DictWriter(self._file, fieldnames=self.columns, restval="", extrasaction="ignore")
+            if header is None:
+                self._writer.writeheader()
+
+    def write_rows(self, rows: Iterable[dict]) -> int:
+        n = 0
+        for row in rows:
+            if self._writer is None:
+                self.columns = list(row)
+                self._writer = csv.DictWriter(self._file, fieldnames=self.columns, restval="", extrasaction="ignore")
+                self._writer.writeheader()
+            self._writer.writerow({key: _text(value) for key, value in row.items()})
+            n += 1
+        self.rows += n
+        return n
+
+
+class ParquetRowWriter(RowWriter):
+    ''' 按 batch_size 行一个 row group 写出，列类型取自第一批数据，非标量的取值编码成 JSON 文本；
+        第一批数据里面全为空的列按字符串列处理，之后这些列里面的非字符串取值同样编码成 JSON 文本 (1 -> "1")，不会因为类型不一致而中断
+    '''
+    format = "parquet"
+    supports_append = False
+
+    def __init__(self, path: str, append: bool = False, columns: Optional[list] = None, batch_size: int = 10000):
+        super().__init__(path, append)
+        if path == "-":
+            raise ValueError("Parquet output cannot be written to stdout, please give an output file.")
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Writing parquet requires pyarrow, please install it with `pip install pyarrow`.") from e
+        self._pa         = pyarrow
+        self._pq         = pyarrow.parquet
+        self.columns     = list(columns) if columns else None
+        self.batch_size  = batch_size
+        self._buffer     = []
+        self._schema     = None
+        self._writer     = None
+        self._text       = set()            # 推断 schema 时全为空、按字符串处理的列
+
+    def write_rows(self, rows: Iterable[dict]) -> int:
+        n = 0
+        for row in rows:
+            if self.columns is None:
+                self.columns = list(row)
+            self._buffer.append(row)
+            n += 1
+            if len(self._buffer) >= self.batch_size:
+                self._write_buffer()
+        self.rows += n
+        return n
+
+    def _write_buffer(self) -> None:
+        if not self._buffer:
+            return
+        pa = self._pa
+        columns = {column: [] for column in self.columns}
+        text = self._text
+        for row in self._buffer:
+            for column, values in columns.items():
+                value = row.get(column)
+                if isinstance(value, (dict, list, tuple)) or (column in text and value is not None and not isinstance(value, str)):
+                    value = json.dumps(value, ensure_ascii=False, default=str)
+                values.append(value)
+        self._buffer = []
+
+        try:
+            if self._schema is None:
+                inferred = pa.table(columns).schema
+                self._text = {field.name for field in inferred if pa.types.is_null(field.type)}
+                self._schema = pa.schema([pa.field(field.name, pa.string()) if field.name in self._text else field
+                                          for field in inferred])
+                self._writer = self._pq.ParquetWriter(self.path, self._schema)
+            table = pa.table(columns, schema=self._schema)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f"Cannot write rows with mixed value types to parquet ({e}), "
+                             f"use csv or jsonl output instead.") from e
+        self._writer.write_table(table)
+
+    def flush(self) -> None:
+        self._write_buffer()
+
+    def close(self) -> None:
+        self._write_buffer()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class XlsxRowWriter(RowWriter):
+    ''' 使用 openpyxl 的 write-only 工作簿逐行写出 Excel 报表，每一行写入之后就不再保留在内存里面 (内存占用与行数无关):
+
+        with XlsxRowWriter("report.xlsx", columns=result_columns(configs)) as writer:
+            writer.write_rows(SpanTree(trace=trace).batch_retrieve(configs) for trace in traces)
+
+        - 表头取自 columns，没有给出时取第一行的键，每个工作表的第一行都是表头
+        - 一个工作表写满 sheet_rows 行 (含表头，默认是 Excel 的上限 1048576 行) 之后自动新建工作表: results、results_2、...
+        - 非标量的取值编码成 JSON 文本，字符串去掉 Excel 不允许的控制字符，并截断到单元格的长度上限
+        - 字符串总是写成文本单元格: trace 负载是不可信的输入，以 '=' 开头的取值不能被 openpyxl 当成公式写入
+
+    :param path:       输出文件路径 (.xlsx)
+    :param columns:    列名列表
+    :param sheet_rows: 每个工作表最多写多少行 (含表头)
+    :param sheet_name: 工作表名称的前缀
+    '''
+    format = "xlsx"
+    supports_append = False
+
+    MAX_ROWS      = 1048576
+    MAX_CELL_TEXT = 32767
+
+    def __init__(self, path: str, append: bool = False, columns: Optional[list] = None,
+                 sheet_rows: int = MAX_ROWS, sheet_name: str = "results"):
+        super().__init__(path, append)
+        if path == "-":
+            raise ValueError("Excel output cannot be written to stdout, please give an output file.")
+        if not 2 <= sheet_rows <= self.MAX_ROWS:
+            raise ValueError(f"sheet_rows must be between 2 and {self.MAX_ROWS}, but got {sheet_rows}.")
+        try:
+            from openpyxl import Workbook
+            from openpyxl.cell import WriteOnlyCell
+            from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+        except ImportError as e:
+            raise ImportError("Writing xlsx requires openpyxl, please install it with `pip install openpyxl`.") from e
+        self._workbook   = Workbook(write_only=True)
+        self._illegal    = ILLEGAL_CHARACTERS_RE
+        self._text_cell  = WriteOnlyCell
+        self.columns     = list(columns) if columns else None
+        self.sheet_rows  = sheet_rows
+        self.sheet_name  = sheet_name
+        self.sheets      = 0
+        self._sheet      = None
+        self._sheet_used = 0
+
+    def _cell(self, value):
+        if isinstance(value, (dict, list, tuple)):
+            value = json.dumps(value, ensure_ascii=False, default=str)
+        elif value is not None and not isinstance(value, (str, int, float, bool)):
+            value = str(value)
+        if isinstance(value, str):
+            value = self._illegal.sub("", value)
+            if len(value) > self.MAX_CELL_TEXT:
+                value = value[:self.MAX_CELL_TEXT]
+            if value.startswith("="):
+                # openpyxl 把以 '=' 开头的字符串写成公式，显式指定为文本单元格
+                cell = self._text_cell(self._sheet, value)
+                cell.data_type = "s"
+                return cell
+        return value
+
+    def _new_sheet(self) -> None:
+        self.sheets += 1
+        title = self.sheet_name if self.sheets == 1 else f"{self.sheet_name}_{self.sheets}"
+        self._sheet = self._workbook.create_sheet(title=title)
+        self._sheet.append([self._cell(column) for column in self.columns])
+        self._sheet_used = 1
+
+    def write_rows(self, rows: Iterable[dict]) -> int:
+        n = 0
+        for row in rows:
+            if self.columns is None:
+                self.columns = list(row)
+            if self._sheet is None or self._sheet_used >= self.sheet_rows:
+                self._new_sheet()
+            self._sheet.append([self._cell(row.get(column)) for column in self.columns])
+            self._sheet_used += 1
+            n += 1
+        self.rows += n
+        return n
+
+    def close(self) -> None:
+        if self._workbook is None:
+            return
+        if self._sheet is None:
+            # 没有任何结果也写出一个只有表头的工作表
+            self.columns = self.columns or []
+            self._new_sheet()
+        self._workbook.save(self.path)
+        self._workbook = None
+
+
+WRITERS = {"csv": CsvRowWriter, "jsonl": JsonlRowWriter, "parquet": ParquetRowWriter, "xlsx": XlsxRowWriter}
+
+
+def open_writer(path: str, format: str = None, append: bool = False, **kwargs) -> RowWriter:
+    ''' 按格式 (默认按后缀推断) 打开一个 RowWriter
+
+    :param path:   输出文件路径，"-" 表示标准输出
+    :param format: csv、jsonl、parquet 或者 xlsx
+    :param append: 追加写入已有的文件
+    :param kwargs: 透传给对应的 writer (e.g. columns、batch_size、sheet_rows)
+    '''
+    format = format or infer_format(path)
+    writer_cls = WRITERS.get(format)
+    if writer_cls is None:
+        raise ValueError(f"Unknown output format '{format}', expected one of {sorted(WRITERS)}.")
+    if writer_cls is JsonlRowWriter:
+        kwargs.pop("columns", None)
+    return writer_cls(path, append=append, **kwargs)
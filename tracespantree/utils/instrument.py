@@ -0,0 +1,157 @@
+import os
+import sys
+
+from time import perf_counter_ns
+from collections import Counter
+
+
+""" 可选的热点路径埋点:
+    - 默认关闭，关闭时热点路径上只多一次 `stats is None` 判断
+    - SpanTree(instrument=True) 为单棵树开启埋点，或者调用 enable() 全局开启 (之后新建的 SpanTree 以及 KVTree 的静态方法都会记录)
+    - 计时使用 perf_counter_ns，按 2 的幂分桶记录直方图，计数器记录缓存命中、回调执行次数等事件
+"""
+
+
+__all__ = ["PhaseStats", "enable", "disable", "is_enabled", "global_stats", "perf_counter_ns", "deep_sizeof"]
+
+
+class PhaseStats:
+    ''' 每个阶段的耗时直方图 (perf_counter_ns，按 bit_length 分桶) + 事件计数器 + 仪表盘数值 (e.g. 内存占用)
+    '''
+
+    def __init__(self):
+        self.timings  = {}          # phase -> [count, total_ns, max_ns, {bucket: count}]
+        self.counters = Counter()
+        self.gauges   = {}
+
+    def incr(self, event: str, n: int = 1) -> None:
+        self.counters[event] += n
+
+    def observe(self, phase: str, elapsed_ns: int) -> None:
+        timing = self.timings.get(phase)
+        if timing is None:
+            timing = self.timings[phase] = [0, 0, 0, {}]
+        timing[0] += 1
+        timing[1] += elapsed_ns
+        if elapsed_ns > timing[2]:
+            timing[2] = elapsed_ns
+        bucket = elapsed_ns.bit_length()
+        timing[3][bucket] = timing[3].get(bucket, 0) + 1
+
+    def merge(self, other: "PhaseStats") -> "PhaseStats":
+        for phase, (count, total, max_ns, buckets) in other.timings.items():
+            timing = self.timings.setdefault(phase, [0, 0, 0, {}])
+            timing[0] += count
+            timing[1] += total
+            timing[2] = max(timing[2], max_ns)
+            for bucket, n in buckets.items():
+                timing[3][bucket] = timing[3].get(bucket, 0) + n
+        self.counters.update(other.counters)
+        self.gauges.update(other.gauges)
+        return self
+
+    def copy(self) -> "PhaseStats":
+        return PhaseStats().merge(self)
+
+    def reset(self) -> None:
+        self.timings.clear()
+        self.counters.clear()
+        self.gauges.clear()
+
+    def to_dict(self) -> dict:
+        phases = {}
+        for phase, (count, total, max_ns, buckets) in self.timings.items():
+            phases[phase] = {
+                "count":    count,
+                "total_ns": total,
+                "mean_ns":  total // count if count else 0,
+                "max_ns":   max_ns,
+                # 桶 b 统计的是耗时 < 2**b ns 的调用 (且 >= 2**(b-1) ns)
+                "histogram_ns": {f"<{1 << bucket}": n for bucket, n in sorted(buckets.items())},
+            }
+        return {"phases": phases, "counters": dict(self.counters), "gauges": dict(self.gauges)}
+
+    def to_prometheus(self, path: str = None, prefix: str = "tracespantree", labels: dict = None) -> str:
+        ''' 导出为 Prometheus 文本格式，传入 path 时原子地写入文件 (适用于 node_exporter 的 textfile collector)
+        '''
+        extra = "".join(f',{key}="{_escape(value)}"' for key, value in (labels or {}).items())
+        lines = []
+
+        if self.timings:
+            lines.append(f"# HELP {prefix}_phase_seconds Time spent in each SpanTree/KVTree phase.")
+            lines.append(f"# TYPE {prefix}_phase_seconds histogram")
+            for phase, (count, total, _, buckets) in sorted(self.timings.items()):
+                label = f'phase="{_escape(phase)}"{extra}'
+                cumulative = 0
+                for bucket in range(min(buckets), max(buckets) + 1):
+                    cumulative += buckets.get(bucket, 0)
+                    lines.append(f'{prefix}_phase_seconds_bucket{{{label},le="{(1 << bucket) / 1e9:.9g}"}} {cumulative}')
+                lines.append(f'{prefix}_phase_seconds_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f"{prefix}_phase_seconds_sum{{{label}}} {total / 1e9:.9g}")
+                lines.append(f"{prefix}_phase_seconds_count{{{label}}} {count}")
+
+        if self.counters:
+            lines.append(f"# HELP {prefix}_events_total Instrumented events (cache hits/misses, callbacks, ...).")
+            lines.append(f"# TYPE {prefix}_events_total counter")
+            for event, n in sorted(self.counters.items()):
+                lines.append(f'{prefix}_events_total{{event="{_escape(event)}"{extra}}} {n}')
+
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name}{{{extra[1:]}}} {value}" if extra else f"{prefix}_{name} {value}")
+
+        text = "\n".join(lines) + "\n"
+        if path is not None:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        return text
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def deep_sizeof(obj, seen: set = None) -> int:
+    ''' 递归统计对象占用的内存 (sys.getsizeof 之和)，被多处引用的对象只统计一次
+    '''
+    seen = set() if seen is None else seen
+    size, stack = 0, [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+    return size
+
+
+_global_stats = None
+
+
+def enable() -> PhaseStats:
+    ''' 全局开启埋点，返回全局的 PhaseStats (KVTree 静态方法的统计记录在这里)
+    '''
+    global _global_stats
+    if _global_stats is None:
+        _global_stats = PhaseStats()
+    return _global_stats
+
+
+def disable() -> None:
+    global _global_stats
+    _global_stats = None
+
+
+def is_enabled() -> bool:
+    return _global_stats is not None
+
+
+def global_stats() -> PhaseStats:
+    return _global_stats
@@ -2,6 +2,8 @@
 import os
 import json
 
+from typing import Callable
+
 
 # 本地缓存相应的文件
 def cache_json(data, fname, file_dir):
@@ -28,3 +30,72 @@ def open_json(fname, file_dir):
 def is_cache(fname, file_dir):
     target_file = os.path.join(file_dir, fname)
     return os.path.exists(target_file) 
+
+
+TRACE_FILE_SUFFIXES = (".json", ".jsonl")
+
+
+def iter_trace_files(root: str, suffixes = TRACE_FILE_SUFFIXES):
+    ''' 遍历 root (文件或者目录) 下面的所有 trace 文件，按路径排序返回
+    '''
+    if os.path.isfile(root):
+        yield root
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(suffixes):
+                yield os.path.join(dirpath, filename)
+
+
+def _split_document(document, split: Callable = None) -> list:
+    if split is not None:
+        return split(document)
+    return document if isinstance(document, list) else [document]
+
+
+def iter_trace_records(path: str, split: Callable = None):
+    ''' 逐个读取 trace 文件里面的 trace，产出 (offset, length, trace):
+        - .jsonl 每一行是一个 trace，offset/length 为这一行的字节偏移与字节长度，之后可以直接 seek 读取
+        - .json  由 split 把整份文档拆成 trace 列表 (通常传入 SpanSchema.split_document)，offset 为列表下标，length 为 -1，
+                 没有给出 split 时顶层是列表则每个元素是一个 trace，否则整个文件是一个 trace
+        .jsonl 里面的空行与无法解析的行会被跳过，.json 文件整体无法解析时抛出 json.JSONDecodeError (或者 UnicodeDecodeError)，由调用方决定如何处理
+    '''
+    if path.endswith(".jsonl"):
+        with open(path, "rb") as f:
+            offset = 0
+            for line in f:
+                length = len(line)
+                if line.strip():
+                    try:
+                        yield offset, length, json.loads(line)
+                    except json.JSONDecodeError:
+                        pass
+                offset += length
+        return
+
+    with open(path, "r", encoding="utf-8") as f:
+        document = json.load(f)
+    for position, trace in enumerate(_split_document(document, split)):
+        yield position, -1, trace
+
+
+def iter_traces(path: str, split: Callable = None):
+    ''' 读取 .json/.jsonl 文件 (或者目录下面的所有这类文件) 里面的 trace，split 的含义与 iter_trace_records 相同
+    '''
+    for file_path in iter_trace_files(path):
+        for _, _, trace in iter_trace_records(file_path, split):
+            yield trace
+
+
+def read_trace(path: str, offset: int, length: int, split: Callable = None):
+    ''' 按照 iter_trace_records 给出的位置读取单个 trace，.jsonl 只读取对应的一行，split 需要与产出位置时的相同
+    '''
+    if length >= 0:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    with open(path, "r", encoding="utf-8") as f:
+        document = json.load(f)
+    return _split_document(document, split)[offset]
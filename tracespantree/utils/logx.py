@@ -1,9 +1,10 @@
 import os
 import time
+import atexit
 import logging
-import colorlog
+import threading
 
-from typing import TypeVar
+from typing import TypeVar, Union
 
 
 try:
@@ -35,14 +36,129 @@ class LoggerX(Protocol):
     
 
    
+
+class RateLimitFilter(logging.Filter):
+    """ 重复日志的限流与去重: 同一个 key 在 interval 秒的窗口之内最多放行 burst 条，其余的直接丢弃，
+        窗口结束之后同一个 key 的下一条日志会附带 "suppressed N similar messages" 的说明
+
+    :param interval: 窗口长度 (秒)
+    :param burst:    每个窗口最多放行的条数
+    :param by:       'message' 按格式化之后的消息去重 (只合并完全相同的日志)，
+                     'template' 按调用位置与消息模板 (record.msg) 限流，参数不同也视为同一类日志，
+                     适合 batch_retrieve 这种同一处代码对每个字段都打一条失败信息的场景
+    :param max_keys: 最多记录多少个 key，超出时清理已经过期的窗口
+    """
+
+    def __init__(self, interval: float = 1.0, burst: int = 1, by: str = "message", max_keys: int = 10000):
+        super().__init__()
+        if by not in ("message", "template"):
+            raise ValueError(f"Unknown rate limit key '{by}', expected 'message' or 'template'.")
+        self.interval   = interval
+        self.burst      = burst
+        self.by         = by
+        self.max_keys   = max_keys
+        self.suppressed = 0                    # 累计丢弃的条数
+        self._windows   = {}                   # key -> [窗口开始时间, 已放行条数, 已丢弃条数]
+        self._lock      = threading.Lock()
+
+    def _key(self, record: logging.LogRecord):
+        if self.by == "message":
+            return record.levelno, record.getMessage()
+        return record.name, record.levelno, record.pathname, record.lineno, str(record.msg)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key, now = self._key(record), record.created
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None and now - window[0] < self.interval:
+                if window[1] < self.burst:
+                    window[1] += 1
+                    return True
+                window[2] += 1
+                self.suppressed += 1
+                return False
+
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if len(self._windows) > self.max_keys:
+                self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.interval}
+
+        if suppressed:
+            record.msg = f"{record.msg} (suppressed {suppressed} similar messages in the last {self.interval:g}s)"
+        return True
+
+
+class _DeferredQueueHandler(logging.Handler):
+    """ 只负责把 LogRecord 放进队列，不在调用方线程里面格式化消息 (QueueHandler.prepare 会先格式化一次)，
+        格式化与写文件都在 QueueListener 的后台线程里面完成，日志参数在后台线程格式化之前不应该被修改
+    """
+
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+_listeners = {}     # logger 名称 -> QueueListener
+
+
+def shutdown_logger(name: str = "autotest"):
+    """ 停止队列模式 logger 的后台线程: 先把队列里面剩余的日志全部写完，再关闭所有 handler
+    """
+    listener = _listeners.pop(name, None)
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def _shutdown_all():
+    for name in list(_listeners):
+        shutdown_logger(name)
+
+
+# 进程退出之前把所有队列里面的日志写完
+atexit.register(_shutdown_all)
+
+
+def _file_handler(log_directory: str, name: str, max_bytes: int = None, rotate_when: str = None, backup_count: int = 7) -> logging.Handler:
+    """ 按大小 (max_bytes) 或者按时间 (rotate_when，取值同 TimedRotatingFileHandler 的 when) 轮转的日志文件，
+        两者都不设置的时候保持原来的行为: 每天一个以日期命名、不断增长的文件
+    """
+    if max_bytes is not None and rotate_when is not None:
+        raise ValueError("max_bytes and rotate_when cannot be used together.")
+
+    if max_bytes is None and rotate_when is None:
+        return logging.FileHandler(os.path.join(log_directory, f"{time.strftime('%Y%m%d')}.log"))
+
+    from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+    log_path = os.path.join(log_directory, f"{name}.log")
+    if max_bytes is not None:
+        return RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    return TimedRotatingFileHandler(log_path, when=rotate_when, backupCount=backup_count, encoding="utf-8")
         
 
 # 日志模块 log_level 控制记录何种级别的日志，低于这个级别的日志不被记录 debug < info < warning < error < critical
-def logger_initiate(log_level=logging.INFO, is_console=True, is_file=True, is_colorful=False) -> LoggerX:
-    """日志基础设置，支持本地控制台和彩色日志文件输出"""
+def logger_initiate(log_level=logging.INFO, is_console=True, is_file=True, is_colorful=False, name: str = "autotest",
+                    log_dir: str = None, use_queue: bool = False, max_bytes: int = None, rotate_when: str = None,
+                    backup_count: int = 7, rate_limit: Union[float, RateLimitFilter] = None) -> LoggerX:
+    """日志基础设置，支持本地控制台和彩色日志文件输出
 
-    
-        
+    :param name:         logger 名称，SpanTree 抽取过程中的失败信息使用名为 tracespantree 的 logger
+    :param log_dir:      日志文件目录，默认是当前目录下的 logs/
+    :param use_queue:    队列模式: 调用方只把日志放进队列，格式化与写文件由后台线程 (QueueListener) 完成，
+                         调用方不会阻塞在磁盘 I/O 上，进程退出或者调用 shutdown_logger(name) 时写完剩余日志
+    :param max_bytes:    日志文件超过这个大小之后轮转，保留 backup_count 个历史文件
+    :param rotate_when:  按时间轮转 ('S'、'M'、'H'、'D'、'midnight' 等)，与 max_bytes 二选一
+    :param rate_limit:   重复日志的限流/去重，传入秒数表示同一条消息在这个时间窗口之内只记录一次，也可以传入 RateLimitFilter，
+                         过滤器挂在 logger 上 (控制台与文件看到的是同一批日志)，队列模式下在入队之前过滤，被丢弃的日志不会进入队列
+    """
     # 统一日志格式
     log_format = "[%(asctime)s] %(levelname)s - %(pathname)s[line:%(lineno)d]: %(message)s"
     date_format = "%Y-%m-%d %H:%M:%S"
@@ -50,26 +166,32 @@ def logger_initiate(log_level=logging.INFO, is_console=True, is_file=True, is_co
     # 普通日志格式
     formatter = logging.Formatter(log_format, datefmt=date_format)
 
-    # 彩色日志格式
-    colorful_formatter = colorlog.ColoredFormatter(
-        "%(log_color)s" + log_format,  # 保持结构一致，仅增加颜色
-        datefmt=date_format,
-        log_colors={
-            'DEBUG': 'cyan',
-            'INFO': 'green',
-            'WARNING': 'yellow',
-            'ERROR': 'red',
-            'CRITICAL': 'bold_red',
-        }
-    )
+    # 彩色日志格式，只有需要的时候才导入 colorlog
+    colorful_formatter = None
+    if is_console and is_colorful:
+        import colorlog
+        colorful_formatter = colorlog.ColoredFormatter(
+            "%(log_color)s" + log_format,  # 保持结构一致，仅增加颜色
+            datefmt=date_format,
+            log_colors={
+                'DEBUG': 'cyan',
+                'INFO': 'green',
+                'WARNING': 'yellow',
+                'ERROR': 'red',
+                'CRITICAL': 'bold_red',
+            }
+        )
 
     # 配置 logger
     logging.basicConfig(format=log_format, level=log_level)
-    _logger = logging.getLogger("autotest")
+    _logger = logging.getLogger(name)
     
-    # 每次调用这个函数之前需要清除已有的 handler，以免日志重复写入
+    # 每次调用这个函数之前需要清除已有的 handler (以及队列模式的后台线程)，以免日志重复写入
+    shutdown_logger(name)
     if _logger.hasHandlers():
         _logger.handlers.clear()  
+    for old_filter in [f for f in _logger.filters if isinstance(f, RateLimitFilter)]:
+        _logger.removeFilter(old_filter)
         
     _logger.setLevel(log_level)
 
@@ -82,17 +204,14 @@ def logger_initiate(log_level=logging.INFO, is_console=True, is_file=True, is_co
 
     #  输出到文件，文件写入当前正在运行的目录
     if is_file:
-        current_time = time.strftime("%Y%m%d")
-        log_filename = f"{current_time}.log"
-
         relative_log_directory = "logs"
         current_path = os.getcwd()  
-        log_directory = os.path.join(current_path, relative_log_directory)
+        log_directory = log_dir or os.path.join(current_path, relative_log_directory)
 
         if not os.path.exists(log_directory):
             os.makedirs(log_directory, exist_ok=True)
 
-        file_handler = logging.FileHandler(f"{log_directory}/{log_filename}")
+        file_handler = _file_handler(log_directory, name, max_bytes, rotate_when, backup_count)
         file_handler.setLevel(log_level)
         
         # 文件日志使用普通格式
@@ -102,6 +221,24 @@ def logger_initiate(log_level=logging.INFO, is_console=True, is_file=True, is_co
         _logger.addHandler(file_handler)
         _logger.propagate = False  
 
+    if rate_limit is not None and not isinstance(rate_limit, RateLimitFilter):
+        rate_limit = RateLimitFilter(interval=rate_limit)
+
+    # 队列模式: 上面创建的 handler 全部交给后台线程，logger 上只保留一个入队的 handler
+    if use_queue and _logger.handlers:
+        from queue import SimpleQueue
+        from logging.handlers import QueueListener
+        records = SimpleQueue()
+        listener = QueueListener(records, *_logger.handlers, respect_handler_level=True)
+        _logger.handlers.clear()
+        _logger.addHandler(_DeferredQueueHandler(records))
+        _listeners[name] = listener
+        listener.start()
+
+    # 限流挂在 logger 上只判断一次: 如果挂在每个 handler 上，共享的窗口会被第一个 handler (控制台) 用完，后面的文件什么也收不到
+    if rate_limit is not None:
+        _logger.addFilter(rate_limit)
+
     # 动态添加 highlight（等价于 debug）与 success（等价于 info）
     setattr(_logger, "highlight", _logger.debug)
     setattr(_logger, "success", _logger.info)
@@ -109,13 +246,28 @@ def logger_initiate(log_level=logging.INFO, is_console=True, is_file=True, is_co
     return _logger
 
 
-logger = logger_initiate(log_level=logging.INFO, is_console=True, is_file=True, is_colorful=True)
+_default_logger = None
+
+
+def get_logger() -> LoggerX:
+    """ 获取默认 logger (控制台彩色日志 + 当前目录 logs/ 下的日志文件)，首次调用的时候才会创建，
+        导入本模块不会创建目录、打开文件或者修改 logging 的全局配置
+    """
+    global _default_logger
+    if _default_logger is None:
+        _default_logger = logger_initiate(log_level=logging.INFO, is_console=True, is_file=True, is_colorful=True)
+    return _default_logger
+
+
+def __getattr__(name):
+    # 兼容老代码: 模块属性 logger 与 Log 在首次访问的时候才初始化
+    if name in ("logger", "Log"):
+        return get_logger()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# 兼容老代码
-Log = logger
 
 # 允许被外部导入
-__all__ = ["logger_initiate", "logging", "logger"]  
+__all__ = ["logger_initiate", "get_logger", "shutdown_logger", "RateLimitFilter", "logging", "logger"]  
 
 
 
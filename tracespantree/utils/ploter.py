@@ -1,12 +1,203 @@
+import html
 
-import matplotlib.pyplot as plt
-import networkx as nx
+from typing import Optional
 
-from tracespantree.collections import MultiNestDict, KVTree
 
+""" Trace 可视化:
+    - render_svg / render_html: 直接基于 SpanTree.sons 做线性时间的 tidy-tree 布局，不依赖 matplotlib 与 graphviz，
+      支持折叠重复的兄弟调用 (调用模式相同的兄弟节点合并为一个 "name ×N" 节点) 以及深度限制，适合上千个 span 的大 trace
+    - visualize_trace: 原有的 networkx + matplotlib 渲染，作为可选后端保留，依赖在调用时才导入，
+      没有安装 pygraphviz 的时候退化为 tidy-tree 布局
+"""
 
-# 生成树并可视化
+
+class LayoutNode:
+    ''' 布局之后的一个可视化节点，count > 1 表示折叠了 count 个重复的兄弟调用，hidden 表示因深度限制被隐藏的后代个数
+    '''
+    __slots__ = ("span_id", "label", "depth", "x", "count", "hidden", "is_error", "parent", "children")
+
+    def __init__(self, span_id, label, depth, count = 1, is_error = False, parent = None):
+        self.span_id  = span_id
+        self.label    = label
+        self.depth    = depth
+        self.x        = 0.0
+        self.count    = count
+        self.hidden   = 0
+        self.is_error = is_error
+        self.parent   = parent
+        self.children = []
+
+
+def _ordered_children(tree, span_id, position: dict) -> list:
+    children = [child_id for child_id in tree.sons.get(span_id, ()) if child_id in tree.span_map]
+    children.sort(key=position.__getitem__)
+    return children
+
+
+def _group_siblings(tree, children: list, collapse_repeats: bool) -> list:
+    ''' 把调用模式相同 (name 与子树结构都相同) 的兄弟节点合并成一组，保持首次出现的顺序
+    '''
+    if not collapse_repeats:
+        return [[child_id] for child_id in children]
+    groups = {}
+    for child_id in children:
+        groups.setdefault(tree.subtree_hash(child_id, with_payload=False), []).append(child_id)
+    return list(groups.values())
+
+
+def _subtree_size(tree, span_id) -> int:
+    size, stack = 0, [span_id]
+    while stack:
+        current_id = stack.pop()
+        size += 1
+        stack.extend(child_id for child_id in tree.sons.get(current_id, ()) if child_id in tree.span_map)
+    return size
+
+
+def tidy_layout(tree, max_depth: Optional[int] = None, collapse_repeats: bool = True, status_key: str = None) -> list:
+    ''' 线性时间的 tidy-tree 布局: 叶子节点从左到右依次占用一个横坐标，父节点位于第一个与最后一个孩子的正中间，
+        纵坐标就是深度。返回所有联通分量的根节点 (LayoutNode)
+
+    :param max_depth:        最多展示多少层 (树根为第 0 层)，更深的 span 折叠到其祖先节点的 hidden 计数里面
+    :param collapse_repeats: 是否把调用模式相同的兄弟节点折叠成一个节点
+    :param status_key:       状态码字段，不传的时候使用 tree.schema 的访问函数 (默认格式为 status_code)
+    '''
+    position = {span_id: i for i, span_id in enumerate(tree.span_map)}
+
+    get_status = (lambda span: span.get(status_key)) if status_key else tree.schema.status
+
+    def make_node(group, depth, parent):
+        span = tree.span_map[group[0]]
+        status = get_status(span)
+        return LayoutNode(group[0], str(tree.schema.name(span)), depth, count=len(group),
+                          is_error=status is not None and status != 0, parent=parent)
+
+    roots = [make_node([root_id], 0, None) for root_id in sorted(tree.get_components(), key=position.__getitem__)]
+
+    # 先序遍历建立可视化节点
+    stack = list(reversed(roots))
+    while stack:
+        node = stack.pop()
+        children = _ordered_children(tree, node.span_id, position)
+        if max_depth is not None and node.depth >= max_depth:
+            node.hidden = sum(_subtree_size(tree, child_id) for child_id in children)
+            continue
+        for group in _group_siblings(tree, children, collapse_repeats):
+            node.children.append(make_node(group, node.depth + 1, node))
+        stack.extend(reversed(node.children))
+
+    # 后序遍历计算横坐标
+    next_x = 0
+    for root in roots:
+        stack = [(root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if not node.children:
+                node.x, next_x = next_x, next_x + 1
+            elif not expanded:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
+            else:
+                node.x = (node.children[0].x + node.children[-1].x) / 2
+    return roots
+
+
+def _iter_nodes(roots: list):
+    stack = list(reversed(roots))
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+
+def _node_label(node: LayoutNode, max_label: int) -> str:
+    label = node.label if len(node.label) <= max_label else node.label[:max_label - 1] + "…"
+    if node.count > 1:
+        label += f" ×{node.count}"
+    if node.hidden:
+        label += f" (+{node.hidden})"
+    return label
+
+
+def render_svg(tree, path: str = None, max_depth: Optional[int] = None, collapse_repeats: bool = True,
+               x_gap: int = 120, y_gap: int = 70, max_label: int = 18) -> str:
+    ''' 把 SpanTree 渲染成 SVG 字符串，传入 path 时同时写入文件
+    '''
+    roots = tidy_layout(tree, max_depth=max_depth, collapse_repeats=collapse_repeats)
+    nodes = list(_iter_nodes(roots))
+
+    width = (max((node.x for node in nodes), default=0) + 1) * x_gap
+    height = (max((node.depth for node in nodes), default=0) + 1) * y_gap
+
+    def xy(node):
+        return node.x * x_gap + x_gap / 2, node.depth * y_gap + y_gap / 2
+
+    lines = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" '
+             f'viewBox="0 0 {width:.0f} {height:.0f}" font-family="sans-serif" font-size="11">']
+    for node in nodes:
+        if node.parent is not None:
+            (x1, y1), (x2, y2) = xy(node.parent), xy(node)
+            lines.append(f'<line x1="{x1:.1f}" y1="{y1:.1f}" x2="{x2:.1f}" y2="{y2:.1f}" stroke="#999"/>')
+    for node in nodes:
+        x, y = xy(node)
+        fill = "#f4a6a6" if node.is_error else "#a6cbf4"
+        title = html.escape(f"{node.label} (span_id={node.span_id}, count={node.count}, hidden={node.hidden})")
+        lines.append(f'<g><title>{title}</title><circle cx="{x:.1f}" cy="{y:.1f}" r="8" fill="{fill}" stroke="#555"/>'
+                     f'<text x="{x:.1f}" y="{y + 20:.1f}" text-anchor="middle">{html.escape(_node_label(node, max_label))}</text></g>')
+    lines.append("</svg>")
+
+    svg = "\n".join(lines)
+    if path is not None:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(svg)
+    return svg
+
+
+def render_html(tree, path: str = None, max_depth: Optional[int] = None, collapse_repeats: bool = True,
+                open_depth: int = 2, title: str = "Trace") -> str:
+    ''' 把 SpanTree 渲染成可以折叠/展开的 HTML 大纲 (基于 <details>，不需要 JavaScript)，传入 path 时同时写入文件
+
+    :param open_depth: 默认展开多少层
+    '''
+    roots = tidy_layout(tree, max_depth=max_depth, collapse_repeats=collapse_repeats)
+
+    lines = ["<!DOCTYPE html>", '<html><head><meta charset="utf-8">', f"<title>{html.escape(title)}</title>",
+             "<style>body{font-family:sans-serif;font-size:13px}details{margin-left:1.2em}"
+             "summary{cursor:pointer}.leaf{margin-left:2.4em}.err{color:#c00}.meta{color:#888}</style>",
+             "</head><body>", f"<h3>{html.escape(title)}</h3>"]
+
+    # 显式栈生成嵌套的 <details>，出栈的 None 表示闭合标签
+    stack = list(reversed(roots))
+    while stack:
+        node = stack.pop()
+        if node is None:
+            lines.append("</details>")
+            continue
+
+        css = ' class="err"' if node.is_error else ""
+        text = f'<span{css}>{html.escape(_node_label(node, max_label=120))}</span> <span class="meta">{html.escape(str(node.span_id))}</span>'
+        if not node.children:
+            lines.append(f'<div class="leaf">{text}</div>')
+            continue
+
+        is_open = " open" if node.depth < open_depth else ""
+        lines.append(f"<details{is_open}><summary>{text}</summary>")
+        stack.append(None)
+        stack.extend(reversed(node.children))
+    lines.append("</body></html>")
+
+    page = "\n".join(lines)
+    if path is not None:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(page)
+    return page
+
+
+# 生成树并可视化 (可选后端，需要 matplotlib 与 networkx，pygraphviz 可选)
 def visualize_trace(spans, title = "untitle"):
+    import matplotlib.pyplot as plt
+    import networkx as nx
+
     G = nx.DiGraph()
 
     #  spans 之中每个节点作为图的节点
@@ -19,8 +210,14 @@ def visualize_trace(spans, title = "untitle"):
         if parent_span_id:
             G.add_edge(parent_span_id, span_id)
 
-    # 使用 graphviz_layout 来生成按层次排序的布局，确保父子节点关系在可视化时是上下结构
-    pos = nx.nx_agraph.graphviz_layout(G, prog='dot')
+    # 使用 graphviz_layout 来生成按层次排序的布局，确保父子节点关系在可视化时是上下结构，没有安装 pygraphviz 时使用 tidy-tree 布局
+    try:
+        pos = nx.nx_agraph.graphviz_layout(G, prog='dot')
+    except ImportError:
+        from tracespantree.collections import SpanTree
+        tree = SpanTree(spans=[dict(span) for span in spans.values()])
+        pos = {node.span_id: (node.x, -node.depth) for node in _iter_nodes(tidy_layout(tree, collapse_repeats=False))}
+        pos.update({node: (0, 1) for node in G.nodes if node not in pos})
 
     # 绘制图
     plt.figure(figsize=(8, 6))
@@ -28,4 +225,4 @@ def visualize_trace(spans, title = "untitle"):
 
     # 显示图
     plt.title("Trace Mock Visualization")
-    plt.savefig(f"{title}.png")
\ No newline at end of file
+    plt.savefig(f"{title}.png")
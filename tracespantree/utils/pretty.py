@@ -0,0 +1,95 @@
+import io
+
+from typing import Any, Iterator, Optional, TextIO
+
+
+""" 流式的树形格式化输出:
+    - 显式栈遍历，不使用递归，任意深度的嵌套都不会触发 RecursionError
+    - 逐行产出 (iter_pretty_lines) 或者逐行写入任意文本流 (render_pretty)，不会在内存里面拼出完整的字符串
+    - 支持最大深度、每个 list/dict 最多展示的元素个数以及字符串最大长度三种截断
+    不做任何截断时，输出格式与原来 KVTree.pretty_str 完全相同。
+"""
+
+
+_END = object()
+
+
+def _scalar(value: Any, max_str_len: Optional[int]) -> str:
+    text = f"{value}"
+    if max_str_len is not None and len(text) > max_str_len:
+        return f"{text[:max_str_len]}... (+{len(text) - max_str_len} chars)"
+    return text
+
+
+def _summary(value) -> str:
+    if isinstance(value, dict):
+        return f"{{...}} ({len(value)} keys)"
+    return f"[...] ({len(value)} items)"
+
+
+def iter_pretty_lines(data: Any, max_depth: Optional[int] = None, max_items: Optional[int] = None,
+                      max_str_len: Optional[int] = None, level: int = 0) -> Iterator[str]:
+    ''' 逐行产出 data 的树形格式化结果 (每行以换行符结尾)，每层缩进四个空格
+
+    :param max_depth:   最多展开多少层 (level 从 0 开始计数)，更深的 dict/list 折叠为 "{...} (N keys)" 或 "[...] (N items)"
+    :param max_items:   每个 dict/list 最多展示多少个元素，其余元素折叠为一行 "... (N more items)"
+    :param max_str_len: 标量转成字符串之后的最大长度，超出部分截断
+    :param level:       起始缩进层级
+    '''
+    if not isinstance(data, (dict, list)):
+        yield f"{'    ' * level}{_scalar(data, max_str_len)}\n"
+        return
+
+    # 栈帧: (元素迭代器, 层级, 是否为 list, 已经输出的元素个数, 元素总数)
+    def frame(container, depth):
+        items = iter(container.items()) if isinstance(container, dict) else iter(container)
+        return [items, depth, isinstance(container, list), 0, len(container)]
+
+    stack = [frame(data, level)]
+    while stack:
+        top = stack[-1]
+        items, depth, is_list, shown, total = top
+        indent = "    " * depth
+
+        if max_items is not None and shown >= max_items and shown < total:
+            yield f"{indent}... ({total - shown} more items)\n"
+            stack.pop()
+            continue
+
+        item = next(items, _END)
+        if item is _END:
+            stack.pop()
+            continue
+        top[3] += 1
+
+        if is_list:
+            # list 的元素: dict 在 list 所在的层级展开，其余元素 (包括嵌套的 list) 直接输出
+            if isinstance(item, dict):
+                stack.append(frame(item, depth))
+            else:
+                yield f"{indent}{_scalar(item, max_str_len)}\n"
+            continue
+
+        key, value = item
+        if isinstance(value, (dict, list)):
+            if max_depth is not None and depth + 1 > max_depth:
+                yield f"{indent}{key}: {_summary(value)}\n"
+                continue
+            yield f"{indent}{key}:\n"
+            stack.append(frame(value, depth + 1))
+        else:
+            yield f"{indent}{key}: {_scalar(value, max_str_len)}\n"
+
+
+def render_pretty(data: Any, stream: Optional[TextIO] = None, max_depth: Optional[int] = None,
+                  max_items: Optional[int] = None, max_str_len: Optional[int] = None, level: int = 0) -> Optional[str]:
+    ''' 把 data 的树形格式化结果逐行写入 stream，没有传入 stream 的时候返回完整的字符串
+    '''
+    if stream is None:
+        buffer = io.StringIO()
+        render_pretty(data, buffer, max_depth=max_depth, max_items=max_items, max_str_len=max_str_len, level=level)
+        return buffer.getvalue()
+
+    for line in iter_pretty_lines(data, max_depth=max_depth, max_items=max_items, max_str_len=max_str_len, level=level):
+        stream.write(line)
+    return None
@@ -0,0 +1,131 @@
+import json
+import random
+
+from typing import Iterator
+
+
+""" 确定性的合成 Trace 生成器，用于基准测试与压测。相同的参数 (含 seed) 总是生成完全相同的 trace。
+
+    生成的 span 格式与 demos 下的 trace 相同 (name/type/span_id/parent_id/status_code + 负载)，
+    另外带有数值型的 start_time/end_time/duration (毫秒)。
+"""
+
+
+_SPAN_TYPES = ("http", "rpc", "db", "cache", "mq", "llm")
+
+
+def _payload(rng: random.Random, size: int, prefix: str) -> dict:
+    ''' 生成大约 size 字节 (JSON 序列化之后) 的三层嵌套负载
+    '''
+    payload, width, i = {}, max(1, size // 64), 0
+    chunk = max(8, size // (width * 2))
+    for group in range(max(1, width // 4)):
+        section = payload.setdefault(f"{prefix}_group_{group}", {})
+        for _ in range(4):
+            section[f"field_{i}"] = {"value": "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(chunk)),
+                                     "score": round(rng.random(), 4)}
+            i += 1
+    return payload
+
+
+def generate_trace(spans: int = 1000, depth: int = 8, fanout: int = 4, name_collisions: float = 0.2,
+                   payload_size: int = 256, stringified_ratio: float = 0.3, broken_links: int = 0,
+                   error_rate: float = 0.01, seed: int = 0, trace_id: str = None) -> dict:
+    ''' 生成一个 trace: {"trace_id": ..., "spans": [...]}
+
+    :param spans:             span 个数
+    :param depth:             最大深度 (树根深度为 0)
+    :param fanout:            每个 span 最多的孩子个数，容量不足以容纳 spans 个节点时会自动放宽
+    :param name_collisions:   span 复用已有名称 (重名) 的概率
+    :param payload_size:      每个 span 的 input/output 负载大约多少字节
+    :param stringified_ratio: input/output 以字符串化 JSON 形式出现的概率
+    :param broken_links:      多少个 span 的 parent_id 指向不存在的 span (断链)
+    :param error_rate:        status_code 不为 0 的概率
+    :param seed:              随机种子
+    '''
+    if spans > 1 and depth < 1:
+        # 深度为 0 时只有树根，其它 span 没有可以挂靠的父节点
+        raise ValueError(f"depth must be at least 1 to generate more than one span, but got depth={depth} with spans={spans}.")
+    rng = random.Random(seed)
+    trace_id = trace_id or f"trace-{seed:08x}"
+
+    # 可以继续挂孩子的节点: [span_index, depth, children]
+    open_parents, records, names = [], [], []
+    for i in range(spans):
+        if i == 0:
+            parent, level = None, 0
+        else:
+            if not open_parents:
+                # 容量耗尽时放宽扇出限制
+                open_parents = [[j, records[j][1], 0] for j in range(len(records)) if records[j][1] < depth]
+            slot = rng.randrange(len(open_parents))
+            parent_entry = open_parents[slot]
+            parent, level = parent_entry[0], parent_entry[1] + 1
+            parent_entry[2] += 1
+            if parent_entry[2] >= fanout:
+                open_parents[slot] = open_parents[-1]
+                open_parents.pop()
+
+        if names and rng.random() < name_collisions:
+            name = rng.choice(names)
+        else:
+            name = f"{rng.choice(_SPAN_TYPES)}_op_{i}"
+            names.append(name)
+
+        records.append((parent, level, name))
+        if level < depth:
+            open_parents.append([i, level, 0])
+
+    broken = set(rng.sample(range(1, spans), min(broken_links, max(0, spans - 1))))
+
+    # 孩子节点的时间区间落在父节点的时间区间之内
+    result, starts, durations = [], [], []
+    for i, (parent, level, name) in enumerate(records):
+        if parent is None:
+            start, duration = 0, rng.randint(1000, 5000)
+        else:
+            duration = max(1, int(durations[parent] * rng.uniform(0.05, 0.5)))
+            start = starts[parent] + rng.randint(0, durations[parent] - duration)
+        starts.append(start)
+        durations.append(duration)
+
+        if i in broken:
+            parent_id = f"{trace_id}-missing-{i}"
+        else:
+            parent_id = f"{trace_id}-{parent}" if parent is not None else "0"
+
+        span = {
+            "name": name,
+            "type": name.split("_", 1)[0],
+            "span_id": f"{trace_id}-{i}",
+            "parent_id": parent_id,
+            "status_code": 1 if rng.random() < error_rate else 0,
+            "start_time": start,
+            "end_time": start + duration,
+            "duration": duration,
+        }
+        for key in ("input", "output"):
+            payload = _payload(rng, payload_size // 2, key)
+            span[key] = json.dumps(payload) if rng.random() < stringified_ratio else payload
+        result.append(span)
+
+    return {"trace_id": trace_id, "spans": result}
+
+
+def generate_traces(n: int, seed: int = 0, **kwargs) -> Iterator[dict]:
+    ''' 依次生成 n 个 trace，第 k 个 trace 使用 seed + k 作为随机种子
+    '''
+    for k in range(n):
+        yield generate_trace(seed=seed + k, **kwargs)
+
+
+def write_jsonl(path: str, traces) -> int:
+    ''' 把 trace 逐行写入 JSONL 文件，返回写入的 trace 个数
+    '''
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for trace in traces:
+            f.write(json.dumps(trace, ensure_ascii=False))
+            f.write("\n")
+            count += 1
+    return count